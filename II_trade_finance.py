@@ -13,6 +13,7 @@ from agent_and_subagents.summarize_llm import SummarizeLLM
 from agent_and_subagents.certificate_of_origin_llm_extractor import CertificateOfOriginLLMExtractor
 from email_and_mongo.email_pdf_merger_uploader import merge_pdfs_unique_and_upload
 from email_and_mongo.mongo_trade_finance_store import store_trade_finance_result
+from pipeline.telemetry import log_debug_payload
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 load_dotenv()
@@ -75,7 +76,7 @@ def run_azure_ocr_local(file_path: str) -> str:
 
         result = poller.result()
         raw_content=result.content
-        print('raw_content',raw_content)
+        log_debug_payload("Azure OCR raw content", raw_content)
         
         text_lines = []
 
@@ -1,7 +1,11 @@
 import os
+import sys
 import time
+import socket
 import traceback
+import contextvars
 import boto3
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Dict, Any
 from dotenv import load_dotenv
 from agent_and_subagents.document_type_classifier import DocumentTypeClassifier
@@ -10,22 +14,46 @@ from agent_and_subagents.courier_dispatch_advice import CourierDispatchAdviceLLM
 from agent_and_subagents.airway_bill_llm_extractor import AirWaybillLLMExtractor
 from agent_and_subagents.letter_of_credit_llm_extractor import LetterOfCreditLLMExtractor
 from email_and_mongo.email_attachment_fetcher import fetch_unread_mbd_emirates_attachments
+from agent_and_subagents.llm_router import open_routes
 from agent_and_subagents.summarize_llm import SummarizeLLM
 from agent_and_subagents.certificate_of_origin_llm_extractor import CertificateOfOriginLLMExtractor
-from email_and_mongo.email_pdf_merger_uploader import merge_pdfs_unique_and_upload
-from email_and_mongo.mongo_trade_finance_store import store_trade_finance_result
+from agent_and_subagents.speculative_extraction import SpeculativeExtractor
+from document_layout.template_store import get_template_store
+from pipeline.cassettes import wrap_document_intelligence, save_cassette
+from pipeline.telemetry import span, add_to_span, log_debug_payload, metrics, start_metrics_server
+from document_layout.document_model import DocumentModel, encode_document_model, decode_document_model
+from document_layout.segmentation import segment_bundle
+from document_layout import scan_preprocessing
+from email_and_mongo.email_pdf_merger_uploader import (
+    merge_pdfs_unique, upload_merged_pdf, merge_and_stream_to_s3,
+    MERGE_STREAM_TO_S3, MERGED_PDF_LOCAL_COPY,
+    existing_merge_or_manifest
+)
+from email_and_mongo.s3_transfer_service import s3_transfer_stats
+from email_and_mongo.mongo_trade_finance_store import (
+    store_trade_finance_result, get_mongo_outbox, get_debug_outbox, MONGO_ASYNC_WRITES,
+    ensure_indexes
+)
+from email_and_mongo.attachment_store import get_attachment_store
+from pipeline.stage_queue import get_stage_queue, run_checkpointed_stage, LeaseHeartbeat
+from pipeline.stage_pipeline import run_stage_pipeline, FanOut
+from pipeline.resilience import (
+    get_circuit_breaker, open_circuits, stage_timeout, deadline_scope,
+    Deadline, CircuitOpenError, DeadlineExceeded
+)
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
 load_dotenv()
 
 
 AZURE_ENDPOINT = os.getenv("AZURE_AI_SERVICES_ENDPOINT")
 AZURE_KEY = os.getenv("AZURE_AI_SERVICES_API_KEY")
 
-client = DocumentIntelligenceClient(
+client = wrap_document_intelligence(DocumentIntelligenceClient(
     endpoint=AZURE_ENDPOINT,
     credential=AzureKeyCredential(AZURE_KEY)
-)
+))
 
 
 
@@ -53,184 +81,705 @@ EXPECTED_DOCUMENT_TYPES = {
 }
 
 
+DOCUMENT_EXTRACTORS = {
+    "INVOICE": InvoiceLLMExtractor,
+    "COURIER_DISPATCH_ADVICE": CourierDispatchAdviceLLMExtractor,
+    "AIR_WAYBILL": AirWaybillLLMExtractor,
+    "LETTER_OF_CREDIT": LetterOfCreditLLMExtractor,
+    "CERTIFICATE_OF_ORIGIN": CertificateOfOriginLLMExtractor
+}
+
+
 bucket_name = "yc-retails-invoice"
 s3_folder = "uploads_trade_finance/"
 local_working_folder = "merged_output/"
 
+# Start the predicted extractor in parallel with the LLM classifier
+SPECULATIVE_EXTRACTION = os.getenv("SPECULATIVE_EXTRACTION", "0") == "1"
+speculative_extractor = SpeculativeExtractor(DOCUMENT_EXTRACTORS)
 
+# Repeat-sender layouts: classify + extract by geometry instead of the LLM
+TEMPLATE_EXTRACTION = os.getenv("TEMPLATE_EXTRACTION", "0") == "1"
+# Self-train templates from LLM extractions (unreviewed; the LLM output is
+# the ground truth). TEMPLATE_AUTO_LEARN is the former name.
+TEMPLATE_SELF_TRAIN = os.getenv("TEMPLATE_SELF_TRAIN", os.getenv("TEMPLATE_AUTO_LEARN", "0")) == "1"
 
+# Split PDF bundles (invoice + COO + AWB in one file) into their documents
+BUNDLE_SEGMENTATION = os.getenv("BUNDLE_SEGMENTATION", "1") == "1"
 
-def run_azure_ocr_local(file_path: str) -> str:
+# Downsample scanned (image-only) pages before upload to Azure DI;
+# needs pymupdf (+ pillow). Validate first: python I_trade_finance.py scan-guard <pdfs>
+SCAN_PREPROCESS = os.getenv("SCAN_PREPROCESS", "0") == "1"
+
+# Per-transaction deadline, propagated to every stage / dependency call
+TRANSACTION_DEADLINE_SECONDS = float(os.getenv("TRANSACTION_DEADLINE_SECONDS", "900"))
+OCR_TIMEOUT_SECONDS = float(os.getenv("OCR_TIMEOUT_SECONDS", "120"))
+
+# How long main() waits for the Mongo outbox to send its batch
+MONGO_DRAIN_SECONDS = float(os.getenv("MONGO_DRAIN_SECONDS", "30"))
+
+# Emails processed concurrently; bounded by cores and Azure API quota
+TRANSACTION_WORKERS = int(os.getenv("TRANSACTION_WORKERS", "4"))
+
+# Linear backoff before a failed transaction is retried from its checkpoints
+RETRY_DELAY_SECONDS = float(os.getenv("PIPELINE_RETRY_DELAY_SECONDS", "30"))
+
+
+
+
+def collect_pipeline_metrics(registry):
     """
-    Run Azure Document Intelligence (prebuilt-layout)
-    and return FULL TEXT only.
+    Scrape-time gauges from stats the pipeline already keeps
+    """
+    circuits = registry.gauge("circuit_open", "1 while the dependency's circuit rejects calls")
+    circuits.clear()
+    for name in open_circuits():
+        circuits.set(1, dependency=name)
+
+    if MONGO_ASYNC_WRITES:
+        outbox = registry.gauge("mongo_outbox_documents", "Mongo outbox documents by outbox and state")
+        for name, pending in (("results", get_mongo_outbox()), ("debug", get_debug_outbox())):
+            for state, value in pending.stats().items():
+                outbox.set(value, outbox=name, state=state)
+
+
+metrics.register_collector(collect_pipeline_metrics)
+
+
+def is_azure_dependency_failure(e: Exception) -> bool:
+    """
+    True for errors that mean the Azure service is unhealthy (network,
+    timeout, 429, 5xx), as opposed to a problem with one document
+    """
+    if isinstance(e, (ServiceRequestError, ServiceResponseError, TimeoutError)):
+        return True
+    if isinstance(e, HttpResponseError):
+        status = getattr(e, "status_code", None)
+        return status is None or status >= 500 or status == 429
+    return False
+
+
+def run_azure_layout_local(file_path: str) -> DocumentModel:
+    """
+    Run Azure Document Intelligence (prebuilt-layout) and return the pages,
+    line polygons, tables and key-value pairs as a DocumentModel.
+
+    Service failures (circuit open, timeout, 429/5xx) are raised so the
+    transaction is retried later; a document the service rejects returns an
+    empty DocumentModel.
     """
 
+    breaker = get_circuit_breaker("azure_di")
+
     try:
         print(f"📄 Reading local file: {file_path}")
 
-        with open(file_path, "rb") as f:
-            poller = client.begin_analyze_document(
-                model_id="prebuilt-layout",
-                body=f
-            )
+        timeout = stage_timeout(OCR_TIMEOUT_SECONDS, "OCR")
 
-        result = poller.result()
+        with breaker.guard(is_failure=is_azure_dependency_failure):
+            with open(file_path, "rb") as f:
+                poller = client.begin_analyze_document(
+                    model_id="prebuilt-layout",
+                    body=f
+                )
+
+            result = poller.result(timeout=timeout)
+            if not poller.done():
+                raise TimeoutError(f"Azure OCR did not finish within {timeout:.0f}s")
         raw_content=result.content
-        print('raw_content',raw_content)
-        
-        text_lines = []
+        log_debug_payload("Azure OCR raw content", raw_content)
 
-        # Extract text from pages
-        for page in result.pages:
-            for line in page.lines:
-                if line.content.strip():
-                    text_lines.append(line.content.strip())
+        document_model = DocumentModel.from_azure_result(result)
 
-        full_text = "\n".join(text_lines)
+        line_count = sum(len(page) for page in document_model.pages)
+        print(f"✅ Azure OCR complete. Extracted {line_count} lines, {len(document_model.tables)} tables")
 
-        print(f"✅ Azure OCR complete. Extracted {len(text_lines)} lines")
+        return document_model
 
-        return full_text
+    except (CircuitOpenError, DeadlineExceeded):
+        raise
 
     except Exception as e:
         print(f"❌ Azure OCR error: {e}")
         traceback.print_exc()
-        return ""
+        if is_azure_dependency_failure(e):
+            raise
+        return DocumentModel()
+
+
+def run_azure_ocr_local(file_path: str) -> str:
+    """
+    Run Azure Document Intelligence (prebuilt-layout)
+    and return FULL TEXT only.
+    """
+    return run_azure_layout_local(file_path).text
+
+
+def load_document_model(attachment_id: str, file_path: str) -> DocumentModel:
+    """
+    OCR an attachment, reusing the binary DocumentModel cached for the same
+    attachment bytes (see AttachmentStore)
+    """
+    attachment_store = get_attachment_store()
+
+    if attachment_id:
+        cached = attachment_store.load_binary_result(attachment_id, "document_model")
+        if cached is not None:
+            print(f"♻️ Reusing cached OCR for attachment {attachment_id[:12]}")
+            add_to_span(cache_hits=1)
+            return DocumentModel.from_bytes(cached)
+
+    prepared = None
+    if SCAN_PREPROCESS and scan_preprocessing.is_available():
+        try:
+            prepared = scan_preprocessing.preprocess_scanned_pdf(file_path)
+        except Exception as e:
+            # Encrypted / damaged scans: the service may still read the original
+            print(f"⚠️ Scan preprocessing failed for {os.path.basename(file_path)}, sending the original: {e}")
+
+    try:
+        document_model = run_azure_layout_local(prepared["file_path"] if prepared else file_path)
+    finally:
+        if prepared and prepared["preprocessed"]:
+            os.remove(prepared["file_path"])
+
+    if attachment_id and document_model:
+        attachment_store.save_binary_result(attachment_id, "document_model", document_model.to_bytes())
+
+    return document_model
+
+
+def run_cached_stage(attachment_id: str, stage: str, compute):
+    """
+    Reuse the result of `stage` computed earlier for the same attachment
+    bytes (see AttachmentStore). Empty and failed results are not cached.
+    """
+    attachment_store = get_attachment_store()
+
+    if attachment_id:
+        cached = attachment_store.load_result(attachment_id, stage)
+        if cached is not None:
+            print(f"♻️ Reusing cached {stage} for attachment {attachment_id[:12]}")
+            return cached
+
+    result = compute()
+
+    failed = isinstance(result, dict) and "error" in result
+    if attachment_id and result and not failed:
+        attachment_store.save_result(attachment_id, stage, result)
+
+    return result
+
+
 # ===============================
 # Example usage
 # ===============================
-def main():
-    # --------------------------------
-    # Step 1: Fetch unread email attachments
-    # --------------------------------
-    mail_data = fetch_unread_mbd_emirates_attachments()
-    #attachment_files = mail_data.get("files", [])
-    attachment_files = []
+def transaction_job_id(email_data: dict) -> str:
+    """
+    Stable queue id for an email: mailbox + UIDVALIDITY + UID
+    """
+    return f"{email_data.get('mailbox', 'inbox')}:{email_data['uidvalidity']}:{email_data['email_uid']}"
 
-    for email_data in mail_data:
-        files = email_data.get("files", [])
-        attachment_files.extend(files)
 
-    print("Total attachments:", attachment_files)
+def process_transaction(job_id: str, email_data: dict) -> dict:
+    """
+    Run the full pipeline for ONE email (one trade finance transaction):
+    OCR → classify → extract → summarize → merge/upload → Mongo.
 
+    Every stage is checkpointed in the StageQueue under job_id, so a rerun
+    after a crash resumes at the first incomplete stage.
+    """
+    queue = get_stage_queue()
+    attachment_files = email_data.get("files", [])
+    attachment_ids = {
+        attachment["file_path"]: attachment["attachment_id"]
+        for attachment in email_data.get("attachments", [])
+    }
+    email_subject = email_data.get("email_subject", "")
+
+    print(f"\n📨 Transaction: {email_subject}")
     print(f"📂 Processing {len(attachment_files)} attachment(s)")
 
     if not attachment_files:
-        print("⚠️ No attachments found. Exiting.")
+        print("⚠️ No attachments found. Skipping.")
         return {}
 
     # --------------------------------
-    # Step 2: Initialize classifier
+    # Merge + S3 upload only need the raw attachments: run them alongside
+    # the LLM stages and join before the Mongo store
     # --------------------------------
-    classifier = DocumentTypeClassifier()
+    def merge_and_upload():
+        print("\n📦 Creating merged PDF & uploading to S3...")
+
+        if MERGE_STREAM_TO_S3:
+            # Merge and upload overlap: one span for both
+            with span("merge_upload", attachments=len(attachment_files)):
+                return merge_and_stream_to_s3(
+                    attachment_files,
+                    bucket_name=bucket_name,
+                    s3_folder=s3_folder,
+                    aws_access_key=AWS_ACCESS_KEY,
+                    aws_secret_key=AWS_SECRET_KEY,
+                    aws_region=REGION,
+                    local_folder=local_working_folder if MERGED_PDF_LOCAL_COPY else None
+                )
+
+        manifest, existing = existing_merge_or_manifest(
+            attachment_files,
+            bucket_name=bucket_name,
+            s3_folder=s3_folder,
+            aws_access_key=AWS_ACCESS_KEY,
+            aws_secret_key=AWS_SECRET_KEY,
+            aws_region=REGION
+        )
+        if existing:
+            return existing
+
+        with span("merge", attachments=len(attachment_files)) as merge_span:
+            merged = run_checkpointed_stage(
+                queue, job_id, "merged",
+                lambda: merge_pdfs_unique(attachment_files, local_working_folder)
+            )
+
+            # Checkpointed merge output may be gone (cleaned up / other host)
+            if not os.path.exists(merged["local_pdf_path"]):
+                merged = merge_pdfs_unique(attachment_files, local_working_folder)
+                queue.save_stage_output(job_id, "merged", merged)
+
+            merge_span.set(bytes=os.path.getsize(merged["local_pdf_path"]))
+
+        with span("upload"):
+            return upload_merged_pdf(
+                merged["local_pdf_path"],
+                bucket_name=bucket_name,
+                s3_folder=s3_folder,
+                aws_access_key=AWS_ACCESS_KEY,
+                aws_secret_key=AWS_SECRET_KEY,
+                aws_region=REGION,
+                manifest=manifest
+            )
+
+    merge_executor = ThreadPoolExecutor(max_workers=1)
+    merge_future = merge_executor.submit(
+        contextvars.copy_context().run,
+        run_checkpointed_stage, queue, job_id, "uploaded", merge_and_upload
+    )
 
     # --------------------------------
-    # Step 3: FINAL OUTPUT CONTAINER
+    # Step 2: Initialize classifier
     # --------------------------------
-    final_llm_results = []
+    classifier = DocumentTypeClassifier()
 
     # --------------------------------
-    # Step 4: Process each attachment
+    # Step 3-4: Stream attachments through OCR → classify → extract;
+    # document 2 is OCR'd while document 1 is classified / extracted
     # --------------------------------
-    uploaded_doc_types = set()
-
-
-    for file_path in attachment_files:
+    def ocr_stage(file_path):
         print(f"\n📄 Processing file: {file_path}")
 
-        normalized_doc = run_azure_ocr_local(file_path)
+        attachment_id = attachment_ids.get(file_path)
 
-        if not normalized_doc:
-            print("⚠️ Skipping empty Textract result")
-            continue
+        def ocr():
+            document_model = load_document_model(attachment_id, file_path)
+            return encode_document_model(document_model) if document_model else None
 
-        doc_type = classifier.classify(normalized_doc)
-        print("📌 Document Type:", doc_type)
-        
-        
+        with span("ocr", file=os.path.basename(file_path), bytes=os.path.getsize(file_path)) as ocr_span:
+            # Older checkpoints hold plain text or a layout dict; both decode
+            document_model = decode_document_model(run_checkpointed_stage(
+                queue, job_id, "ocr", ocr, item_key=file_path
+            ))
 
-        if doc_type in EXPECTED_DOCUMENT_TYPES:
-            uploaded_doc_types.add(doc_type)
+            if document_model:
+                ocr_span.set(
+                    pages=len(document_model.pages),
+                    lines=sum(len(page) for page in document_model.pages),
+                    tables=len(document_model.tables)
+                )
 
+        if not document_model:
+            print("⚠️ Skipping empty Textract result")
+            return None
+
+        segments = segment_bundle(document_model) if BUNDLE_SEGMENTATION else []
+
+        if not segments:
+            return {
+                "file_path": file_path,
+                "attachment_id": attachment_id,
+                "item_key": file_path,
+                "segment": None,
+                "segment_type": None,
+                "segment_title_types": [],
+                # Compact prompt encoding: lines plus tables / key-value pairs
+                "normalized_doc": document_model.to_prompt(),
+                "document_model": document_model
+            }
+
+        # A bundle: each logical document goes on alone with only its pages
+        print(f"📑 Bundle split into {len(segments)} documents: " + ", ".join(
+            f"{segment.label} {segment.predicted_type or '?'}" for segment in segments
+        ))
+
+        documents = FanOut()
+        for segment in segments:
+            part = document_model.subset(segment.page_numbers)
+            documents.append({
+                "file_path": file_path,
+                "attachment_id": attachment_id,
+                "item_key": f"{file_path}#{segment.label}",
+                "segment": segment.label,
+                "segment_type": segment.predicted_type,
+                "segment_title_types": segment.title_types,
+                "normalized_doc": part.to_prompt(),
+                "document_model": part
+            })
+        return documents
+
+    def cache_stage(document, stage):
+        # Bundle parts are cached per page range of the attachment
+        return f"{stage}.{document['segment']}" if document["segment"] else stage
+
+    def document_name(document):
+        name = os.path.basename(document["file_path"])
+        return f"{name} [{document['segment']}]" if document["segment"] else name
+
+    def classify_stage(document):
+        speculation = None
+
+        # A known repeat-sender layout gives the type and fields directly
+        document["template_match"] = (
+            get_template_store().match(document["document_model"]) if TEMPLATE_EXTRACTION else None
+        )
+
+        def classify():
+            if document["template_match"]:
+                return document["template_match"].doc_type
+
+            # Bundle parts without an extractor (e.g. packing lists) keep
+            # their title-based type; the classifier cannot return it. A
+            # title that also names an extracted type ("Commercial Invoice
+            # cum Packing List") goes to the classifier instead.
+            if (
+                document["segment_type"]
+                and document["segment_type"] not in DOCUMENT_EXTRACTORS
+                and not any(doc_type in DOCUMENT_EXTRACTORS for doc_type in document["segment_title_types"])
+            ):
+                return document["segment_type"]
+
+            # Only reached when the type is not cached: start the likely
+            # extractor now instead of after the classifier returns
+            nonlocal speculation
+            if SPECULATIVE_EXTRACTION:
+                speculation = speculative_extractor.speculate(document["normalized_doc"])
+            return classifier.classify(document["normalized_doc"])
+
+        with span("classify", document=document_name(document)) as classify_span:
+            try:
+                document["doc_type"] = run_checkpointed_stage(
+                    queue, job_id, "classified",
+                    lambda: run_cached_stage(document["attachment_id"], cache_stage(document, "classification"), classify),
+                    item_key=document["item_key"]
+                )
+            except Exception:
+                speculative_extractor.resolve(speculation, None)
+                raise
+            classify_span.set(doc_type=document["doc_type"])
+
+        document["speculative_extraction"] = speculative_extractor.resolve(
+            speculation, document["doc_type"]
+        )
+        print("📌 Document Type:", document["doc_type"], f"({document_name(document)})")
+        return document
+
+    def extract_stage(document):
         extracted_data = None
 
-        if doc_type == "INVOICE":
-            extracted_data = InvoiceLLMExtractor().extract(normalized_doc)
-
-        elif doc_type == "COURIER_DISPATCH_ADVICE":
-            extracted_data = CourierDispatchAdviceLLMExtractor().extract(normalized_doc)
-
-        elif doc_type == "AIR_WAYBILL":
-            extracted_data = AirWaybillLLMExtractor().extract(normalized_doc)
+        extractor_class = DOCUMENT_EXTRACTORS.get(document["doc_type"])
 
-        elif doc_type == "LETTER_OF_CREDIT":
-            extracted_data = LetterOfCreditLLMExtractor().extract(normalized_doc)
+        if extractor_class:
+            speculative_extraction = document.get("speculative_extraction")
+            template_match = document.get("template_match")
 
-        elif doc_type == "CERTIFICATE_OF_ORIGIN":
-            extracted_data = CertificateOfOriginLLMExtractor().extract(normalized_doc)
+            def extract():
+                if template_match and template_match.doc_type == document["doc_type"]:
+                    print(f"🧩 Extracted by layout template {template_match.template_id} (score {template_match.score}), no LLM call")
+                    return template_match.extraction
 
+                if speculative_extraction:
+                    data = speculative_extraction.result()
+                else:
+                    data = extractor_class().extract(document["normalized_doc"])
+
+                if TEMPLATE_SELF_TRAIN:
+                    get_template_store().learn(document["document_model"], document["doc_type"], data)
+                return data
+
+            # One span name per extractor, so each gets its own histogram
+            with span(f"extract.{document['doc_type'].lower()}", document=document_name(document)):
+                extracted_data = run_checkpointed_stage(
+                    queue, job_id, "extracted",
+                    lambda: run_cached_stage(
+                        document["attachment_id"],
+                        cache_stage(document, f"extraction.{extractor_class.__name__}"),
+                        extract
+                    ),
+                    item_key=document["item_key"]
+                )
         else:
             print("ℹ️ No extractor configured for this document type")
 
-        final_llm_results.append({
-            "file_name": os.path.basename(file_path),
-            "doc_type": doc_type,
+        return {
+            "file_name": document_name(document),
+            "doc_type": document["doc_type"],
             "extracted_data": extracted_data
-        })
-        
-    missing_documents = [
-    EXPECTED_DOCUMENT_TYPES[doc]
-    for doc in EXPECTED_DOCUMENT_TYPES
-    if doc not in uploaded_doc_types
-    ]
+        }
 
+    try:
+        final_llm_results = run_stage_pipeline(
+            attachment_files,
+            [
+                ("ocr", ocr_stage),
+                ("classify", classify_stage),
+                ("extract", extract_stage),
+            ]
+        )
+
+        uploaded_doc_types = {
+            result["doc_type"]
+            for result in final_llm_results
+            if result["doc_type"] in EXPECTED_DOCUMENT_TYPES
+        }
+
+        missing_documents = [
+        EXPECTED_DOCUMENT_TYPES[doc]
+        for doc in EXPECTED_DOCUMENT_TYPES
+        if doc not in uploaded_doc_types
+        ]
+
+
+        # --------------------------------
+        # Step 5: Summarize (LC vs Docs)
+        # --------------------------------
+        print("\n🧾 Running Trade Finance Summary LLM...")
+        with span("summarize", documents=len(final_llm_results), missing=len(missing_documents)):
+            summarized_data = run_checkpointed_stage(
+                queue, job_id, "summarized",
+                lambda: SummarizeLLM().extract({
+                    "documents": final_llm_results,
+                    "missing_documents": missing_documents
+                })
+            )
 
-    # --------------------------------
-    # Step 5: Summarize (LC vs Docs)
-    # --------------------------------
-    print("\n🧾 Running Trade Finance Summary LLM...")
-    summarized_data = SummarizeLLM().extract({
-            "documents": final_llm_results,
-            "missing_documents": missing_documents
-        })
-
-    print("\n📦 Creating merged PDF & uploading to S3...")
-
-    merge_result = merge_pdfs_unique_and_upload(
-        attachments=attachment_files,
-        folder_path=local_working_folder,
-        bucket_name=bucket_name,
-        s3_folder=s3_folder,
-        aws_access_key=AWS_ACCESS_KEY,
-        aws_secret_key=AWS_SECRET_KEY,
-        aws_region=REGION
-    )
+        # Join the merge/upload branch before the Mongo store
+        merge_result = merge_future.result()
+
+    finally:
+        merge_executor.shutdown(wait=True)
 
     print("\n✅ MERGED PDF RESULT")
     print(merge_result)
-    
-    mongo_id = store_trade_finance_result(
-    extracted_results=summarized_data,
-    object_url=merge_result["object_url"],
-    filename=merge_result["filename"],
-    original_s3_file=merge_result["s3_key"],
-    email_text="Email subject: NMD Emirates"
-)
+
+    # Raw LLM output of failed extractions goes to the debug collection
+    debug_payloads = [
+        {
+            "fileName": result["file_name"],
+            "docType": result["doc_type"],
+            "error": result["extracted_data"].get("error"),
+            "rawLlmOutput": result["extracted_data"]["raw_llm_output"],
+        }
+        for result in final_llm_results
+        if isinstance(result.get("extracted_data"), dict) and "raw_llm_output" in result["extracted_data"]
+    ]
+
+    with span("store", debug_payloads=len(debug_payloads)):
+        mongo_id = run_checkpointed_stage(
+            queue, job_id, "stored",
+            lambda: store_trade_finance_result(
+                extracted_results=summarized_data,
+                object_url=merge_result["object_url"],
+                filename=merge_result["filename"],
+                original_s3_file=merge_result["s3_key"],
+                email_text=f"Email subject: {email_subject}",
+                debug_payloads=debug_payloads
+            )
+        )
     print("✅ Mongo Document ID:", mongo_id)
 
     # --------------------------------
     # Step 7: Final return object
     # --------------------------------
     return {
+        "job_id": job_id,
+        "email_subject": email_subject,
         "documents_extracted": final_llm_results,
         "summary": summarized_data,
-        "merged_pdf": merge_result
+        "merged_pdf": merge_result,
+        "mongo_id": mongo_id
     }
 
 
+def enqueue_new_emails() -> int:
+    """
+    Fetch new emails straight into the durable queue. Returns the count.
+    """
+    queue = get_stage_queue()
+    enqueued = []
+
+    def on_email(email_data):
+        if queue.enqueue(transaction_job_id(email_data), email_data):
+            enqueued.append(email_data)
+
+    with span("fetch") as fetch_span:
+        try:
+            fetch_unread_mbd_emirates_attachments(on_email=on_email)
+        except Exception as e:
+            # Emails enqueued before the failure still count; the span must not read ok
+            fetch_span.status = "error"
+            fetch_span.set(error=type(e).__name__)
+            print(f"📭 {e}")
+        fetch_span.set(emails=len(enqueued))
+
+    return len(enqueued)
+
+
+def _blocking_circuits() -> dict:
+    """
+    Open circuits that would fail any transaction claimed now: dependencies
+    without an alternative. A single LLM deployment or (with the outbox
+    taking the writes) Mongo being down does not stop the pipeline.
+    """
+    circuits = open_circuits()
+    gated = {"azure_di", "s3"} if MONGO_ASYNC_WRITES else {"azure_di", "s3", "mongo"}
+
+    blocked = {name: seconds for name, seconds in circuits.items() if name in gated}
+    blocked.update(open_routes(circuits))
+    return blocked
+
+
+def _run_claimed_jobs(worker_id: str) -> list:
+    """
+    Claim and process jobs until the queue has nothing available
+    """
+    queue = get_stage_queue()
+    transactions = []
+
+    while True:
+        # Leave work queued while a dependency is down; it drains once the
+        # circuit lets a probe through again
+        blocked = _blocking_circuits()
+        if blocked:
+            print(f"⏸️ Not claiming work, circuit(s) open: {blocked}")
+            return transactions
+
+        job = queue.claim(worker_id)
+        if not job:
+            return transactions
+
+        email_data = job["payload"]
+
+        with LeaseHeartbeat(queue, job["job_id"], worker_id) as heartbeat:
+            try:
+                with deadline_scope(Deadline(TRANSACTION_DEADLINE_SECONDS)):
+                    with span("transaction", job_id=job["job_id"], attempt=job["attempts"] + 1,
+                              attachments=len(email_data.get("files", []))):
+                        result = process_transaction(job["job_id"], email_data)
+                if not queue.complete(job["job_id"], worker_id):
+                    print(f"⚠️ {job['job_id']} finished after its lease was lost")
+                transactions.append(result)
+            except CircuitOpenError as e:
+                # Not the transaction's fault: back off without using an attempt.
+                # A lost lease means another worker owns the job now; leave it be
+                print(f"⏸️ {job['job_id']} deferred: {e}")
+                released = not heartbeat.lost and queue.release(
+                    job["job_id"], retry_delay=e.retry_after, worker_id=worker_id
+                )
+                transactions.append({
+                    "job_id": job["job_id"],
+                    "email_subject": email_data.get("email_subject"),
+                    "error": str(e),
+                    "status": "deferred" if released else "lease_lost"
+                })
+            except Exception as e:
+                print(f"❌ Transaction failed: {email_data.get('email_subject')}")
+                traceback.print_exc()
+                transactions.append({
+                    "job_id": job["job_id"],
+                    "email_subject": email_data.get("email_subject"),
+                    "files": email_data.get("files", []),
+                    "error": str(e),
+                    "status": "lease_lost" if heartbeat.lost else queue.fail(
+                        job["job_id"], str(e),
+                        retry_delay=RETRY_DELAY_SECONDS * (job["attempts"] + 1)
+                    )
+                })
+
+
+def process_queued_jobs(worker_id: str = None) -> dict:
+    """
+    Drain the queue with a bounded pool; each pool thread claims its own
+    leased jobs, so several processes can drain the same queue safely.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    transactions = []
+
+    with ThreadPoolExecutor(max_workers=TRANSACTION_WORKERS) as pool:
+        futures = [
+            pool.submit(_run_claimed_jobs, f"{worker_id}:{i}")
+            for i in range(TRANSACTION_WORKERS)
+        ]
+        for future in as_completed(futures):
+            transactions.extend(future.result())
+
+    return {"transactions": transactions}
+
+
+def main():
+    # --------------------------------
+    # Step 1: Fetch new emails straight into the durable queue
+    # --------------------------------
+    enqueue_new_emails()
+
+    # --------------------------------
+    # Each email is an isolated transaction, claimed from the queue
+    # (new emails plus anything left unfinished by an earlier run)
+    # --------------------------------
+    print(f"📬 Processing queued transactions with up to {TRANSACTION_WORKERS} worker(s)")
+
+    result = process_queued_jobs()
+
+    if SPECULATIVE_EXTRACTION:
+        result["speculation"] = speculative_extractor.stats()
+        print("🔮 Speculative extraction:", result["speculation"])
+
+    if TEMPLATE_EXTRACTION or TEMPLATE_SELF_TRAIN:
+        result["layout_templates"] = get_template_store().stats()
+        print("🧩 Layout templates:", result["layout_templates"])
+
+    result["s3_transfers"] = s3_transfer_stats()
+    print("☁️ S3 transfers:", result["s3_transfers"])
+
+    if MONGO_ASYNC_WRITES:
+        # Send this round's results in one batch before reporting
+        outbox = get_mongo_outbox()
+        outbox.drain(MONGO_DRAIN_SECONDS)
+        result["mongo_outbox"] = outbox.stats()
+        print("🗄️ Mongo outbox:", result["mongo_outbox"])
+
+        # Debug payload documents go through their own outbox
+        debug_outbox = get_debug_outbox()
+        debug_outbox.drain(MONGO_DRAIN_SECONDS)
+        result["mongo_debug_outbox"] = debug_outbox.stats()
+        print("🗄️ Mongo debug outbox:", result["mongo_debug_outbox"])
+
+    # CASSETTE_MODE=record: write what this round called
+    save_cassette()
+
+    return result
+
+
 def run_live():
     print("🚀 Starting LIVE email processing service (poll every 5 seconds)...")
+    start_metrics_server()
 
     try:
         while True:
@@ -239,8 +788,13 @@ def run_live():
                 result = main()
                 print('Final Results',result)
 
-                if not result or not result.get("documents_extracted"):
+                transactions = (result or {}).get("transactions", [])
+                failed = [t for t in transactions if "error" in t]
+
+                if not transactions:
                     print("📭 No new attachments found")
+                elif failed:
+                    print(f"⚠️ {len(failed)} of {len(transactions)} transaction(s) failed")
                 else:
                     print("📨 New documents processed successfully")
 
@@ -254,4 +808,93 @@ def run_live():
         print("\n🛑 Live service stopped by user (Ctrl+C)")
 
 
-run_live()
+def run_coordinator():
+    """
+    Single fetcher: polls the mailbox and enqueues transactions for workers
+    """
+    print("🚀 Starting COORDINATOR (poll every 5 seconds)...")
+    start_metrics_server()
+    queue = get_stage_queue()
+
+    try:
+        while True:
+            try:
+                enqueued = enqueue_new_emails()
+                requeued = queue.requeue_expired()
+
+                if enqueued or requeued:
+                    print(f"📥 Enqueued {enqueued} new, re-queued {requeued} expired transaction(s)")
+
+            except Exception:
+                print("❌ Error during mailbox poll")
+                traceback.print_exc()
+
+            time.sleep(5)
+
+    except KeyboardInterrupt:
+        print("\n🛑 Coordinator stopped by user (Ctrl+C)")
+
+
+def run_worker():
+    """
+    Worker: claims leased transactions from the queue. Start as many as
+    needed, on this host or (with PIPELINE_QUEUE_BACKEND=mongo) on others.
+    """
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    print(f"🚀 Starting WORKER {worker_id} with {TRANSACTION_WORKERS} thread(s)...")
+    start_metrics_server()
+
+    try:
+        while True:
+            try:
+                result = process_queued_jobs(worker_id)
+                if result["transactions"]:
+                    print(f"📨 Worker {worker_id} processed {len(result['transactions'])} transaction(s)")
+                    continue
+
+            except Exception:
+                print("❌ Error during worker run")
+                traceback.print_exc()
+
+            time.sleep(5)
+
+    except KeyboardInterrupt:
+        print(f"\n🛑 Worker {worker_id} stopped by user (Ctrl+C)")
+
+
+def run_scan_guard():
+    """
+    Compare Azure OCR of sample PDFs with and without scan preprocessing
+    """
+    if not scan_preprocessing.is_available():
+        sys.exit("❌ Scan preprocessing needs pymupdf: pip install pymupdf pillow")
+
+    report = scan_preprocessing.accuracy_guard(sys.argv[2:], run_azure_ocr_local)
+
+    for sample in report["samples"]:
+        print(sample)
+    print(f"🗜️ Bytes saved: {report['bytes_saved']}, min similarity: {report['min_similarity']}")
+
+    if not report["passed"]:
+        sys.exit(f"❌ OCR similarity below {scan_preprocessing.SCAN_MIN_SIMILARITY}, keep SCAN_PREPROCESS off")
+    print("✅ Scan preprocessing keeps OCR accuracy")
+
+
+def run_mongo_indexes():
+    """
+    Create the result lookup indexes and backfill lookupKeys on older results
+    """
+    print("🗂️ Mongo indexes:", ensure_indexes(backfill=True))
+
+
+if __name__ == "__main__":
+    # python I_trade_finance.py [live | coordinator | worker | scan-guard <pdf>... | mongo-indexes]
+    mode = sys.argv[1] if len(sys.argv) > 1 else "live"
+
+    {
+        "live": run_live,
+        "coordinator": run_coordinator,
+        "worker": run_worker,
+        "scan-guard": run_scan_guard,
+        "mongo-indexes": run_mongo_indexes
+    }[mode]()
@@ -1,7 +1,8 @@
-import os
 import json
 import re
-from openai import AzureOpenAI
+from agent_and_subagents.llm_router import get_llm_router
+from pipeline.telemetry import log_debug_payload
+from document_layout.document_model import prompt_content
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -13,12 +14,9 @@ class CertificateOfOriginLLMExtractor:
     """
 
     def __init__(self):
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        )
-        self.deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+        self.router = get_llm_router()
+        self.agent = "certificate_of_origin"
+        self.last_usage = None
 
     def _safe_json_parse(self, text: str) -> dict:
         """
@@ -76,19 +74,19 @@ class CertificateOfOriginLLMExtractor:
         }
 """
 
-        response = self.client.chat.completions.create(
-            model=self.deployment,
+        response = self.router.chat_completion(
+            self.agent,
             temperature=0,
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(normalized_doc)},
+                {"role": "user", "content": prompt_content(normalized_doc)},
             ],
         )
 
+        self.last_usage = getattr(response, "usage", None)
         raw_output = response.choices[0].message.content
 
-        # Debug (disable in production)
-        print("\n📄 RAW CERTIFICATE OF ORIGIN LLM OUTPUT:\n", raw_output)
+        log_debug_payload("RAW CERTIFICATE OF ORIGIN LLM OUTPUT", raw_output)
 
         try:
             return self._safe_json_parse(raw_output)
@@ -1,6 +1,5 @@
-import os
-import json
-from openai import AzureOpenAI
+from agent_and_subagents.llm_router import get_llm_router
+from document_layout.document_model import prompt_content
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -24,24 +23,14 @@ class DocumentTypeClassifier:
     ]
 
     def __init__(self):
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        )
-
-        self.deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-
-        if not self.deployment:
-            raise ValueError("AZURE_OPENAI_DEPLOYMENT is not set")
+        self.router = get_llm_router()
+        self.agent = "classifier"
 
     def classify(self, document):
         """
-        document format:
-        {
-            "tables": [...],
-            "lines": [...]
-        }
+        document:
+        DocumentModel, or its to_prompt() text (lines in reading order,
+        tables as pipe-separated rows, key-value pairs as "key: value")
 
         returns:
         INVOICE | AIR_WAYBILL |
@@ -87,12 +76,12 @@ class DocumentTypeClassifier:
             "- Output ONLY the document type string\n"
         )
 
-        response = self.client.chat.completions.create(
-            model=self.deployment,
+        response = self.router.chat_completion(
+            self.agent,
             temperature=0,
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(document, indent=2)},
+                {"role": "user", "content": prompt_content(document)},
             ],
         )
 
@@ -1,18 +1,16 @@
-import os
 import json
 import re
-from openai import AzureOpenAI
+from agent_and_subagents.llm_router import get_llm_router
+from pipeline.telemetry import log_debug_payload
+from document_layout.document_model import prompt_content
 
 
 class InvoiceLLMExtractor:
 
     def __init__(self):
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        )
-        self.deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+        self.router = get_llm_router()
+        self.agent = "invoice"
+        self.last_usage = None
 
     def _safe_json_parse(self, text: str) -> dict:
         """
@@ -70,19 +68,19 @@ Required JSON Schema:
   "beneficiary": null,
   "applicant_consignee": null
 }"""
-        response = self.client.chat.completions.create(
-            model=self.deployment,
+        response = self.router.chat_completion(
+            self.agent,
             temperature=0,
             messages=[
                 {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(normalized_doc)},
+                {"role": "user", "content": prompt_content(normalized_doc)},
             ],
         )
 
+        self.last_usage = getattr(response, "usage", None)
         raw_output = response.choices[0].message.content
 
-        # 🔍 OPTIONAL DEBUG (comment out in prod)
-        print("\n🔎 RAW LLM OUTPUT:\n", raw_output)
+        log_debug_payload("RAW INVOICE LLM OUTPUT", raw_output)
 
         try:
             return self._safe_json_parse(raw_output)
@@ -0,0 +1,412 @@
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import openai
+from openai import AzureOpenAI
+from dotenv import load_dotenv
+from pipeline.resilience import get_circuit_breaker, stage_timeout, CircuitOpenError
+from pipeline.cassettes import wrap_chat_client
+from pipeline.telemetry import metrics, add_to_span
+
+load_dotenv()
+
+
+# Default tier per agent: cheap one-word / short-form tasks go to the small
+# deployment, cross-document reasoning and long LC text to the large one
+AGENT_TIERS = {
+    "classifier": "SMALL",
+    "courier_dispatch_advice": "SMALL",
+    "invoice": "DEFAULT",
+    "air_waybill": "DEFAULT",
+    "certificate_of_origin": "DEFAULT",
+    "letter_of_credit": "LARGE",
+    "summary": "LARGE",
+}
+
+# Errors that move a call on to the next deployment in the route
+FALLBACK_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+LLM_CALL_SECONDS = metrics.histogram("llm_call_duration_seconds", "Chat completion latency per agent and deployment")
+LLM_CALL_ERRORS = metrics.counter("llm_call_errors_total", "Chat completions that failed over to the next deployment")
+LLM_TOKENS = metrics.counter("llm_tokens_total", "Tokens used per agent, deployment and kind (prompt / completion)")
+
+
+def _env_list(name: str) -> list:
+    return [item.strip() for item in os.getenv(name, "").split(",") if item.strip()]
+
+
+def resolve_route(agent: str) -> list:
+    """
+    Ordered deployments for an agent:
+
+    1. AZURE_OPENAI_ROUTE_<AGENT>            explicit list, e.g. "gpt-4o-mini,gpt-4o"
+    2. AZURE_OPENAI_DEPLOYMENT_<TIER>        SMALL / LARGE deployment for the agent's tier
+    3. AZURE_OPENAI_DEPLOYMENT               shared default, always last fallback
+    """
+    route = _env_list(f"AZURE_OPENAI_ROUTE_{agent.upper()}")
+
+    if not route:
+        tier = AGENT_TIERS.get(agent, "DEFAULT")
+        if tier != "DEFAULT":
+            route = _env_list(f"AZURE_OPENAI_DEPLOYMENT_{tier}")
+
+    default = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+    if default and default not in route:
+        route.append(default)
+
+    return route
+
+
+def open_routes(circuits: dict) -> dict:
+    """
+    {"azure_openai:<agent>": seconds until probe} for every agent whose
+    whole route sits behind open circuits, given open_circuits(). One open
+    deployment alone is not listed: its calls fall back to the next one.
+    """
+    blocked = {}
+    for agent in AGENT_TIERS:
+        names = [f"azure_openai:{deployment}" for deployment in resolve_route(agent)]
+        if names and all(name in circuits for name in names):
+            blocked[f"azure_openai:{agent}"] = min(circuits[name] for name in names)
+    return blocked
+
+
+class LatencyWindow:
+    """
+    Rolling window of call latencies for one deployment
+    """
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, pct: float):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class LLMRouter:
+    """
+    Shared chat-completion path for all agents. An agent keeps the router
+    from get_llm_router() and calls chat_completion with its AGENT_TIERS key.
+
+    Each agent has an ordered route of Azure OpenAI deployments. A call
+    goes to the first healthy deployment and falls back to the next one
+    on timeouts, 429s, connection and 5xx errors. A deployment whose
+    measured p95 latency exceeds LLM_P95_BUDGET_SECONDS is skipped for
+    LLM_DEMOTION_SECONDS and then gets a fresh latency window.
+
+    Hedging (LLM_HEDGE_ENABLED=1): when a call runs longer than the
+    LLM_HEDGE_PERCENTILE of the agent's recent latencies, a duplicate is
+    sent (to the next deployment in the route with LLM_HEDGE_ALTERNATE=1)
+    and the first valid response wins. Hedges are capped at
+    LLM_HEDGE_BUDGET_RATIO of all calls.
+
+    Each deployment also has a circuit breaker ("azure_openai:<deployment>");
+    while it is open the deployment is skipped like a demoted one, and if
+    every deployment is open the call raises CircuitOpenError.
+    """
+
+    def __init__(self):
+        self.client = wrap_chat_client(AzureOpenAI(
+            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+            # Fallback deployments replace SDK-level retries
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "0")),
+        ))
+        self.timeout = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+        self.p95_budget = float(os.getenv("LLM_P95_BUDGET_SECONDS", "0")) or None
+        self.min_samples = int(os.getenv("LLM_P95_MIN_SAMPLES", "20"))
+        self.demotion_seconds = float(os.getenv("LLM_DEMOTION_SECONDS", "60"))
+
+        self.hedge_enabled = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+        self.hedge_percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+        self.hedge_budget_ratio = float(os.getenv("LLM_HEDGE_BUDGET_RATIO", "0.05"))
+        self.hedge_alternate = os.getenv("LLM_HEDGE_ALTERNATE", "0") == "1"
+
+        self._lock = threading.Lock()
+        self._latency = {}
+        self._agent_latency = {}
+        self._demoted_until = {}
+        self._stats = {}
+        self._hedge_stats = {
+            "requests": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "primary_wins": 0,
+            "budget_denied": 0,
+        }
+        self._hedge_executor = None
+
+    # -------------------------------
+    # Health
+    # -------------------------------
+    def _window(self, deployment: str) -> LatencyWindow:
+        with self._lock:
+            return self._latency.setdefault(deployment, LatencyWindow())
+
+    def _count(self, agent: str, deployment: str, key: str):
+        with self._lock:
+            stats = self._stats.setdefault((agent, deployment), {
+                "calls": 0, "fallbacks": 0, "skipped_slow": 0, "skipped_open": 0, "errors": 0
+            })
+            stats[key] += 1
+
+    def _is_demoted(self, deployment: str) -> bool:
+        now = time.monotonic()
+
+        with self._lock:
+            until = self._demoted_until.get(deployment)
+            if until and now >= until:
+                # Demotion over: start measuring again from scratch
+                del self._demoted_until[deployment]
+                self._latency[deployment] = LatencyWindow()
+                return False
+            if until:
+                return True
+
+        if not self.p95_budget:
+            return False
+
+        window = self._window(deployment)
+        if len(window.samples) < self.min_samples:
+            return False
+
+        if window.percentile(95) > self.p95_budget:
+            with self._lock:
+                self._demoted_until[deployment] = now + self.demotion_seconds
+            print(f"🐢 Deployment '{deployment}' p95 above {self.p95_budget}s, demoted")
+            return True
+
+        return False
+
+    @staticmethod
+    def _breaker(deployment: str):
+        return get_circuit_breaker(f"azure_openai:{deployment}")
+
+    def p95(self, deployment: str):
+        return self._window(deployment).percentile(95)
+
+    # -------------------------------
+    # Hedging
+    # -------------------------------
+    def _agent_window(self, agent: str) -> LatencyWindow:
+        with self._lock:
+            return self._agent_latency.setdefault(agent, LatencyWindow())
+
+    def _hedge_count(self, key: str):
+        with self._lock:
+            self._hedge_stats[key] += 1
+
+    def _hedge_delay(self, agent: str):
+        """
+        Seconds to wait before hedging, or None if hedging does not apply
+        """
+        if not self.hedge_enabled:
+            return None
+
+        window = self._agent_window(agent)
+        if len(window.samples) < self.min_samples:
+            return None
+
+        return window.percentile(self.hedge_percentile)
+
+    def _take_hedge_budget(self) -> bool:
+        with self._lock:
+            stats = self._hedge_stats
+            if stats["hedges"] + 1 > stats["requests"] * self.hedge_budget_ratio:
+                stats["budget_denied"] += 1
+                return False
+            stats["hedges"] += 1
+            return True
+
+    @staticmethod
+    def _is_valid(response) -> bool:
+        try:
+            return bool(response.choices[0].message.content)
+        except (AttributeError, IndexError, TypeError):
+            return False
+
+    def _create(self, agent: str, deployment: str, alternate: str, messages: list, timeout: float, kwargs: dict):
+        """
+        One chat completion on `deployment`, hedged when it runs long.
+        Returns (response, deployment that answered, its call seconds);
+        each call reports to its own deployment's breaker.
+        """
+        def call(target):
+            started = time.monotonic()
+            with self._breaker(target).guard(is_failure=lambda e: isinstance(e, FALLBACK_ERRORS)):
+                response = self.client.chat.completions.create(
+                    model=target,
+                    messages=messages,
+                    timeout=timeout,
+                    **kwargs
+                )
+            return response, target, time.monotonic() - started
+
+        with self._lock:
+            self._hedge_stats["requests"] += 1
+
+        delay = self._hedge_delay(agent)
+        if delay is None:
+            return call(deployment)
+
+        with self._lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(
+                    max_workers=int(os.getenv("LLM_HEDGE_WORKERS", "16")),
+                    thread_name_prefix="llm-hedge"
+                )
+            executor = self._hedge_executor
+
+        primary = executor.submit(call, deployment)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._take_hedge_budget():
+            return primary.result()
+
+        hedge_target = alternate if self.hedge_alternate and alternate else deployment
+        print(f"🪁 {agent}: no answer after {delay:.2f}s, hedging on '{hedge_target}'")
+        hedge = executor.submit(call, hedge_target)
+
+        pending = {primary, hedge}
+        last_error = None
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    answer = future.result()
+                except Exception as e:
+                    last_error = e
+                    continue
+
+                if not self._is_valid(answer[0]):
+                    continue
+
+                self._hedge_count("hedge_wins" if future is hedge else "primary_wins")
+
+                # The sync SDK call cannot be interrupted once in flight;
+                # cancel it if still queued, otherwise its result is dropped
+                for loser in pending:
+                    loser.cancel()
+                return answer
+
+        if last_error:
+            raise last_error
+        return primary.result()
+
+    def hedge_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._hedge_stats)
+
+        stats["hedge_rate"] = round(stats["hedges"] / stats["requests"], 4) if stats["requests"] else 0.0
+        stats["hedge_win_rate"] = round(stats["hedge_wins"] / stats["hedges"], 4) if stats["hedges"] else None
+        return stats
+
+    # -------------------------------
+    # Calls
+    # -------------------------------
+    @staticmethod
+    def _record_usage(agent: str, deployment: str, elapsed: float, response):
+        LLM_CALL_SECONDS.observe(elapsed, agent=agent, deployment=deployment)
+
+        usage = getattr(response, "usage", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None) or 0
+        completion_tokens = getattr(usage, "completion_tokens", None) or 0
+        LLM_TOKENS.inc(prompt_tokens, agent=agent, deployment=deployment, kind="prompt")
+        LLM_TOKENS.inc(completion_tokens, agent=agent, deployment=deployment, kind="completion")
+
+        # Summed into the calling stage's span (classify, extract, ...)
+        add_to_span(llm_calls=1, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+    def chat_completion(self, agent: str, messages: list, timeout: float = None, **kwargs):
+        """
+        Route a chat completion for `agent`. Returns the SDK response of the
+        first deployment that answers.
+        """
+        route = resolve_route(agent)
+        if not route:
+            raise ValueError(f"No Azure OpenAI deployment configured for agent '{agent}'")
+
+        # Deployments behind an open circuit are skipped outright
+        available = [d for d in route if self._breaker(d).state != "open"]
+        for deployment in route:
+            if deployment not in available:
+                self._count(agent, deployment, "skipped_open")
+        if not available:
+            breakers = [self._breaker(d) for d in route]
+            raise CircuitOpenError(f"azure_openai:{agent}", min(b.retry_after() for b in breakers))
+
+        # Slow deployments are skipped unless nothing else is left
+        healthy = [d for d in available if not self._is_demoted(d)]
+        for deployment in available:
+            if deployment not in healthy:
+                self._count(agent, deployment, "skipped_slow")
+        candidates = healthy or available[-1:]
+
+        last_error = None
+
+        for position, deployment in enumerate(candidates):
+            self._count(agent, deployment, "calls" if position == 0 else "fallbacks")
+            started = time.monotonic()
+
+            alternate = candidates[position + 1] if position + 1 < len(candidates) else None
+            call_timeout = stage_timeout(timeout or self.timeout, f"{agent} LLM call")
+
+            try:
+                response, answered_by, seconds = self._create(
+                    agent, deployment, alternate, messages, call_timeout, kwargs
+                )
+            except CircuitOpenError as e:
+                # Another call is probing this deployment right now
+                last_error = e
+                continue
+            except FALLBACK_ERRORS as e:
+                last_error = e
+                self._count(agent, deployment, "errors")
+                self._window(deployment).add(time.monotonic() - started)
+                LLM_CALL_ERRORS.inc(agent=agent, deployment=deployment, error=type(e).__name__)
+                print(f"↪️ {agent}: deployment '{deployment}' failed ({type(e).__name__}), trying next")
+                continue
+
+            # A winning hedge on `alternate` is that deployment's call, not
+            # this one's; the agent window keeps the latency the caller saw
+            self._window(answered_by).add(seconds)
+            self._agent_window(agent).add(time.monotonic() - started)
+            self._record_usage(agent, answered_by, seconds, response)
+            return response
+
+        raise last_error
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {f"{agent}/{deployment}": dict(values) for (agent, deployment), values in self._stats.items()}
+
+        for key, values in stats.items():
+            values["p95_seconds"] = self.p95(key.split("/", 1)[1])
+        return stats
+
+
+_llm_router = None
+_llm_router_lock = threading.Lock()
+
+
+def get_llm_router() -> LLMRouter:
+    global _llm_router
+    with _llm_router_lock:
+        if _llm_router is None:
+            _llm_router = LLMRouter()
+    return _llm_router
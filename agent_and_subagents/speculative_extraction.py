@@ -0,0 +1,139 @@
+import os
+import re
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Checked in this order, mirroring the classifier's priority rules
+# (a Certificate of Origin often mentions the AWB and the invoice)
+TITLE_PATTERNS = [
+    ("CERTIFICATE_OF_ORIGIN", re.compile(r"certificate\s+of\s+origin", re.IGNORECASE)),
+    ("COURIER_DISPATCH_ADVICE", re.compile(r"courier|dispatch\s+advice", re.IGNORECASE)),
+    ("LETTER_OF_CREDIT", re.compile(r"letter\s+of\s+credit|documentary\s+credit|\bMT\s*700\b", re.IGNORECASE)),
+    ("AIR_WAYBILL", re.compile(r"air\s*way\s*bill|\bAWB\b", re.IGNORECASE)),
+    # Packing lists quote the invoice number; match them before INVOICE
+    ("PACKING_LIST", re.compile(r"packing\s+list", re.IGNORECASE)),
+    ("INVOICE", re.compile(r"\binvoice\b", re.IGNORECASE)),
+]
+
+# Only the title area is looked at; deeper lines reference other documents
+TITLE_LINES = int(os.getenv("SPECULATIVE_TITLE_LINES", "12"))
+
+
+def title_document_types(normalized_doc: str) -> list:
+    """
+    Every document type whose title pattern matches the title area, in
+    TITLE_PATTERNS order (e.g. "Commercial Invoice cum Packing List" →
+    PACKING_LIST, INVOICE)
+    """
+    if not isinstance(normalized_doc, str):
+        return []
+
+    title_area = "\n".join(normalized_doc.splitlines()[:TITLE_LINES])
+    return [doc_type for doc_type, pattern in TITLE_PATTERNS if pattern.search(title_area)]
+
+
+def predict_document_type(normalized_doc: str):
+    """
+    Cheap title-based guess of the document type, or None if no title
+    pattern matches. Used only to start the extractor early; the LLM
+    classifier remains the source of truth.
+    """
+    matches = title_document_types(normalized_doc)
+    return matches[0] if matches else None
+
+
+class Speculation:
+    __slots__ = ("predicted_type", "extractor", "future")
+
+    def __init__(self, predicted_type, extractor, future):
+        self.predicted_type = predicted_type
+        self.extractor = extractor
+        self.future = future
+
+
+class SpeculativeExtractor:
+    """
+    Starts the extractor for the predicted document type in parallel with
+    DocumentTypeClassifier.classify.
+
+    - speculate(doc)            → launches the predicted extractor
+    - resolve(spec, doc_type)   → the extraction future if the classifier
+                                  agreed, otherwise cancels / discards it
+
+    Hit rate and tokens spent on discarded extractions are kept in stats().
+    """
+
+    def __init__(self, extractors: dict, max_workers: int = None):
+        self.extractors = extractors
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers or int(os.getenv("SPECULATIVE_WORKERS", "4")),
+            thread_name_prefix="speculative-extract"
+        )
+        self._lock = threading.Lock()
+        self._stats = {
+            "speculations": 0,
+            "hits": 0,
+            "misses": 0,
+            "no_prediction": 0,
+            "cancelled_before_start": 0,
+            "wasted_tokens": 0,
+        }
+
+    def _count(self, key: str, amount: int = 1):
+        with self._lock:
+            self._stats[key] += amount
+
+    def speculate(self, normalized_doc):
+        predicted_type = predict_document_type(normalized_doc)
+        extractor_class = self.extractors.get(predicted_type)
+
+        if not extractor_class:
+            self._count("no_prediction")
+            return None
+
+        extractor = extractor_class()
+        future = self._executor.submit(
+            contextvars.copy_context().run, extractor.extract, normalized_doc
+        )
+        self._count("speculations")
+
+        print(f"🔮 Speculatively extracting as {predicted_type}")
+        return Speculation(predicted_type, extractor, future)
+
+    def resolve(self, speculation: Speculation, doc_type):
+        """
+        Returns the speculative extraction future when the prediction matches
+        the classifier's doc_type, otherwise None
+        """
+        if speculation is None:
+            return None
+
+        if speculation.predicted_type == doc_type:
+            self._count("hits")
+            return speculation.future
+
+        self._count("misses")
+        print(f"🔮 Speculation discarded: predicted {speculation.predicted_type}, classified {doc_type}")
+
+        if speculation.future.cancel():
+            self._count("cancelled_before_start")
+            return None
+
+        # Already running: the HTTP call cannot be aborted, account its tokens.
+        # Every extractor keeps the SDK usage of its latest call in last_usage
+        def record_waste(future):
+            usage = getattr(speculation.extractor, "last_usage", None)
+            self._count("wasted_tokens", getattr(usage, "total_tokens", 0) or 0)
+
+        speculation.future.add_done_callback(record_waste)
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+
+        resolved = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / resolved, 3) if resolved else None
+        return stats
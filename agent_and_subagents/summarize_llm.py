@@ -1,7 +1,7 @@
-import os
 import json
 import re
-from openai import AzureOpenAI
+from agent_and_subagents.llm_router import get_llm_router
+from pipeline.telemetry import log_debug_payload
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -179,12 +179,8 @@ Return ONLY this JSON structure. No additional text.
 class SummarizeLLM:
 
     def __init__(self):
-        self.client = AzureOpenAI(
-            api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-            api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-            azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        )
-        self.deployment = os.getenv("AZURE_OPENAI_DEPLOYMENT")
+        self.router = get_llm_router()
+        self.agent = "summary"
 
     def _safe_json_parse(self, text: str) -> dict:
         """
@@ -212,8 +208,8 @@ class SummarizeLLM:
         ready for MongoDB storage.
         """
 
-        response = self.client.chat.completions.create(
-        model=self.deployment,
+        response = self.router.chat_completion(
+        self.agent,
         temperature=0,
         messages=[
             {"role": "system", "content": system_prompt},
@@ -230,9 +226,8 @@ class SummarizeLLM:
 
         raw_output = response.choices[0].message.content.strip()
 
-        # Debug / audit log
-        print("\n🏦 TRADE FINANCE COMPLIANCE SUMMARY:\n")
-        print(raw_output)
+        # Debug / audit log (sampled)
+        log_debug_payload("TRADE FINANCE COMPLIANCE SUMMARY", raw_output)
 
         # Parse into dict (safe)
         parsed_output = self._safe_json_parse(raw_output)
@@ -0,0 +1,209 @@
+import io
+import os
+import re
+import glob
+import json
+import time
+import random
+import hashlib
+import threading
+import types
+from email.message import EmailMessage
+import openai
+from PyPDF2 import PdfReader
+from azure.core.exceptions import ServiceResponseError
+from agent_and_subagents.speculative_extraction import predict_document_type
+from agent_and_subagents.document_type_classifier import DocumentTypeClassifier
+
+
+SEED_DOCUMENTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "required_documents")
+
+# Appended after %%EOF so every email carries distinct attachment bytes
+# (no OCR cache / merge reuse across emails); PDF readers ignore it
+_UNIQUE_MARKER = b"\n%bench-"
+
+
+def seed_documents(directory: str = None) -> list:
+    return sorted(glob.glob(os.path.join(directory or SEED_DOCUMENTS_DIR, "*.pdf")))
+
+
+def _strip_marker(payload: bytes) -> bytes:
+    index = payload.rfind(_UNIQUE_MARKER)
+    return payload[:index] if index != -1 else payload
+
+
+def build_email(subject: str, paths: list, unique_token: str = None) -> bytes:
+    message = EmailMessage()
+    message["Subject"] = subject
+    message.set_content("Trade finance documents attached.")
+
+    for path in paths:
+        with open(path, "rb") as f:
+            payload = f.read()
+        if unique_token:
+            payload += _UNIQUE_MARKER + unique_token.encode() + b"\n"
+        message.add_attachment(payload, maintype="application", subtype="pdf", filename=os.path.basename(path))
+
+    return message.as_bytes()
+
+
+class LatencyModel:
+    """
+    Normally distributed latency (seconds) and an error rate
+    """
+
+    def __init__(self, mean: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int = None):
+        self.mean = mean
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        with self._lock:
+            delay = max(0.0, self._random.gauss(self.mean, self.jitter)) if self.jitter else self.mean
+            failed = self._random.random() < self.error_rate
+        return delay, failed
+
+
+# -------------------------------
+# Document Intelligence
+# -------------------------------
+def synthesize_layout(payload: bytes):
+    """
+    prebuilt-layout shaped result from the PDF text layer: one line per
+    text line, stacked top to bottom on a letter page
+    """
+    pages = []
+    for reader_page in PdfReader(io.BytesIO(payload)).pages:
+        lines = [line for line in (reader_page.extract_text() or "").splitlines() if line.strip()]
+        step = 10.0 / max(len(lines), 1)
+        pages.append(types.SimpleNamespace(
+            page_number=len(pages) + 1, width=8.5, height=11.0, unit="inch",
+            lines=[
+                types.SimpleNamespace(
+                    content=line,
+                    polygon=[0.5, 0.5 + i * step, 8.0, 0.5 + i * step, 8.0, 0.5 + (i + 0.8) * step, 0.5, 0.5 + (i + 0.8) * step]
+                )
+                for i, line in enumerate(lines)
+            ],
+        ))
+
+    return types.SimpleNamespace(
+        content="\n".join(line.content for page in pages for line in page.lines),
+        pages=pages, tables=[], paragraphs=[], key_value_pairs=[],
+    )
+
+
+class _Poller:
+    def __init__(self, result, delay: float, failed: bool):
+        self._result = result
+        self._ready_at = time.monotonic() + delay
+        self._failed = failed
+
+    def done(self) -> bool:
+        return time.monotonic() >= self._ready_at
+
+    def result(self, timeout: float = None):
+        wait = self._ready_at - time.monotonic()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+        if self._failed:
+            raise ServiceResponseError("benchmark: injected Document Intelligence failure")
+        return self._result
+
+
+class FakeDocumentIntelligenceClient:
+    """
+    begin_analyze_document() answering with the layout recorded for the
+    same PDF (synthesized from its text layer on first sight)
+    """
+
+    def __init__(self, latency: LatencyModel = None):
+        self.latency = latency or LatencyModel()
+        self._recorded = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def begin_analyze_document(self, model_id: str = None, body=None, **kwargs):
+        payload = _strip_marker(body.read() if hasattr(body, "read") else body)
+        key = hashlib.sha256(payload).hexdigest()
+
+        with self._lock:
+            self.calls += 1
+            result = self._recorded.get(key)
+        if result is None:
+            result = synthesize_layout(payload)
+            with self._lock:
+                self._recorded[key] = result
+
+        return _Poller(result, *self.latency.sample())
+
+
+# -------------------------------
+# Azure OpenAI chat
+# -------------------------------
+_JSON_KEY = re.compile(r'"(\w+)"\s*:')
+
+
+def _fake_answer(system_prompt: str, user_content: str) -> str:
+    if "document classifier" in system_prompt:
+        predicted = predict_document_type(user_content)
+        return predicted if predicted in DocumentTypeClassifier.ALLOWED_TYPES else "INVOICE"
+
+    # Fill the JSON skeleton the prompt asks for
+    keys = list(dict.fromkeys(_JSON_KEY.findall(system_prompt)))
+    return json.dumps({key: f"BENCH-{key}" for key in keys} or {"result": "BENCH"})
+
+
+def _injected_error(model: str) -> Exception:
+    # Built without an HTTP request: the router only looks at the type
+    error = openai.APITimeoutError.__new__(openai.APITimeoutError)
+    Exception.__init__(error, f"benchmark: injected timeout on {model}")
+    return error
+
+
+class _Completions:
+    def __init__(self, owner):
+        self._owner = owner
+
+    def create(self, model: str = None, messages: list = None, **kwargs):
+        delay, failed = self._owner.latency.sample()
+        time.sleep(delay)
+
+        with self._owner._lock:
+            self._owner.calls += 1
+            self._owner.errors += int(failed)
+        if failed:
+            raise _injected_error(model)
+
+        content = _fake_answer(messages[0]["content"], messages[-1]["content"])
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages) // 4
+        completion_tokens = len(content) // 4
+
+        return types.SimpleNamespace(
+            model=model,
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content))],
+            usage=types.SimpleNamespace(
+                prompt_tokens=prompt_tokens,
+                completion_tokens=completion_tokens,
+                total_tokens=prompt_tokens + completion_tokens,
+            ),
+        )
+
+
+class FakeAzureOpenAI:
+    """
+    chat.completions.create() with configurable latency and error rate;
+    answers are shaped by the system prompt (classifier label or the JSON
+    keys the extractor prompt lists)
+    """
+
+    def __init__(self, latency: LatencyModel = None):
+        self.latency = latency or LatencyModel()
+        self.chat = types.SimpleNamespace(completions=_Completions(self))
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
@@ -0,0 +1,153 @@
+import re
+import threading
+import socketserver
+
+
+_ATOM = re.compile(rb'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+
+def _uid_ranges(uid_set: str, uids: list) -> list:
+    """
+    Messages of an IMAP sequence set such as "3:5,9" or "7:*"
+    """
+    selected = set()
+    highest = max(uids) if uids else 0
+
+    for part in uid_set.split(","):
+        low, _, high = part.partition(":")
+        low = highest if low == "*" else int(low)
+        high = low if not high else (highest if high == "*" else int(high))
+        low, high = min(low, high), max(low, high)
+        selected.update(uid for uid in uids if low <= uid <= high)
+
+    return sorted(selected)
+
+
+def _subject_header(message: bytes) -> bytes:
+    header = message.split(b"\r\n\r\n", 1)[0].split(b"\n\n", 1)[0]
+    match = re.search(rb"^Subject:.*?(?=\r?\n(?![ \t]))", header, re.IGNORECASE | re.MULTILINE | re.DOTALL)
+    return (match.group(0) if match else b"") + b"\r\n\r\n"
+
+
+class Mailbox:
+    """
+    One IMAP folder: UID → raw RFC 822 message, plus \\Seen flags
+    """
+
+    def __init__(self, messages: dict = None, uidvalidity: int = 1):
+        self.messages = dict(messages or {})
+        self.uidvalidity = uidvalidity
+        self.seen = set()
+        self.lock = threading.Lock()
+
+    def append(self, message: bytes) -> int:
+        with self.lock:
+            uid = max(self.messages, default=0) + 1
+            self.messages[uid] = message
+            return uid
+
+    @property
+    def uidnext(self) -> int:
+        return max(self.messages, default=0) + 1
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    """
+    The IMAP4rev1 subset the attachment fetcher speaks: LOGIN, SELECT,
+    UID SEARCH / FETCH / STORE, LOGOUT
+    """
+
+    def send(self, line: bytes):
+        self.wfile.write(line + b"\r\n")
+
+    def handle(self):
+        mailbox = self.server.mailbox
+        self.send(b"* OK [CAPABILITY IMAP4rev1] benchmark IMAP ready")
+
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+
+            parts = [m.group(1) if m.group(1) is not None else m.group(2) for m in _ATOM.finditer(line.strip())]
+            if len(parts) < 2:
+                continue
+
+            tag, command, args = parts[0], parts[1].upper(), parts[2:]
+
+            if command == b"CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1")
+            elif command == b"LOGOUT":
+                self.send(b"* BYE logging out")
+                self.send(tag + b" OK LOGOUT completed")
+                return
+            elif command in (b"SELECT", b"EXAMINE"):
+                self.send(b"* %d EXISTS" % len(mailbox.messages))
+                self.send(b"* 0 RECENT")
+                self.send(b"* OK [UIDVALIDITY %d] UIDs valid" % mailbox.uidvalidity)
+                self.send(b"* OK [UIDNEXT %d] predicted next UID" % mailbox.uidnext)
+            elif command == b"UID" and args:
+                self.uid_command(mailbox, args[0].upper(), args[1:])
+            # LOGIN, NOOP, CHECK, CLOSE: nothing to do
+
+            self.send(tag + b" OK " + command + b" completed")
+
+    def uid_command(self, mailbox: Mailbox, command: bytes, args: list):
+        with mailbox.lock:
+            uids = sorted(mailbox.messages)
+
+            if command == b"SEARCH":
+                criteria = b" ".join(args).upper()
+                if criteria.startswith(b"UID "):
+                    found = _uid_ranges(criteria[4:].decode(), uids)
+                elif criteria == b"UNSEEN":
+                    found = [uid for uid in uids if uid not in mailbox.seen]
+                else:
+                    found = uids
+                self.send(b"* SEARCH" + b"".join(b" %d" % uid for uid in found))
+
+            elif command == b"FETCH":
+                headers_only = b"HEADER.FIELDS" in b" ".join(args[1:]).upper()
+                for sequence, uid in enumerate(_uid_ranges(args[0].decode(), uids), start=1):
+                    message = mailbox.messages[uid]
+                    if headers_only:
+                        section, payload = b"BODY[HEADER.FIELDS (SUBJECT)]", _subject_header(message)
+                    else:
+                        section, payload = b"BODY[]", message
+                    self.wfile.write(b"* %d FETCH (UID %d %s {%d}\r\n" % (sequence, uid, section, len(payload)))
+                    self.wfile.write(payload)
+                    self.send(b")")
+
+            elif command == b"STORE":
+                if b"\\SEEN" in b" ".join(args[1:]).upper():
+                    mailbox.seen.update(_uid_ranges(args[0].decode(), uids))
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class IMAPServer:
+    """
+    In-process plain-text IMAP server on 127.0.0.1. Point the fetcher at
+    it with IMAP_SERVER=127.0.0.1 IMAP_PORT=<port> IMAP_USE_SSL=0.
+    """
+
+    def __init__(self, mailbox: Mailbox, port: int = 0):
+        self.mailbox = mailbox
+        self._server = _Server(("127.0.0.1", port), _IMAPHandler)
+        self._server.mailbox = mailbox
+        self._thread = threading.Thread(target=self._server.serve_forever, name="bench-imap", daemon=True)
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def start(self) -> "IMAPServer":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
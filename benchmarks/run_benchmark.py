@@ -0,0 +1,306 @@
+"""
+Offline end-to-end benchmark of the trade finance pipeline.
+
+Every scenario runs main() (fetch → OCR → classify → extract → summarize →
+merge/upload → Mongo) in a fresh subprocess and working directory against
+local stand-ins:
+
+- IMAP            in-process server (benchmarks/imap_server.py) seeded with
+                  emails carrying the required_documents/ PDFs
+- Azure DI        FakeDocumentIntelligenceClient, recorded layouts
+- Azure OpenAI    FakeAzureOpenAI, configurable latency / error rate
+- S3              moto (or S3_ENDPOINT_URL, e.g. a local MinIO)
+- Mongo           mongomock
+
+and reports per-stage latency percentiles, throughput (emails / minute)
+and peak memory (RSS; --tracemalloc adds traced Python allocations) per
+scenario.
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.run_benchmark --emails 10 40 --workers 1 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+import itertools
+import subprocess
+import tracemalloc
+import resource
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_BUCKET = "yc-retails-invoice"
+
+
+# -------------------------------
+# Stage timings
+# -------------------------------
+class StageRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._errors = {}
+
+    def record(self, stage: str, seconds: float, failed: bool):
+        with self._lock:
+            self._samples.setdefault(stage, []).append(seconds)
+            self._errors[stage] = self._errors.get(stage, 0) + int(failed)
+
+    def wrap(self, stage: str, fn):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            failed = True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                self.record(stage, time.perf_counter() - started, failed)
+        return timed
+
+    def instrument(self, owner, attribute: str, stage: str):
+        setattr(owner, attribute, self.wrap(stage, getattr(owner, attribute)))
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                stage: {**percentiles(samples), "errors": self._errors.get(stage, 0)}
+                for stage, samples in self._samples.items()
+            }
+
+
+def percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+
+    def rank(p):
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+    return {
+        "count": len(ordered),
+        "p50": round(rank(50), 4),
+        "p95": round(rank(95), 4),
+        "p99": round(rank(99), 4),
+        "max": round(ordered[-1], 4),
+    }
+
+
+# -------------------------------
+# One scenario (runs in its own process)
+# -------------------------------
+def _configure_environment(config: dict, imap_port: int):
+    os.environ.update({
+        "IMAP_SERVER": "127.0.0.1",
+        "IMAP_PORT": str(imap_port),
+        "IMAP_USE_SSL": "0",
+        "EMAIL_USER": "benchmark@example.com",
+        "EMAIL_PASS": "benchmark",
+        "MONGO_URI": os.getenv("MONGO_URI", "mongodb://127.0.0.1:27017"),
+        "DB_NAME": "benchmark",
+        "FILE_DETAILS": "trade_finance_results",
+        "AZURE_AI_SERVICES_ENDPOINT": "https://benchmark.invalid/",
+        "AZURE_AI_SERVICES_API_KEY": "benchmark",
+        "AZURE_OPENAI_API_KEY": "benchmark",
+        "AZURE_OPENAI_API_VERSION": "2024-06-01",
+        "AZURE_OPENAI_ENDPOINT": "https://benchmark.invalid/",
+        "AZURE_OPENAI_DEPLOYMENT": os.getenv("AZURE_OPENAI_DEPLOYMENT", "benchmark"),
+        "AWS_ACCESS_KEY": "benchmark",
+        "AWS_SECRET_KEY": "benchmark",
+        "AWS_ACCESS_KEY_ID": "benchmark",
+        "AWS_SECRET_ACCESS_KEY": "benchmark",
+        "TRANSACTION_WORKERS": str(config["workers"]),
+        "PIPELINE_RETRY_DELAY_SECONDS": "3600",
+    })
+
+
+def run_scenario(config: dict) -> dict:
+    from benchmarks.imap_server import IMAPServer, Mailbox
+    from benchmarks.fakes import (
+        LatencyModel, FakeDocumentIntelligenceClient, FakeAzureOpenAI,
+        build_email, seed_documents
+    )
+
+    documents = seed_documents(config.get("documents_dir"))
+    mailbox = Mailbox({
+        uid: build_email(
+            f"NMD Emirates benchmark {uid}", documents,
+            unique_token=f"{uid}" if config["unique_attachments"] else None
+        )
+        for uid in range(1, config["emails"] + 1)
+    })
+    imap = IMAPServer(mailbox).start()
+    _configure_environment(config, imap.port)
+
+    # Local S3 and in-memory Mongo must be in place before the pipeline
+    # modules create their clients
+    import boto3
+    import pymongo
+    import mongomock
+
+    aws = None
+    if not os.getenv("S3_ENDPOINT_URL"):
+        from moto import mock_aws
+        aws = mock_aws()
+        aws.start()
+    boto3.client("s3", region_name="us-east-1", endpoint_url=os.getenv("S3_ENDPOINT_URL") or None).create_bucket(Bucket=BENCH_BUCKET)
+    pymongo.MongoClient = mongomock.MongoClient
+
+    import I_trade_finance as pipeline
+    from agent_and_subagents.llm_router import get_llm_router
+    from agent_and_subagents.summarize_llm import SummarizeLLM
+    from agent_and_subagents.document_type_classifier import DocumentTypeClassifier
+
+    di = FakeDocumentIntelligenceClient(LatencyModel(config["di_latency"], config["di_jitter"], config["di_error_rate"], seed=1))
+    chat = FakeAzureOpenAI(LatencyModel(config["chat_latency"], config["chat_jitter"], config["chat_error_rate"], seed=2))
+    pipeline.client = di
+    get_llm_router().client = chat
+
+    recorder = StageRecorder()
+    recorder.instrument(pipeline, "enqueue_new_emails", "fetch")
+    recorder.instrument(pipeline, "process_transaction", "transaction")
+    recorder.instrument(pipeline, "load_document_model", "ocr")
+    recorder.instrument(DocumentTypeClassifier, "classify", "classify")
+    for extractor_class in set(pipeline.DOCUMENT_EXTRACTORS.values()):
+        recorder.instrument(extractor_class, "extract", "extract")
+    recorder.instrument(SummarizeLLM, "extract", "summarize")
+    recorder.instrument(pipeline, "merge_and_stream_to_s3", "merge_upload")
+    recorder.instrument(pipeline, "upload_merged_pdf", "merge_upload")
+    recorder.instrument(pipeline, "store_trade_finance_result", "store")
+
+    # tracemalloc attributes Python allocations but slows the pipeline
+    # several times over; peak RSS is always reported
+    if config["tracemalloc"]:
+        tracemalloc.start()
+    started = time.perf_counter()
+    result = pipeline.main()
+    elapsed = time.perf_counter() - started
+    peak_traced = tracemalloc.get_traced_memory()[1] if config["tracemalloc"] else None
+    tracemalloc.stop()
+
+    imap.stop()
+    if aws:
+        aws.stop()
+
+    transactions = result.get("transactions", [])
+    completed = [t for t in transactions if "error" not in t]
+
+    return {
+        "scenario": config,
+        "wall_seconds": round(elapsed, 3),
+        "emails": len(transactions),
+        "completed": len(completed),
+        "failed": len(transactions) - len(completed),
+        "emails_per_minute": round(len(completed) / elapsed * 60, 2) if elapsed else None,
+        "peak_traced_mb": round(peak_traced / 1024 / 1024, 2) if peak_traced is not None else None,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        "stages": recorder.report(),
+        "dependency_calls": {
+            "document_intelligence": di.calls,
+            "chat": chat.calls,
+            "chat_injected_errors": chat.errors,
+        },
+        "mongo_outbox": result.get("mongo_outbox"),
+        "mongo_debug_outbox": result.get("mongo_debug_outbox"),
+        "s3_transfers": result.get("s3_transfers"),
+    }
+
+
+# -------------------------------
+# Driver
+# -------------------------------
+def _run_in_subprocess(config: dict, verbose: bool) -> dict:
+    with tempfile.TemporaryDirectory(prefix="tf_bench_") as workdir:
+        result_path = os.path.join(workdir, "result.json")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.getenv("PYTHONPATH")])))
+
+        with open(os.path.join(workdir, "pipeline.log"), "w") as log:
+            process = subprocess.run(
+                [sys.executable, "-m", "benchmarks.run_benchmark", "--scenario", json.dumps(config), "--result", result_path],
+                cwd=workdir, env=env,
+                stdout=None if verbose else log, stderr=subprocess.STDOUT if not verbose else None,
+            )
+
+        if process.returncode != 0 or not os.path.exists(result_path):
+            with open(os.path.join(workdir, "pipeline.log")) as log:
+                tail = log.read()[-3000:]
+            raise RuntimeError(f"Scenario {config} failed (exit {process.returncode}):\n{tail}")
+
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def _print_report(report: dict):
+    scenario = report["scenario"]
+    print(
+        f"\n📊 {scenario['emails']} email(s), {scenario['workers']} worker(s): "
+        f"{report['completed']}/{report['emails']} completed in {report['wall_seconds']}s, "
+        f"{report['emails_per_minute']} emails/min, peak RSS {report['max_rss_mb']} MB"
+        + (f", peak traced {report['peak_traced_mb']} MB" if report["peak_traced_mb"] is not None else "")
+    )
+    print(f"   {'stage':<14}{'count':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}{'errors':>8}")
+    for stage, values in report["stages"].items():
+        print(
+            f"   {stage:<14}{values['count']:>7}{values['p50']:>9.3f}{values['p95']:>9.3f}"
+            f"{values['p99']:>9.3f}{values['max']:>9.3f}{values['errors']:>8}"
+        )
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--emails", type=int, nargs="+", default=[5, 20], help="emails per scenario")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4], help="TRANSACTION_WORKERS per scenario")
+    parser.add_argument("--di-latency", type=float, default=0.5)
+    parser.add_argument("--di-jitter", type=float, default=0.1)
+    parser.add_argument("--di-error-rate", type=float, default=0.0)
+    parser.add_argument("--chat-latency", type=float, default=0.3)
+    parser.add_argument("--chat-jitter", type=float, default=0.1)
+    parser.add_argument("--chat-error-rate", type=float, default=0.0)
+    parser.add_argument("--documents-dir", default=None, help="seed PDFs (default: required_documents/)")
+    parser.add_argument("--reuse-attachments", action="store_true", help="identical attachment bytes in every email (exercises caches)")
+    parser.add_argument("--tracemalloc", action="store_true", help="also trace peak Python allocations (slow)")
+    parser.add_argument("--output", help="write all scenario reports to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show pipeline output")
+    parser.add_argument("--scenario", help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.scenario:
+        report = run_scenario(json.loads(args.scenario))
+        with open(args.result, "w") as f:
+            json.dump(report, f)
+        # Pipeline threads (outbox, circuit probes) are daemons
+        os._exit(0)
+
+    reports = []
+    for emails, workers in itertools.product(args.emails, args.workers):
+        config = {
+            "emails": emails,
+            "workers": workers,
+            "di_latency": args.di_latency,
+            "di_jitter": args.di_jitter,
+            "di_error_rate": args.di_error_rate,
+            "chat_latency": args.chat_latency,
+            "chat_jitter": args.chat_jitter,
+            "chat_error_rate": args.chat_error_rate,
+            "documents_dir": args.documents_dir,
+            "unique_attachments": not args.reuse_attachments,
+            "tracemalloc": args.tracemalloc,
+        }
+        print(f"⏱️ Running scenario: {emails} email(s), {workers} worker(s)...")
+        report = _run_in_subprocess(config, args.verbose)
+        _print_report(report)
+        reports.append(report)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(reports, f, indent=2)
+        print(f"\n💾 Reports written to {args.output}")
+
+    return reports
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+import json
+import zlib
+import base64
+import struct
+from array import array
+
+
+# Every line keeps its quadrilateral: 4 points, 8 floats, in page units
+POLYGON_SIZE = 8
+
+MAGIC = b"TFDM"
+VERSION = 1
+
+
+def _polygon(values) -> list:
+    values = list(values or [])[:POLYGON_SIZE]
+    if len(values) < POLYGON_SIZE:
+        values += [0.0] * (POLYGON_SIZE - len(values))
+    return values
+
+
+class Page:
+    """
+    One page: line texts in a list, line polygons in one flat float array
+    (POLYGON_SIZE floats per line) instead of an object per line.
+    """
+
+    __slots__ = ("number", "width", "height", "unit", "texts", "polygons")
+
+    def __init__(self, number: int, width: float, height: float, unit: str = ""):
+        self.number = number
+        self.width = width or 1.0
+        self.height = height or 1.0
+        self.unit = unit or ""
+        self.texts = []
+        self.polygons = array("f")
+
+    def add_line(self, text: str, polygon):
+        self.texts.append(text)
+        self.polygons.extend(_polygon(polygon))
+
+    def __len__(self):
+        return len(self.texts)
+
+    def polygon(self, index: int) -> tuple:
+        start = index * POLYGON_SIZE
+        return tuple(self.polygons[start:start + POLYGON_SIZE])
+
+    def bbox(self, index: int) -> tuple:
+        """
+        (x0, y0, x1, y1) normalised to the page size
+        """
+        polygon = self.polygon(index)
+        xs, ys = polygon[0::2], polygon[1::2]
+        return (
+            min(xs) / self.width, min(ys) / self.height,
+            max(xs) / self.width, max(ys) / self.height,
+        )
+
+
+class Table:
+    """
+    Table cells as parallel arrays (row index, column index, text)
+    """
+
+    __slots__ = ("page", "row_count", "column_count", "rows", "columns", "texts", "polygon")
+
+    def __init__(self, page: int, row_count: int, column_count: int, polygon=None):
+        self.page = page
+        self.row_count = row_count
+        self.column_count = column_count
+        self.rows = array("H")
+        self.columns = array("H")
+        self.texts = []
+        self.polygon = array("f", _polygon(polygon))
+
+    def add_cell(self, row: int, column: int, text: str):
+        self.rows.append(row)
+        self.columns.append(column)
+        self.texts.append(text)
+
+    def grid(self) -> list:
+        grid = [[""] * self.column_count for _ in range(self.row_count)]
+        for row, column, text in zip(self.rows, self.columns, self.texts):
+            if row < self.row_count and column < self.column_count:
+                grid[row][column] = text
+        return grid
+
+    def contains(self, page: Page, index: int) -> bool:
+        """
+        True if the centre of the page's line `index` lies inside the table
+        """
+        if page.number != self.page:
+            return False
+
+        xs, ys = self.polygon[0::2], self.polygon[1::2]
+        line = page.polygon(index)
+        cx = sum(line[0::2]) / 4
+        cy = sum(line[1::2]) / 4
+        return min(xs) <= cx <= max(xs) and min(ys) <= cy <= max(ys)
+
+
+class DocumentModel:
+    """
+    Compact form of an Azure Document Intelligence prebuilt-layout result:
+    pages with line polygons, tables and key-value pairs.
+
+    - text          newline-joined lines (the former OCR output)
+    - to_prompt()   token-efficient encoding for the LLM agents: lines in
+                    reading order, tables as pipe-separated rows in place
+                    of their lines, key-value pairs as "key: value"
+    - to_bytes()    compressed binary form for the attachment cache
+    """
+
+    __slots__ = ("pages", "tables", "keys", "values", "key_pages")
+
+    def __init__(self):
+        self.pages = []
+        self.tables = []
+        self.keys = []
+        self.values = []
+        self.key_pages = array("H")
+
+    # -------------------------------
+    # Builders
+    # -------------------------------
+    @classmethod
+    def from_azure_result(cls, result) -> "DocumentModel":
+        model = cls()
+
+        for azure_page in getattr(result, "pages", None) or []:
+            page = Page(
+                azure_page.page_number,
+                getattr(azure_page, "width", None),
+                getattr(azure_page, "height", None),
+                getattr(azure_page, "unit", None),
+            )
+            for line in getattr(azure_page, "lines", None) or []:
+                if line.content.strip():
+                    page.add_line(line.content.strip(), getattr(line, "polygon", None))
+            model.pages.append(page)
+
+        for azure_table in getattr(result, "tables", None) or []:
+            regions = getattr(azure_table, "bounding_regions", None) or []
+            region = regions[0] if regions else None
+            table = Table(
+                getattr(region, "page_number", 1) if region else 1,
+                azure_table.row_count,
+                azure_table.column_count,
+                getattr(region, "polygon", None) if region else None,
+            )
+            for cell in azure_table.cells:
+                table.add_cell(cell.row_index, cell.column_index, (cell.content or "").strip())
+            model.tables.append(table)
+
+        for pair in getattr(result, "key_value_pairs", None) or []:
+            key = getattr(pair.key, "content", "") if pair.key else ""
+            value = getattr(pair.value, "content", "") if getattr(pair, "value", None) else ""
+            if key.strip():
+                regions = getattr(pair.key, "bounding_regions", None) or []
+                model.keys.append(key.strip())
+                model.values.append(value.strip())
+                model.key_pages.append(getattr(regions[0], "page_number", 1) if regions else 1)
+
+        return model
+
+    @classmethod
+    def from_text(cls, text: str) -> "DocumentModel":
+        model = cls()
+        page = Page(1, 1.0, 1.0)
+        for line in text.splitlines():
+            if line.strip():
+                page.add_line(line.strip(), None)
+        model.pages.append(page)
+        return model
+
+    @classmethod
+    def from_layout(cls, layout: dict) -> "DocumentModel":
+        """
+        From the earlier {"text", "pages": [{"lines": [[text, x0, y0, x1, y1]]}]}
+        checkpoint format (normalised boxes)
+        """
+        model = cls()
+        for layout_page in layout.get("pages", []):
+            page = Page(layout_page["number"], 1.0, 1.0)
+            for text, x0, y0, x1, y1 in layout_page["lines"]:
+                page.add_line(text, (x0, y0, x1, y0, x1, y1, x0, y1))
+            model.pages.append(page)
+
+        if not model.pages and layout.get("text"):
+            return cls.from_text(layout["text"])
+        return model
+
+    # -------------------------------
+    # Views
+    # -------------------------------
+    def __bool__(self):
+        return any(len(page) for page in self.pages)
+
+    @property
+    def text(self) -> str:
+        return "\n".join(text for page in self.pages for text in page.texts)
+
+    def page_text(self, page_number: int, max_lines: int = None) -> str:
+        for page in self.pages:
+            if page.number == page_number:
+                return "\n".join(page.texts[:max_lines])
+        return ""
+
+    def subset(self, page_numbers) -> "DocumentModel":
+        """
+        The given pages with their tables and key-value pairs (objects are
+        shared, not copied)
+        """
+        wanted = set(page_numbers)
+        model = DocumentModel()
+        model.pages = [page for page in self.pages if page.number in wanted]
+        model.tables = [table for table in self.tables if table.page in wanted]
+
+        for key, value, page in zip(self.keys, self.values, self.key_pages):
+            if page in wanted:
+                model.keys.append(key)
+                model.values.append(value)
+                model.key_pages.append(page)
+
+        return model
+
+    def iter_lines(self):
+        """
+        Yields (page_number, index, text, x0, y0, x1, y1) in reading order,
+        boxes normalised to the page size
+        """
+        for page in self.pages:
+            for index, text in enumerate(page.texts):
+                yield (page.number, index, text) + page.bbox(index)
+
+    def to_prompt(self) -> str:
+        out = []
+        multi_page = len(self.pages) > 1
+
+        for page in self.pages:
+            if multi_page:
+                out.append(f"--- page {page.number} ---")
+
+            tables = [table for table in self.tables if table.page == page.number]
+            emitted = set()
+
+            for index, text in enumerate(page.texts):
+                table = next((t for t in tables if t.contains(page, index)), None)
+                if table is None:
+                    out.append(text)
+                    continue
+
+                # Table text replaces its lines, once, where the table starts
+                if id(table) not in emitted:
+                    emitted.add(id(table))
+                    out.append(f"[table {table.row_count}x{table.column_count}]")
+                    out.extend(" | ".join(row) for row in table.grid())
+                    out.append("[/table]")
+
+            # Tables whose lines were not reported on the page
+            for table in tables:
+                if id(table) not in emitted:
+                    out.append(f"[table {table.row_count}x{table.column_count}]")
+                    out.extend(" | ".join(row) for row in table.grid())
+                    out.append("[/table]")
+
+        if self.keys:
+            out.append("[key-values]")
+            out.extend(f"{key}: {value}" for key, value in zip(self.keys, self.values))
+
+        return "\n".join(out)
+
+    # -------------------------------
+    # Binary form
+    # -------------------------------
+    def to_bytes(self) -> bytes:
+        """
+        MAGIC | version | zlib( header_len | JSON header | strings | floats | cell indexes )
+
+        All strings travel in one NUL-separated UTF-8 block, all polygons in
+        one float32 block, all cell indexes in one uint16 block.
+        """
+        strings = []
+        floats = array("f")
+        indexes = array("H")
+
+        header = {
+            "pages": [],
+            "tables": [],
+            "key_values": len(self.keys),
+            "key_value_pages": list(self.key_pages),
+        }
+
+        for page in self.pages:
+            header["pages"].append([page.number, page.width, page.height, page.unit, len(page)])
+            strings.extend(page.texts)
+            floats.extend(page.polygons)
+
+        for table in self.tables:
+            header["tables"].append([table.page, table.row_count, table.column_count, len(table.texts)])
+            strings.extend(table.texts)
+            floats.extend(table.polygon)
+            indexes.extend(table.rows)
+            indexes.extend(table.columns)
+
+        strings.extend(self.keys)
+        strings.extend(self.values)
+
+        header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        string_bytes = "\x00".join(s.replace("\x00", " ") for s in strings).encode("utf-8")
+        float_bytes = floats.tobytes()
+
+        body = b"".join([
+            struct.pack("<IIII", len(header_bytes), len(string_bytes), len(float_bytes), len(strings)),
+            header_bytes,
+            string_bytes,
+            float_bytes,
+            indexes.tobytes(),
+        ])
+        return MAGIC + struct.pack("<H", VERSION) + zlib.compress(body, 6)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DocumentModel":
+        if data[:4] != MAGIC:
+            raise ValueError("Not a serialized DocumentModel")
+        (version,) = struct.unpack("<H", data[4:6])
+        if version != VERSION:
+            raise ValueError(f"Unsupported DocumentModel version {version}")
+
+        body = zlib.decompress(data[6:])
+        header_len, string_len, float_len, string_count = struct.unpack("<IIII", body[:16])
+        offset = 16
+
+        header = json.loads(body[offset:offset + header_len])
+        offset += header_len
+
+        strings = body[offset:offset + string_len].decode("utf-8").split("\x00") if string_count else []
+        offset += string_len
+
+        floats = array("f")
+        floats.frombytes(body[offset:offset + float_len])
+        offset += float_len
+
+        indexes = array("H")
+        indexes.frombytes(body[offset:])
+
+        model = cls()
+        s = f = i = 0
+
+        for number, width, height, unit, line_count in header["pages"]:
+            page = Page(number, width, height, unit)
+            page.texts = strings[s:s + line_count]
+            page.polygons = floats[f:f + line_count * POLYGON_SIZE]
+            s += line_count
+            f += line_count * POLYGON_SIZE
+            model.pages.append(page)
+
+        for page_number, row_count, column_count, cell_count in header["tables"]:
+            table = Table(page_number, row_count, column_count, floats[f:f + POLYGON_SIZE])
+            table.texts = strings[s:s + cell_count]
+            table.rows = indexes[i:i + cell_count]
+            table.columns = indexes[i + cell_count:i + 2 * cell_count]
+            s += cell_count
+            f += POLYGON_SIZE
+            i += 2 * cell_count
+            model.tables.append(table)
+
+        kv = header["key_values"]
+        model.keys = strings[s:s + kv]
+        model.values = strings[s + kv:s + 2 * kv]
+        model.key_pages = array("H", header.get("key_value_pages") or [1] * kv)
+
+        return model
+
+
+# -------------------------------------------------------
+# CHECKPOINT PAYLOADS
+# Stage checkpoints are JSON, so the binary form travels base64-encoded
+# -------------------------------------------------------
+def encode_document_model(model: DocumentModel) -> dict:
+    return {"document_model": base64.b64encode(model.to_bytes()).decode("ascii")}
+
+
+def decode_document_model(payload) -> DocumentModel:
+    """
+    Accepts the current payload and the older plain-text / layout-dict
+    checkpoint formats
+    """
+    if isinstance(payload, DocumentModel):
+        return payload
+    if isinstance(payload, str):
+        return DocumentModel.from_text(payload)
+    if isinstance(payload, dict) and "document_model" in payload:
+        return DocumentModel.from_bytes(base64.b64decode(payload["document_model"]))
+    if isinstance(payload, dict):
+        return DocumentModel.from_layout(payload)
+    return DocumentModel()
+
+
+def prompt_content(document) -> str:
+    """
+    User-message content for an agent: the compact encoding for a
+    DocumentModel, text as-is, anything else as JSON
+    """
+    if isinstance(document, DocumentModel):
+        return document.to_prompt()
+    if isinstance(document, str):
+        return document
+    return json.dumps(document)
@@ -0,0 +1,293 @@
+import re
+import hashlib
+
+
+# A line is a label candidate if it is short and carries no figures
+# ("Invoice No:", "Consignee", "Port of Loading")
+LABEL_MAX_WORDS = 5
+
+# Multi-line values (addresses, goods descriptions) span at most this many lines
+MAX_VALUE_LINES = 4
+
+
+# -------------------------------------------------------
+# LAYOUT HELPERS
+# layout = DocumentModel (document_layout/document_model.py); line boxes
+# are read normalised to the page size (0..1).
+# -------------------------------------------------------
+def normalize_text(text) -> str:
+    text = re.sub(r"[^\w]+", " ", str(text).lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def _label_key(text: str) -> str:
+    return re.sub(r"\d", "#", normalize_text(text))
+
+
+def is_label(text: str) -> bool:
+    words = normalize_text(text).split()
+    if not words or len(words) > LABEL_MAX_WORDS:
+        return False
+    if any(ch.isdigit() for ch in text):
+        return False
+    return sum(ch.isalpha() for ch in text) >= 3
+
+
+def iter_lines(layout):
+    """
+    Yields (page_number, index, text, x0, y0, x1, y1) in reading order
+    """
+    return layout.iter_lines()
+
+
+def layout_labels(layout) -> dict:
+    """
+    {label_key: [page, x0, y0]} for the first occurrence of each label line
+    """
+    labels = {}
+    for page, _, text, x0, y0, _, _ in iter_lines(layout):
+        if is_label(text):
+            labels.setdefault(_label_key(text), [page, round(x0, 4), round(y0, 4)])
+    return labels
+
+
+def template_id(doc_type: str, labels: dict) -> str:
+    digest = hashlib.sha1(
+        "\n".join([doc_type] + sorted(labels)).encode("utf-8")
+    ).hexdigest()
+    return digest[:16]
+
+
+# -------------------------------------------------------
+# FINGERPRINT MATCHING
+# -------------------------------------------------------
+def fingerprint_score(template_labels: dict, labels: dict, tolerance: float) -> float:
+    """
+    Share of the template's recurring labels found in the document at the
+    same place (within `tolerance` of the page size).
+    """
+    if not template_labels:
+        return 0.0
+
+    hits = 0
+    for key, (page, x0, y0) in template_labels.items():
+        found = labels.get(key)
+        if found and found[0] == page and abs(found[1] - x0) <= tolerance and abs(found[2] - y0) <= tolerance:
+            hits += 1
+
+    return hits / len(template_labels)
+
+
+# -------------------------------------------------------
+# FIELD RULES
+# -------------------------------------------------------
+def _page_lines(layout) -> dict:
+    pages = {}
+    for page, index, text, x0, y0, x1, y1 in iter_lines(layout):
+        pages.setdefault(page, []).append((index, text, x0, y0, x1, y1))
+    return pages
+
+
+def _locate_value(pages: dict, value: str):
+    """
+    First run of 1..MAX_VALUE_LINES consecutive lines containing the value.
+    Returns (page, start_index, line_count, joined_text, offset) or None.
+    """
+    target = str(value).strip()
+    if not target:
+        return None
+
+    target_norm = normalize_text(target)
+
+    for line_count in range(1, MAX_VALUE_LINES + 1):
+        for page, lines in pages.items():
+            for start in range(len(lines) - line_count + 1):
+                joined = " ".join(line[1] for line in lines[start:start + line_count])
+
+                offset = joined.find(target)
+                if offset >= 0:
+                    return page, start, line_count, joined, offset
+
+                # Case / punctuation differences: accept only a whole-run match
+                if target_norm and normalize_text(joined) == target_norm:
+                    return page, start, line_count, joined, None
+
+    return None
+
+
+def _nearest_anchor(pages: dict, page: int, start: int, line_count: int, recurring: set):
+    """
+    Closest recurring label line to the value (labels above or left of it
+    are preferred). The value's own lines never anchor it.
+    """
+    _, _, vx0, vy0, _, _ = pages[page][start]
+    best = None
+
+    for position, (_, text, x0, y0, _, _) in enumerate(pages[page]):
+        if start <= position < start + line_count:
+            continue
+
+        key = _label_key(text)
+        if key not in recurring:
+            continue
+
+        distance = abs(vy0 - y0) * 2 + abs(vx0 - x0)
+        if y0 > vy0 + 0.005 or (abs(y0 - vy0) <= 0.005 and x0 > vx0):
+            distance *= 2
+        if best is None or distance < best[0]:
+            best = (distance, key, x0, y0)
+
+    return best
+
+
+def _value_spellings(value) -> list:
+    """
+    How a value may be printed: the LLM returns 1250.5 for "1,250.50"
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return [f"{value:,.2f}", f"{value:.2f}", f"{value:,}", str(value)]
+    return [str(value).strip()]
+
+
+def learn_rules(layout, extraction: dict, recurring: set) -> dict:
+    """
+    Geometry rule per field of a confirmed extraction:
+
+      {"kind": "null"}                                      value was null
+      {"kind": "anchor", "anchor", "dx", "dy", "lines",     value read from the
+       "prefix", "suffix", "type"}                          line(s) at (dx, dy)
+                                                            from its label
+
+    Fields whose value cannot be found on the page map to None, which makes
+    the template unusable until a later sample teaches them.
+    """
+    pages = _page_lines(layout)
+    anchors = {
+        _label_key(text) for _, _, text, *_ in iter_lines(layout) if is_label(text)
+    } & recurring
+
+    rules = {}
+
+    for field, value in extraction.items():
+        if value is None:
+            rules[field] = {"kind": "null"}
+            continue
+
+        if isinstance(value, (dict, list)):
+            rules[field] = None
+            continue
+
+        located = None
+        for text in _value_spellings(value):
+            located = _locate_value(pages, text)
+            if located:
+                break
+
+        if not located:
+            rules[field] = None
+            continue
+
+        page, start, line_count, joined, offset = located
+        anchor = _nearest_anchor(pages, page, start, line_count, anchors)
+        if not anchor:
+            rules[field] = None
+            continue
+
+        _, key, ax0, ay0 = anchor
+        _, _, vx0, vy0, _, _ = pages[page][start]
+
+        rules[field] = {
+            "kind": "anchor",
+            "anchor": key,
+            "dx": round(vx0 - ax0, 4),
+            "dy": round(vy0 - ay0, 4),
+            "lines": line_count,
+            "prefix": joined[:offset] if offset is not None else "",
+            "suffix": joined[offset + len(text):] if offset is not None else "",
+            "type": "number" if isinstance(value, (int, float)) and not isinstance(value, bool) else "str",
+        }
+
+    return rules
+
+
+def _to_number(text: str):
+    cleaned = re.sub(r"[^\d.\-]", "", text)
+    try:
+        number = float(cleaned)
+    except ValueError:
+        return None
+    return int(number) if number.is_integer() and "." not in cleaned else number
+
+
+def apply_rules(layout, labels: dict, rules: dict, tolerance: float):
+    """
+    Read every field by geometry. Returns the extraction dict, or None as
+    soon as one field cannot be read (the caller falls back to the LLM).
+    """
+    pages = _page_lines(layout)
+    extraction = {}
+
+    for field, rule in rules.items():
+        if rule is None:
+            return None
+
+        if rule["kind"] == "null":
+            extraction[field] = None
+            continue
+
+        anchor = labels.get(rule["anchor"])
+        if not anchor:
+            return None
+
+        page, ax0, ay0 = anchor
+        tx, ty = ax0 + rule["dx"], ay0 + rule["dy"]
+
+        best = None
+        for position, (_, _, x0, y0, _, _) in enumerate(pages.get(page, [])):
+            distance = max(abs(x0 - tx), abs(y0 - ty))
+            if distance <= tolerance and (best is None or distance < best[0]):
+                best = (distance, position)
+
+        if best is None:
+            return None
+
+        lines = pages[page][best[1]:best[1] + rule["lines"]]
+        text = " ".join(line[1] for line in lines)
+
+        if rule["prefix"]:
+            if not text.startswith(rule["prefix"]):
+                return None
+            text = text[len(rule["prefix"]):]
+        if rule["suffix"]:
+            if not text.endswith(rule["suffix"]):
+                return None
+            text = text[:-len(rule["suffix"])]
+
+        text = text.strip()
+        if not text:
+            return None
+
+        if rule["type"] == "number":
+            number = _to_number(text)
+            if number is None:
+                return None
+            extraction[field] = number
+        else:
+            extraction[field] = text
+
+    return extraction
+
+
+def values_agree(expected, actual) -> bool:
+    if expected is None or actual is None:
+        return expected is None and actual is None
+    if isinstance(expected, (int, float)) and isinstance(actual, (int, float)):
+        return abs(expected - actual) < 1e-6
+    return normalize_text(expected) == normalize_text(actual)
+
+
+def disagreeing_fields(expected: dict, actual: dict) -> list:
+    return [
+        field for field in set(expected) | set(actual)
+        if not values_agree(expected.get(field), actual.get(field))
+    ]
@@ -0,0 +1,167 @@
+import os
+import io
+import tempfile
+from difflib import SequenceMatcher
+
+# Optional: pip install pymupdf pillow
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Resolution scanned pages are re-rendered at; enough for printed text
+SCAN_TARGET_DPI = int(os.getenv("SCAN_TARGET_DPI", "200"))
+SCAN_JPEG_QUALITY = int(os.getenv("SCAN_JPEG_QUALITY", "70"))
+SCAN_GRAYSCALE = os.getenv("SCAN_GRAYSCALE", "1") == "1"
+
+# Keep the original unless the lean PDF is at least this much smaller
+SCAN_MIN_SAVING = float(os.getenv("SCAN_MIN_SAVING", "0.2"))
+
+# Word-level OCR agreement the accuracy guard requires
+SCAN_MIN_SIMILARITY = float(os.getenv("SCAN_MIN_SIMILARITY", "0.98"))
+
+
+def is_available() -> bool:
+    return pymupdf is not None
+
+
+def _is_image_only(page) -> bool:
+    return not page.get_text("text").strip() and bool(page.get_images(full=True))
+
+
+def _source_dpi(page) -> float:
+    """
+    Highest effective resolution of the images drawn on the page
+    """
+    dpi = 0.0
+    for image in page.get_images(full=True):
+        xref, width_px = image[0], image[2]
+        for rect in page.get_image_rects(xref):
+            if rect.width > 0:
+                dpi = max(dpi, width_px / (rect.width / 72))
+    return dpi
+
+
+def _encode_page(page) -> bytes:
+    colorspace = pymupdf.csGRAY if SCAN_GRAYSCALE else pymupdf.csRGB
+    pixmap = page.get_pixmap(dpi=SCAN_TARGET_DPI, colorspace=colorspace, alpha=False)
+
+    if Image is None:
+        return pixmap.tobytes("jpeg", jpg_quality=SCAN_JPEG_QUALITY)
+
+    mode = "L" if SCAN_GRAYSCALE else "RGB"
+    image = Image.frombytes(mode, (pixmap.width, pixmap.height), pixmap.samples)
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=SCAN_JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def preprocess_scanned_pdf(file_path: str) -> dict:
+    """
+    Re-render image-only pages above SCAN_TARGET_DPI as grayscale JPEG at
+    that resolution and rebuild the PDF. Text pages are copied unchanged,
+    page sizes are kept, so OCR coordinates stay comparable.
+
+    Returns:
+    {
+        "file_path": path to send to OCR (a temp file if preprocessed),
+        "preprocessed": bool,
+        "original_bytes": int,
+        "lean_bytes": int,
+        "pages_rewritten": int
+    }
+    The caller removes the temp file once OCR is done.
+    """
+    original_bytes = os.path.getsize(file_path)
+    result = {
+        "file_path": file_path,
+        "preprocessed": False,
+        "original_bytes": original_bytes,
+        "lean_bytes": original_bytes,
+        "pages_rewritten": 0,
+    }
+
+    if pymupdf is None or not file_path.lower().endswith(".pdf"):
+        return result
+
+    source = pymupdf.open(file_path)
+    lean = pymupdf.open()
+
+    try:
+        for page in source:
+            if _is_image_only(page) and _source_dpi(page) > SCAN_TARGET_DPI * 1.1:
+                new_page = lean.new_page(width=page.rect.width, height=page.rect.height)
+                new_page.insert_image(new_page.rect, stream=_encode_page(page))
+                result["pages_rewritten"] += 1
+            else:
+                lean.insert_pdf(source, from_page=page.number, to_page=page.number)
+
+        if not result["pages_rewritten"]:
+            return result
+
+        payload = lean.tobytes(garbage=4, deflate=True)
+    finally:
+        lean.close()
+        source.close()
+
+    if len(payload) > original_bytes * (1 - SCAN_MIN_SAVING):
+        return result
+
+    fd, lean_path = tempfile.mkstemp(prefix="scan_", suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        f.write(payload)
+
+    result.update(file_path=lean_path, preprocessed=True, lean_bytes=len(payload))
+    print(
+        f"🗜️ Scanned PDF {os.path.basename(file_path)}: {result['pages_rewritten']} page(s) "
+        f"re-rendered at {SCAN_TARGET_DPI} DPI, {original_bytes // 1024} KB → {len(payload) // 1024} KB"
+    )
+    return result
+
+
+def ocr_similarity(original_text: str, lean_text: str) -> float:
+    return SequenceMatcher(None, original_text.split(), lean_text.split(), autojunk=False).ratio()
+
+
+def accuracy_guard(sample_paths: list, ocr) -> dict:
+    """
+    OCR every sample both as-is and preprocessed with `ocr(path) -> text`
+    and compare the words. Passes when every preprocessed sample reaches
+    SCAN_MIN_SIMILARITY; run it on real scans before enabling SCAN_PREPROCESS.
+    """
+    samples = []
+
+    for path in sample_paths:
+        prepared = preprocess_scanned_pdf(path)
+        sample = {
+            "file": os.path.basename(path),
+            "preprocessed": prepared["preprocessed"],
+            "original_bytes": prepared["original_bytes"],
+            "lean_bytes": prepared["lean_bytes"],
+            "similarity": None,
+        }
+
+        if prepared["preprocessed"]:
+            try:
+                sample["similarity"] = round(ocr_similarity(ocr(path), ocr(prepared["file_path"])), 4)
+            finally:
+                os.remove(prepared["file_path"])
+
+        samples.append(sample)
+
+    scored = [s["similarity"] for s in samples if s["similarity"] is not None]
+    return {
+        "samples": samples,
+        "min_similarity": min(scored) if scored else None,
+        "bytes_saved": sum(s["original_bytes"] - s["lean_bytes"] for s in samples),
+        "passed": all(score >= SCAN_MIN_SIMILARITY for score in scored),
+    }
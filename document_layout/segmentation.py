@@ -0,0 +1,65 @@
+import os
+from agent_and_subagents.speculative_extraction import title_document_types
+
+
+# Lines from the top of each page searched for a document title
+SEGMENT_TITLE_LINES = int(os.getenv("SEGMENT_TITLE_LINES", "8"))
+
+
+class Segment:
+    __slots__ = ("page_numbers", "predicted_type", "title_types")
+
+    def __init__(self, page_numbers, predicted_type, title_types=None):
+        self.page_numbers = page_numbers
+        self.predicted_type = predicted_type
+        # Every type the segment's title matched; predicted_type is the first
+        self.title_types = title_types or ([predicted_type] if predicted_type else [])
+
+    @property
+    def label(self) -> str:
+        first, last = self.page_numbers[0], self.page_numbers[-1]
+        return f"p{first}" if first == last else f"p{first}-{last}"
+
+
+def classify_pages(document_model) -> list:
+    """
+    [(page_number, title-based type or None, all matching title types)]
+    for every page
+    """
+    pages = []
+    for page in document_model.pages:
+        title_types = title_document_types(document_model.page_text(page.number, SEGMENT_TITLE_LINES))
+        pages.append((page.number, title_types[0] if title_types else None, title_types))
+    return pages
+
+
+def segment_bundle(document_model) -> list:
+    """
+    Split a PDF bundle into its logical documents.
+
+    Each page is typed from its title area; a page without a recognisable
+    title continues the document before it, a page with a different title
+    starts a new one. Returns [] unless at least two different document
+    types were found, so single documents keep going through the LLM
+    classifier as one unit.
+    """
+    pages = classify_pages(document_model)
+
+    if len({doc_type for _, doc_type, _ in pages if doc_type}) < 2:
+        return []
+
+    segments = []
+    for page_number, doc_type, title_types in pages:
+        current = segments[-1] if segments else None
+
+        if current and (doc_type is None or doc_type == current.predicted_type):
+            current.page_numbers.append(page_number)
+        elif current and current.predicted_type is None:
+            # Untitled leading pages belong to the first titled document
+            current.page_numbers.append(page_number)
+            current.predicted_type = doc_type
+            current.title_types = title_types
+        else:
+            segments.append(Segment([page_number], doc_type, title_types))
+
+    return segments
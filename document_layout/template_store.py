@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from document_layout.layout_templates import (
+    layout_labels, template_id, fingerprint_score, learn_rules, apply_rules,
+    disagreeing_fields
+)
+
+
+# Share of a template's recurring labels that must be found in place
+TEMPLATE_MATCH_THRESHOLD = float(os.getenv("TEMPLATE_MATCH_THRESHOLD", "0.8"))
+
+# Position tolerance, as a fraction of the page width / height
+TEMPLATE_POSITION_TOLERANCE = float(os.getenv("TEMPLATE_POSITION_TOLERANCE", "0.02"))
+
+# Layouts with fewer recurring labels are too generic to fingerprint
+TEMPLATE_MIN_LABELS = int(os.getenv("TEMPLATE_MIN_LABELS", "5"))
+
+# Confirmed samples the rules must reproduce before the template replaces the LLM
+TEMPLATE_MIN_CONFIRMATIONS = int(os.getenv("TEMPLATE_MIN_CONFIRMATIONS", "2"))
+
+# Share of template matches still sent to the LLM to catch layout drift
+TEMPLATE_AUDIT_RATE = float(os.getenv("TEMPLATE_AUDIT_RATE", "0.02"))
+
+# Other workers may have learned templates; reload the table this often
+TEMPLATE_REFRESH_SECONDS = float(os.getenv("TEMPLATE_REFRESH_SECONDS", "60"))
+
+
+class TemplateMatch:
+    __slots__ = ("template_id", "doc_type", "extraction", "score")
+
+    def __init__(self, template_id, doc_type, extraction, score):
+        self.template_id = template_id
+        self.doc_type = doc_type
+        self.extraction = extraction
+        self.score = score
+
+
+class LayoutTemplateStore:
+    """
+    Layout templates of repeat senders, self-trained from the pipeline's
+    own LLM extractions (nothing here is reviewed by a person).
+
+    A template is the set of label lines that recur at the same position
+    across a sender's documents (the fingerprint) plus, per field, the
+    position of its value relative to one of those labels. Once the rules
+    reproduced TEMPLATE_MIN_CONFIRMATIONS extractions, i.e. agreed with
+    the LLM that many times, match() returns the document type and fields
+    read by geometry, no LLM call. TEMPLATE_AUDIT_RATE keeps sampling the
+    LLM to catch drift.
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv("LAYOUT_TEMPLATE_DB", "layout_templates.db")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS layout_templates (
+                template_id    TEXT PRIMARY KEY,
+                doc_type       TEXT NOT NULL,
+                labels         TEXT NOT NULL,
+                rules          TEXT NOT NULL,
+                confirmations  INTEGER NOT NULL,
+                active         INTEGER NOT NULL,
+                hits           INTEGER NOT NULL DEFAULT 0,
+                updated_at     TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+        self._templates = {}
+        self._loaded_at = 0.0
+        self._stats = {"matches": 0, "misses": 0, "audits": 0, "learned": 0, "activated": 0, "relearned": 0}
+
+    # -------------------------------
+    # Persistence
+    # -------------------------------
+    def _refresh(self):
+        if time.monotonic() - self._loaded_at < TEMPLATE_REFRESH_SECONDS:
+            return
+
+        rows = self._conn.execute(
+            "SELECT template_id, doc_type, labels, rules, confirmations, active, hits "
+            "FROM layout_templates"
+        ).fetchall()
+
+        self._templates = {
+            row[0]: {
+                "template_id": row[0],
+                "doc_type": row[1],
+                "labels": json.loads(row[2]),
+                "rules": json.loads(row[3]),
+                "confirmations": row[4],
+                "active": bool(row[5]),
+                "hits": row[6],
+            }
+            for row in rows
+        }
+        self._loaded_at = time.monotonic()
+
+    def _save(self, template: dict):
+        self._templates[template["template_id"]] = template
+        self._conn.execute(
+            """
+            INSERT INTO layout_templates
+                (template_id, doc_type, labels, rules, confirmations, active, hits, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (template_id) DO UPDATE SET
+                labels        = excluded.labels,
+                rules         = excluded.rules,
+                confirmations = excluded.confirmations,
+                active        = excluded.active,
+                hits          = excluded.hits,
+                updated_at    = excluded.updated_at
+            """,
+            (
+                template["template_id"],
+                template["doc_type"],
+                json.dumps(template["labels"]),
+                json.dumps(template["rules"]),
+                template["confirmations"],
+                int(template["active"]),
+                template["hits"],
+                datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+            ),
+        )
+        self._conn.commit()
+
+    def _delete(self, template_id: str):
+        self._templates.pop(template_id, None)
+        self._conn.execute("DELETE FROM layout_templates WHERE template_id = ?", (template_id,))
+        self._conn.commit()
+
+    # -------------------------------
+    # Matching
+    # -------------------------------
+    def _best_template(self, labels: dict, doc_type: str = None, active_only: bool = False):
+        best = None
+
+        for template in self._templates.values():
+            if active_only and not template["active"]:
+                continue
+            if doc_type and template["doc_type"] != doc_type:
+                continue
+
+            score = fingerprint_score(template["labels"], labels, TEMPLATE_POSITION_TOLERANCE)
+            if score >= TEMPLATE_MATCH_THRESHOLD and (best is None or score > best[0]):
+                best = (score, template)
+
+        return best
+
+    def match(self, layout):
+        """
+        TemplateMatch for a known, confirmed layout whose fields could all be
+        read by geometry; None means "use the LLM".
+        """
+        if not layout:
+            return None
+
+        labels = layout_labels(layout)
+        if len(labels) < TEMPLATE_MIN_LABELS:
+            return None
+
+        with self._lock:
+            self._refresh()
+            best = self._best_template(labels, active_only=True)
+
+            if not best:
+                self._stats["misses"] += 1
+                return None
+
+            score, template = best
+            extraction = apply_rules(layout, labels, template["rules"], TEMPLATE_POSITION_TOLERANCE)
+            if extraction is None:
+                self._stats["misses"] += 1
+                return None
+
+            if random.random() < TEMPLATE_AUDIT_RATE:
+                # Let the LLM extract this one; learn() then re-verifies the rules
+                self._stats["audits"] += 1
+                return None
+
+            template["hits"] += 1
+            self._stats["matches"] += 1
+            self._save(template)
+
+        return TemplateMatch(template["template_id"], template["doc_type"], extraction, round(score, 3))
+
+    # -------------------------------
+    # Learning
+    # -------------------------------
+    def learn(self, layout, doc_type: str, extraction: dict) -> str:
+        """
+        Feed one extraction of `layout` (the pipeline passes LLM output with
+        TEMPLATE_SELF_TRAIN=1). Returns what happened to the template:
+        "skipped", "created", "confirmed", "activated" or "relearned".
+        """
+        if not isinstance(extraction, dict) or "error" in extraction:
+            return "skipped"
+
+        if not layout:
+            return "skipped"
+
+        labels = layout_labels(layout)
+        if len(labels) < TEMPLATE_MIN_LABELS:
+            return "skipped"
+
+        with self._lock:
+            self._refresh()
+            best = self._best_template(labels, doc_type=doc_type)
+
+            if not best:
+                template = {
+                    "template_id": template_id(doc_type, labels),
+                    "doc_type": doc_type,
+                    "labels": labels,
+                    "rules": learn_rules(layout, extraction, set(labels)),
+                    "confirmations": 1,
+                    "active": False,
+                    "hits": 0,
+                }
+                template["active"] = self._ready(template)
+                self._stats["learned"] += 1
+                self._save(template)
+                print(f"🧩 New layout template {template['template_id']} ({doc_type}, {len(labels)} labels)")
+                return "created"
+
+            _, template = best
+
+            # Keep only labels that recur in this sample too
+            template["labels"] = {
+                key: position for key, position in template["labels"].items()
+                if key in labels and fingerprint_score({key: position}, labels, TEMPLATE_POSITION_TOLERANCE) == 1.0
+            }
+            if len(template["labels"]) < TEMPLATE_MIN_LABELS:
+                self._delete(template["template_id"])
+                print(f"🧩 Layout template {template['template_id']} dropped: too few recurring labels")
+                return "skipped"
+
+            # Fields without a rule yet are taught by this sample; fields whose
+            # rule reads something else than the confirmed value are wrong
+            relearned = learn_rules(layout, extraction, set(template["labels"]))
+            mismatched = []
+
+            for field, value in extraction.items():
+                rule = template["rules"].get(field)
+                if rule is None:
+                    template["rules"][field] = relearned.get(field)
+                    continue
+
+                predicted = apply_rules(layout, labels, {field: rule}, TEMPLATE_POSITION_TOLERANCE)
+                if predicted is None or disagreeing_fields({field: value}, predicted):
+                    mismatched.append(field)
+
+            if not mismatched:
+                template["confirmations"] += 1
+                was_active = template["active"]
+                template["active"] = self._ready(template)
+                self._save(template)
+
+                if template["active"] and not was_active:
+                    self._stats["activated"] += 1
+                    print(f"🧩 Layout template {template['template_id']} active after {template['confirmations']} confirmations")
+                    return "activated"
+                return "confirmed"
+
+            # Rules no longer reproduce a confirmed extraction: relearn those
+            # fields against the recurring labels and start confirming again
+            for field in mismatched:
+                template["rules"][field] = relearned.get(field)
+            template["confirmations"] = 1
+            template["active"] = self._ready(template)
+            self._stats["relearned"] += 1
+            self._save(template)
+            print(f"🧩 Layout template {template['template_id']} relearned, fields differed: {sorted(mismatched)}")
+            return "relearned"
+
+    @staticmethod
+    def _ready(template: dict) -> bool:
+        complete = all(rule is not None for rule in template["rules"].values())
+        return complete and template["confirmations"] >= TEMPLATE_MIN_CONFIRMATIONS
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._refresh()
+            stats = dict(self._stats)
+            stats["templates"] = len(self._templates)
+            stats["active_templates"] = sum(1 for t in self._templates.values() if t["active"])
+        return stats
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_template_store = None
+_template_store_lock = threading.Lock()
+
+
+def get_template_store() -> LayoutTemplateStore:
+    global _template_store
+    with _template_store_lock:
+        if _template_store is None:
+            _template_store = LayoutTemplateStore()
+    return _template_store
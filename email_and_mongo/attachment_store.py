@@ -0,0 +1,128 @@
+import os
+import json
+import uuid
+import shutil
+import hashlib
+
+
+class AttachmentStore:
+    """
+    Content-addressed store for email attachments.
+
+    Every attachment is stored once under its SHA-256 (the `attachment_id`).
+    Per-email folders only hold hard links (or copies where linking is not
+    possible) to the stored blob, and results computed for an attachment
+    (OCR text, document type, extracted fields) are kept next to it so a
+    re-sent document is never processed twice.
+
+    Layout:
+        <root>/objects/ab/abcdef...      attachment bytes
+        <root>/results/ab/abcdef.../     <stage>.json per processing stage
+                                         (<stage>.bin for binary results)
+    """
+
+    def __init__(self, root: str = None):
+        self.root = root or os.getenv("ATTACHMENT_STORE_DIR", "attachment_store")
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "results"), exist_ok=True)
+
+    # -------------------------------
+    # Blobs
+    # -------------------------------
+    def blob_path(self, attachment_id: str) -> str:
+        return os.path.join(self.root, "objects", attachment_id[:2], attachment_id)
+
+    def put(self, payload: bytes):
+        """
+        Stores payload if unseen.
+
+        Returns (attachment_id, blob_path, is_duplicate)
+        """
+        attachment_id = hashlib.sha256(payload).hexdigest()
+        blob_path = self.blob_path(attachment_id)
+
+        if os.path.exists(blob_path):
+            return attachment_id, blob_path, True
+
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+        # Write-then-rename so concurrent writers never expose a partial blob
+        tmp_path = f"{blob_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, blob_path)
+
+        return attachment_id, blob_path, False
+
+    def link(self, attachment_id: str, dest_path: str) -> str:
+        """
+        Materialize a stored attachment at dest_path without rewriting bytes
+        """
+        blob_path = self.blob_path(attachment_id)
+
+        if os.path.exists(dest_path):
+            os.remove(dest_path)
+
+        try:
+            os.link(blob_path, dest_path)
+        except OSError:
+            # Cross-device or filesystem without hard links
+            shutil.copyfile(blob_path, dest_path)
+
+        return dest_path
+
+    # -------------------------------
+    # Per-attachment results
+    # -------------------------------
+    def _result_path(self, attachment_id: str, stage: str) -> str:
+        return os.path.join(
+            self.root, "results", attachment_id[:2], attachment_id, f"{stage}.json"
+        )
+
+    def load_result(self, attachment_id: str, stage: str):
+        """
+        Returns the cached result of `stage` for this attachment or None
+        """
+        path = self._result_path(attachment_id, stage)
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_result(self, attachment_id: str, stage: str, result):
+        path = self._result_path(attachment_id, stage)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+
+    def load_binary_result(self, attachment_id: str, stage: str):
+        path = self._result_path(attachment_id, stage)[:-len(".json")] + ".bin"
+        if not os.path.exists(path):
+            return None
+
+        with open(path, "rb") as f:
+            return f.read()
+
+    def save_binary_result(self, attachment_id: str, stage: str, payload: bytes):
+        path = self._result_path(attachment_id, stage)[:-len(".json")] + ".bin"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+
+_attachment_store = None
+
+
+def get_attachment_store() -> AttachmentStore:
+    global _attachment_store
+    if _attachment_store is None:
+        _attachment_store = AttachmentStore()
+    return _attachment_store
@@ -1,87 +1,292 @@
 import os
+import re
 import imaplib
 import email
 import uuid
 from email.header import decode_header
 from datetime import datetime
+from email_and_mongo.mailbox_checkpoint_store import MailboxCheckpointStore
+from email_and_mongo.attachment_store import get_attachment_store
+from pipeline.cassettes import open_imap
 
 
-def fetch_unread_mbd_emirates_attachments():
+_checkpoint_store = None
+
+
+def get_checkpoint_store() -> MailboxCheckpointStore:
+    global _checkpoint_store
+    if _checkpoint_store is None:
+        _checkpoint_store = MailboxCheckpointStore()
+    return _checkpoint_store
+
+
+SUBJECT_FETCH_ITEMS = "(UID BODY.PEEK[HEADER.FIELDS (SUBJECT)])"
+BODY_FETCH_ITEMS = "(UID BODY.PEEK[])"
+FETCH_BATCH_SIZE = int(os.getenv("IMAP_FETCH_BATCH_SIZE", "40"))
+
+_UID_PATTERN = re.compile(rb"UID (\d+)")
+
+
+def _batched(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _uid_set(uids: list) -> str:
+    """
+    Compress UIDs into an IMAP sequence set: [101, 102, 103, 150] → "101:103,150"
+    """
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(f"{a}:{b}" if a != b else str(a) for a, b in ranges)
+
+
+def _iter_uid_fetch(mail, uids: list, items: str, batch_size: int = None):
+    """
+    Issue one UID FETCH per batch of UIDs and yield (uid, payload) for every
+    message as soon as its batch arrives, so only one batch is held in memory.
+    """
+    for batch in _batched(uids, batch_size or FETCH_BATCH_SIZE):
+        status, data = mail.uid("FETCH", _uid_set(batch), items)
+        if status != "OK":
+            raise Exception(f"UID FETCH {_uid_set(batch)} failed")
+
+        for i, item in enumerate(data or []):
+            if not isinstance(item, tuple):
+                continue
+
+            # Servers may send the UID item before or after the literal
+            match = _UID_PATTERN.search(item[0])
+            if not match and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+                match = _UID_PATTERN.search(data[i + 1])
+            if not match:
+                continue
+
+            yield int(match.group(1)), item[1]
+
+
+def _decode_subject(msg) -> str:
+    # Decode subject safely
+    subject = ""
+    for part, enc in decode_header(msg.get("Subject", "")):
+        if isinstance(part, bytes):
+            subject += part.decode(enc or "utf-8", errors="ignore")
+        else:
+            subject += part
+    return subject
+
+
+def _save_attachments(msg) -> list:
+    """
+    Hash and store every attachment in the content-addressed store, then
+    link it into a per-email folder under its original name.
+
+    Returns [{"attachment_id", "file_name", "file_path", "size", "duplicate"}]
+    """
+    attachment_store = get_attachment_store()
+    unique_folder = f"mail_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+    saved_attachments = []
+
+    for part in msg.walk():
+        content_disposition = part.get("Content-Disposition", "")
+        if "attachment" in content_disposition.lower():
+            filename = part.get_filename()
+            if not filename:
+                continue
+
+            decoded_name, _ = decode_header(filename)[0]
+            if isinstance(decoded_name, bytes):
+                decoded_name = decoded_name.decode(errors="ignore")
+
+            payload = part.get_payload(decode=True) or b""
+            attachment_id, _, duplicate = attachment_store.put(payload)
+
+            os.makedirs(unique_folder, exist_ok=True)
+            file_path = attachment_store.link(
+                attachment_id, os.path.join(unique_folder, decoded_name)
+            )
+
+            saved_attachments.append({
+                "attachment_id": attachment_id,
+                "file_name": decoded_name,
+                "file_path": file_path,
+                "size": len(payload),
+                "duplicate": duplicate
+            })
+
+            if duplicate:
+                print(f"♻️ Linked duplicate attachment: {file_path} ({attachment_id[:12]})")
+            else:
+                print(f"📎 Saved attachment: {file_path} ({attachment_id[:12]})")
+
+    return saved_attachments
+
+
+def _select_mailbox(mail, mailbox: str):
+    """
+    SELECT the mailbox and return (uidvalidity, uidnext)
+    """
+    status, _ = mail.select(mailbox)
+    if status != "OK":
+        raise Exception(f"Unable to select mailbox '{mailbox}'")
+
+    _, uidvalidity = mail.response("UIDVALIDITY")
+    _, uidnext = mail.response("UIDNEXT")
+
+    if not uidvalidity or uidvalidity[0] is None:
+        raise Exception(f"Server did not report UIDVALIDITY for '{mailbox}'")
+
+    uidnext = int(uidnext[0]) if uidnext and uidnext[0] is not None else None
+    return int(uidvalidity[0]), uidnext
+
+
+def _uid_search(mail, criteria: str) -> list:
+    status, data = mail.uid("SEARCH", None, criteria)
+    if status != "OK":
+        raise Exception(f"UID SEARCH {criteria} failed")
+    return sorted(int(uid) for uid in data[0].split()) if data and data[0] else []
+
+
+def _find_new_uids(mail, account: str, mailbox: str, store: MailboxCheckpointStore):
+    """
+    Returns (uidvalidity, last_uid, uids_to_check, resync_mark)
+
+    - Known UIDVALIDITY  → only UIDs above the stored mark (O(new messages))
+    - First run / UIDVALIDITY changed → full resync: pick up every UNSEEN
+      message once and move the mark to the current end of the mailbox
+    """
+    uidvalidity, uidnext = _select_mailbox(mail, mailbox)
+    checkpoint = store.get(account, mailbox)
+
+    if checkpoint and checkpoint[0] == uidvalidity:
+        last_uid = checkpoint[1]
+        # "n:*" always matches the newest message, even when its UID < n
+        uids = [uid for uid in _uid_search(mail, f"UID {last_uid + 1}:*") if uid > last_uid]
+        return uidvalidity, last_uid, uids, None
+
+    if checkpoint:
+        print(f"🔄 UIDVALIDITY changed for '{mailbox}' ({checkpoint[0]} → {uidvalidity}), full resync")
+    else:
+        print(f"🔄 No checkpoint for '{mailbox}', initial sync")
+
+    uids = _uid_search(mail, "UNSEEN")
+
+    if uidnext:
+        sync_mark = uidnext - 1
+    else:
+        all_uids = _uid_search(mail, "ALL")
+        sync_mark = all_uids[-1] if all_uids else 0
+
+    # Saved only once the resync batch is done, so a crash mid-way resyncs again
+    return uidvalidity, 0, uids, sync_mark
+
+
+def fetch_unread_mbd_emirates_attachments(on_email=None):
+    """
+    Fetch new 'NMD emirates' emails above the mailbox checkpoint and save
+    their attachments.
+
+    on_email(email_result) is called for every matched email BEFORE it is
+    flagged \\Seen and before the UID checkpoint moves past it, so a durable
+    consumer (e.g. the pipeline StageQueue) never loses a message.
+    """
     IMAP_SERVER = os.getenv("IMAP_SERVER")
     EMAIL_USER = os.getenv("EMAIL_USER")
     EMAIL_PASS = os.getenv("EMAIL_PASS")
+    IMAP_MAILBOX = os.getenv("IMAP_MAILBOX", "inbox")
+    # Plain IMAP on a custom port is only meant for local stand-ins
+    IMAP_USE_SSL = os.getenv("IMAP_USE_SSL", "1") == "1"
+    IMAP_PORT = int(os.getenv("IMAP_PORT") or (imaplib.IMAP4_SSL_PORT if IMAP_USE_SSL else imaplib.IMAP4_PORT))
 
     if not all([IMAP_SERVER, EMAIL_USER, EMAIL_PASS]):
         raise ValueError("Missing IMAP environment variables")
 
     print("📧 Connecting to IMAP server...")
-    mail = imaplib.IMAP4_SSL(IMAP_SERVER)
+    imap_class = imaplib.IMAP4_SSL if IMAP_USE_SSL else imaplib.IMAP4
+    mail = open_imap(lambda: imap_class(IMAP_SERVER, IMAP_PORT))
     mail.login(EMAIL_USER, EMAIL_PASS)
-    mail.select("inbox")
 
-    status, messages = mail.search(None, 'UNSEEN')
-    email_ids = messages[0].split()
+    # Log out on every path (no new mail, on_email or FETCH / STORE errors),
+    # live mode polls every few seconds
+    try:
+        store = get_checkpoint_store()
+        uidvalidity, last_uid, email_uids, resync_mark = _find_new_uids(
+            mail, EMAIL_USER, IMAP_MAILBOX, store
+        )
 
-    if not email_ids:
-        raise Exception("No unread emails found")
+        def advance_checkpoint(uid):
+            nonlocal last_uid
+            if resync_mark is None and uid > last_uid:
+                last_uid = uid
+                store.save(EMAIL_USER, IMAP_MAILBOX, uidvalidity, last_uid)
 
-    all_results = []
+        if resync_mark is not None and not email_uids:
+            store.save(EMAIL_USER, IMAP_MAILBOX, uidvalidity, resync_mark)
 
-    for email_id in reversed(email_ids):
-        status, msg_data = mail.fetch(email_id, "(RFC822)")
-        msg = email.message_from_bytes(msg_data[0][1])
+        if not email_uids:
+            raise Exception("No new emails found")
 
-        # Decode subject safely
-        subject = ""
-        for part, enc in decode_header(msg.get("Subject", "")):
-            if isinstance(part, bytes):
-                subject += part.decode(enc or "utf-8", errors="ignore")
-            else:
-                subject += part
+        all_results = []
 
-        print(f"🔍 Checking subject: {subject}")
+        # Round-trip 1..n: subjects only, one UID FETCH per batch
+        matched_uids = []
+        for uid, header_bytes in _iter_uid_fetch(mail, email_uids, SUBJECT_FETCH_ITEMS):
+            subject = _decode_subject(email.message_from_bytes(header_bytes))
+            print(f"🔍 Checking subject: {subject}")
+            if "nmd emirates" in subject.lower():
+                matched_uids.append(uid)
 
-        if "nmd emirates" not in subject.lower():
-            continue
+        # Bodies are fetched only for matches, in ascending UID batches so the
+        # checkpoint only ever moves forward (FETCH responses may come back
+        # in any order)
+        for batch in _batched(sorted(matched_uids), FETCH_BATCH_SIZE):
+            seen_uids = []
 
-        print(f"✅ Matched unread email: {subject}")
+            for uid, raw_message in _iter_uid_fetch(mail, batch, BODY_FETCH_ITEMS):
+                msg = email.message_from_bytes(raw_message)
+                subject = _decode_subject(msg)
 
-        unique_folder = f"mail_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
-        os.makedirs(unique_folder, exist_ok=True)
+                print(f"✅ Matched new email: {subject}")
 
-        saved_files = []
+                saved_attachments = _save_attachments(msg)
 
-        for part in msg.walk():
-            content_disposition = part.get("Content-Disposition", "")
-            if "attachment" in content_disposition.lower():
-                filename = part.get_filename()
-                if not filename:
-                    continue
+                if saved_attachments:
+                    email_result = {
+                        "email_subject": subject,
+                        "mailbox": IMAP_MAILBOX,
+                        "email_uid": uid,
+                        "uidvalidity": uidvalidity,
+                        "folder_path": os.path.dirname(saved_attachments[0]["file_path"]),
+                        "files": [a["file_path"] for a in saved_attachments],
+                        "attachments": saved_attachments
+                    }
 
-                decoded_name, _ = decode_header(filename)[0]
-                if isinstance(decoded_name, bytes):
-                    decoded_name = decoded_name.decode(errors="ignore")
+                    if on_email:
+                        on_email(email_result)
 
-                file_path = os.path.join(unique_folder, decoded_name)
+                    all_results.append(email_result)
+                    seen_uids.append(uid)
 
-                with open(file_path, "wb") as f:
-                    f.write(part.get_payload(decode=True))
+            # \Seen is informational only; the UID checkpoint drives polling
+            if seen_uids:
+                mail.uid("STORE", _uid_set(seen_uids), "+FLAGS.SILENT", "(\\Seen)")
 
-                saved_files.append(file_path)
-                print(f"📎 Saved attachment: {file_path}")
+            advance_checkpoint(batch[-1])
 
-        if saved_files:
-            all_results.append({
-                "email_subject": subject,
-                "folder_path": unique_folder,
-                "files": saved_files
-            })
+        advance_checkpoint(email_uids[-1])
 
-            # Mark email as SEEN only after successful processing
-            mail.store(email_id, '+FLAGS', '\\Seen')
+        if resync_mark is not None:
+            store.save(EMAIL_USER, IMAP_MAILBOX, uidvalidity, max(resync_mark, email_uids[-1]))
+    finally:
+        mail.logout()
 
     if not all_results:
-        raise Exception("No unread emails found with subject 'NMD emirates' and attachments")
+        raise Exception("No new emails found with subject 'NMD emirates' and attachments")
 
     return all_results
 
@@ -94,6 +299,7 @@ if __name__ == "__main__":
     result = fetch_unread_mbd_emirates_attachments()
 
     print("\n📂 DOWNLOAD SUMMARY")
-    print("Folder:", result["folder_path"])
-    for f in result["files"]:
-        print(" -", f)
+    for email_data in result:
+        print("Folder:", email_data["folder_path"])
+        for f in email_data["files"]:
+            print(" -", f)
@@ -1,14 +1,115 @@
 import os
-import boto3
+import io
+import hashlib
 from datetime import datetime
 from reportlab.platypus import SimpleDocTemplate, Paragraph
 from reportlab.lib.styles import getSampleStyleSheet
 from PyPDF2 import PdfMerger
+from email_and_mongo.s3_transfer_service import get_s3_transfer_service
+from email_and_mongo import pdf_optimizer
 
 
-def merge_pdfs_unique_and_upload(
+# Merge directly into the S3 upload instead of via a local file
+MERGE_STREAM_TO_S3 = os.getenv("MERGE_STREAM_TO_S3", "1") == "1"
+# Keep a local copy of streamed merges (folder_path / merged_output/)
+MERGED_PDF_LOCAL_COPY = os.getenv("MERGED_PDF_LOCAL_COPY", "0") == "1"
+# De-duplicate / compress the merged PDF before it is written out:
+# auto = only with pymupdf installed, 1 = always (PyPDF2 fallback only
+# compresses content streams), 0 = off. Optimizing needs the whole merged
+# PDF in memory, so the streamed merge no longer overlaps with the upload.
+_MERGED_PDF_OPTIMIZE_MODE = os.getenv("MERGED_PDF_OPTIMIZE", "auto").lower()
+MERGED_PDF_OPTIMIZE = _MERGED_PDF_OPTIMIZE_MODE == "1" or (
+    _MERGED_PDF_OPTIMIZE_MODE == "auto" and pdf_optimizer.is_available()
+)
+# Name merges by their attachment manifest and reuse an existing upload
+MERGE_IDEMPOTENT = os.getenv("MERGE_IDEMPOTENT", "1") == "1"
+
+# Bump when the merge output changes for the same inputs
+MERGE_MANIFEST_VERSION = "1"
+
+
+def _unique_merged_filename() -> str:
+    unique_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    return f"Merged_{unique_id}.pdf"
+
+
+def _merged_pdf_paths(attachments: list) -> list:
+    return [
+        file_path for file_path in attachments
+        if file_path.lower().endswith(".pdf") and os.path.exists(file_path)
+    ]
+
+
+def _file_sha256(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def attachment_manifest(attachments: list) -> str:
+    """
+    sha256 over the ordered content hashes of the PDFs that get merged
+    (plus the merge settings), so the same attachment set in the same
+    order always maps to the same merged object
+    """
+    digest = hashlib.sha256(
+        f"v{MERGE_MANIFEST_VERSION}:optimize={int(MERGED_PDF_OPTIMIZE)}".encode()
+    )
+    for file_path in _merged_pdf_paths(attachments):
+        digest.update(b"\n" + _file_sha256(file_path).encode())
+    return digest.hexdigest()
+
+
+def manifest_filename(manifest: str) -> str:
+    return f"Merged_{manifest[:16]}.pdf"
+
+
+def find_existing_merge(
+    attachments: list,
+    bucket_name: str = "",
+    s3_folder: str = "",
+    aws_access_key: str = "",
+    aws_secret_key: str = "",
+    aws_region: str = "ap-south-1",
+    manifest: str = None
+):
+    """
+    HEAD the manifest-named object; returns an upload result when it exists
+    and carries the same manifest in its metadata, else None
+    """
+    manifest = manifest or attachment_manifest(attachments)
+    filename = manifest_filename(manifest)
+    s3_key = f"{s3_folder}{filename}"
+
+    s3 = get_s3_transfer_service(aws_access_key, aws_secret_key, aws_region)
+
+    head = s3.head_object(bucket_name, s3_key)
+    if head is None:
+        return None
+
+    if head.get("Metadata", {}).get("manifest") != manifest or not head.get("ContentLength"):
+        print(f"⚠️ {s3_key} exists but does not match manifest {manifest[:16]}; re-uploading")
+        return None
+
+    print(f"♻️ Merged PDF already uploaded: {s3_key}")
+
+    return {
+        "local_pdf_path": None,
+        "s3_bucket": bucket_name,
+        "s3_key": s3_key,
+        "object_url": s3.object_url(bucket_name, s3_key),
+        "filename": filename,
+        "manifest": manifest,
+        "etag": head.get("ETag"),
+        "reused": True,
+        "message": "Merged PDF already uploaded"
+    }
+
+
+def existing_merge_or_manifest(
     attachments: list,
-    folder_path: str = "",
     bucket_name: str = "",
     s3_folder: str = "",
     aws_access_key: str = "",
@@ -16,58 +117,217 @@ def merge_pdfs_unique_and_upload(
     aws_region: str = "ap-south-1"
 ):
     """
-    Merge PDF attachments into a uniquely named PDF
-    and upload it to AWS S3.
+    MERGE_IDEMPOTENT lookup shared by every merge path. Returns
+    (manifest, existing): existing is the earlier upload to reuse, else
+    None and the merge goes ahead tagged with manifest. (None, None) when
+    MERGE_IDEMPOTENT is off.
     """
+    if not MERGE_IDEMPOTENT:
+        return None, None
+
+    manifest = attachment_manifest(attachments)
+    existing = find_existing_merge(
+        attachments, bucket_name, s3_folder,
+        aws_access_key, aws_secret_key, aws_region,
+        manifest=manifest
+    )
+    return manifest, existing
 
-    import os
-    from datetime import datetime
-    from PyPDF2 import PdfMerger
-    import boto3
+
+def _write_merged_pdf(attachments: list, stream):
+    """
+    Merge into `stream` (file object or path). Returns the optimization
+    stats, or None when MERGED_PDF_OPTIMIZE is off.
+    """
+    merger = PdfMerger()
+
+    for file_path in _merged_pdf_paths(attachments):
+        merger.append(file_path)
+
+    if not MERGED_PDF_OPTIMIZE:
+        merger.write(stream)
+        merger.close()
+        return None
+
+    # Optimizing needs the whole document: merge in memory first
+    buffer = io.BytesIO()
+    merger.write(buffer)
+    merger.close()
+
+    payload, stats = pdf_optimizer.optimize_pdf(buffer.getvalue())
+    print(f"🗜️ Merged PDF optimized ({stats['engine']}): {stats['original_bytes']} → {stats['optimized_bytes']} bytes, saved {stats['bytes_saved']}")
+
+    if isinstance(stream, str):
+        with open(stream, "wb") as f:
+            f.write(payload)
+    else:
+        stream.write(payload)
+
+    return stats
+
+
+def merge_pdfs_unique(attachments: list, folder_path: str = "") -> dict:
+    """
+    Merge PDF attachments into a uniquely named local PDF.
+    """
 
     os.makedirs(folder_path, exist_ok=True)
 
     # -------------------------------
     # Generate Unique Filename
     # -------------------------------
-    unique_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
-    base_filename = f"Merged_{unique_id}"
-
-    merged_pdf_path = os.path.join(folder_path, f"{base_filename}.pdf")
+    filename = _unique_merged_filename()
+    merged_pdf_path = os.path.join(folder_path, filename)
 
     # -------------------------------
     # Merge Attachments
     # -------------------------------
-    merger = PdfMerger()
+    optimization = _write_merged_pdf(attachments, merged_pdf_path)
 
-    for file_path in attachments:
-        if file_path.lower().endswith(".pdf") and os.path.exists(file_path):
-            merger.append(file_path)
+    return {
+        "local_pdf_path": merged_pdf_path,
+        "filename": filename,
+        "optimization": optimization
+    }
 
-    merger.write(merged_pdf_path)
-    merger.close()
 
-    # -------------------------------
-    # Upload to S3
-    # -------------------------------
-    s3_key = f"{s3_folder}{base_filename}.pdf"
+def upload_merged_pdf(
+    merged_pdf_path: str,
+    bucket_name: str = "",
+    s3_folder: str = "",
+    aws_access_key: str = "",
+    aws_secret_key: str = "",
+    aws_region: str = "ap-south-1",
+    manifest: str = None
+) -> dict:
+    """
+    Upload a merged PDF to AWS S3. With a `manifest` the object is named
+    after it and tagged with it, so find_existing_merge can reuse it.
+    """
 
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=aws_region
-    )
+    filename = manifest_filename(manifest) if manifest else os.path.basename(merged_pdf_path)
+    s3_key = f"{s3_folder}{filename}"
+    extra_args = {"ContentType": "application/pdf"}
+    if manifest:
+        extra_args["Metadata"] = {"manifest": manifest}
 
-    s3.upload_file(merged_pdf_path, bucket_name, s3_key)
+    s3 = get_s3_transfer_service(aws_access_key, aws_secret_key, aws_region)
+    s3.upload_file(merged_pdf_path, bucket_name, s3_key, extra_args=extra_args)
 
-    object_url = f"https://{bucket_name}.s3.{aws_region}.amazonaws.com/{s3_key}"
+    object_url = s3.object_url(bucket_name, s3_key)
 
     return {
         "local_pdf_path": merged_pdf_path,
         "s3_bucket": bucket_name,
         "s3_key": s3_key,
         "object_url": object_url,
-        "filename": f"{base_filename}.pdf",
+        "filename": filename,
+        "manifest": manifest,
         "message": "PDFs merged and uploaded successfully"
     }
+
+
+def merge_and_stream_to_s3(
+    attachments: list,
+    bucket_name: str = "",
+    s3_folder: str = "",
+    aws_access_key: str = "",
+    aws_secret_key: str = "",
+    aws_region: str = "ap-south-1",
+    local_folder: str = None
+) -> dict:
+    """
+    Merge PDF attachments straight into an S3 (multipart) upload, parts
+    uploaded in parallel while merging continues (with MERGED_PDF_OPTIMIZE
+    the merge is finished in memory before the first part goes out). Nothing touches the disk
+    unless `local_folder` is given, in which case a copy is kept there.
+
+    Returns the same shape as upload_merged_pdf (local_pdf_path is None
+    without a local copy). With MERGE_IDEMPOTENT an existing upload of the
+    same attachment manifest is returned instead of merging again.
+    """
+
+    manifest, existing = existing_merge_or_manifest(
+        attachments, bucket_name, s3_folder,
+        aws_access_key, aws_secret_key, aws_region
+    )
+    if existing:
+        return existing
+    metadata = {"manifest": manifest} if manifest else {}
+
+    filename = manifest_filename(manifest) if manifest else _unique_merged_filename()
+    s3_key = f"{s3_folder}{filename}"
+
+    local_pdf_path = None
+    if local_folder:
+        os.makedirs(local_folder, exist_ok=True)
+        local_pdf_path = os.path.join(local_folder, filename)
+
+    s3 = get_s3_transfer_service(aws_access_key, aws_secret_key, aws_region)
+
+    with s3.open_writer(
+        bucket_name, s3_key,
+        content_type="application/pdf",
+        metadata=metadata,
+        local_copy_path=local_pdf_path
+    ) as writer:
+        optimization = _write_merged_pdf(attachments, writer)
+
+    object_url = s3.object_url(bucket_name, s3_key)
+
+    return {
+        "local_pdf_path": local_pdf_path,
+        "s3_bucket": bucket_name,
+        "s3_key": s3_key,
+        "object_url": object_url,
+        "filename": filename,
+        "manifest": manifest,
+        "etag": writer.etag,
+        "optimization": optimization,
+        "message": "PDFs merged and uploaded successfully"
+    }
+
+
+def merge_pdfs_unique_and_upload(
+    attachments: list,
+    folder_path: str = "",
+    bucket_name: str = "",
+    s3_folder: str = "",
+    aws_access_key: str = "",
+    aws_secret_key: str = "",
+    aws_region: str = "ap-south-1"
+):
+    """
+    Merge PDF attachments into a uniquely named PDF
+    and upload it to AWS S3.
+    """
+
+    if MERGE_STREAM_TO_S3:
+        return merge_and_stream_to_s3(
+            attachments,
+            bucket_name=bucket_name,
+            s3_folder=s3_folder,
+            aws_access_key=aws_access_key,
+            aws_secret_key=aws_secret_key,
+            aws_region=aws_region,
+            local_folder=folder_path if MERGED_PDF_LOCAL_COPY else None
+        )
+
+    manifest, existing = existing_merge_or_manifest(
+        attachments, bucket_name, s3_folder,
+        aws_access_key, aws_secret_key, aws_region
+    )
+    if existing:
+        return existing
+
+    merged = merge_pdfs_unique(attachments, folder_path)
+
+    return upload_merged_pdf(
+        merged["local_pdf_path"],
+        bucket_name=bucket_name,
+        s3_folder=s3_folder,
+        aws_access_key=aws_access_key,
+        aws_secret_key=aws_secret_key,
+        aws_region=aws_region,
+        manifest=manifest
+    )
@@ -0,0 +1,73 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime, timezone
+
+
+class MailboxCheckpointStore:
+    """
+    Persists the IMAP sync position per mailbox.
+
+    For every mailbox we keep the UIDVALIDITY seen on the last poll and the
+    highest UID that has already been handled. UIDs are only meaningful
+    together with their UIDVALIDITY, so a changed UIDVALIDITY means the
+    stored mark is void and a full resync is required.
+    """
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or os.getenv(
+            "MAILBOX_CHECKPOINT_DB", "mailbox_checkpoints.db"
+        )
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mailbox_checkpoints (
+                account      TEXT NOT NULL,
+                mailbox      TEXT NOT NULL,
+                uidvalidity  INTEGER NOT NULL,
+                last_uid     INTEGER NOT NULL,
+                updated_at   TEXT NOT NULL,
+                PRIMARY KEY (account, mailbox)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, account: str, mailbox: str):
+        """
+        Returns (uidvalidity, last_uid) or None if the mailbox was never synced
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT uidvalidity, last_uid FROM mailbox_checkpoints "
+                "WHERE account = ? AND mailbox = ?",
+                (account, mailbox),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def save(self, account: str, mailbox: str, uidvalidity: int, last_uid: int):
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT INTO mailbox_checkpoints
+                    (account, mailbox, uidvalidity, last_uid, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (account, mailbox) DO UPDATE SET
+                    uidvalidity = excluded.uidvalidity,
+                    last_uid    = excluded.last_uid,
+                    updated_at  = excluded.updated_at
+                """,
+                (
+                    account,
+                    mailbox,
+                    uidvalidity,
+                    last_uid,
+                    datetime.now(timezone.utc).isoformat(timespec="milliseconds"),
+                ),
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
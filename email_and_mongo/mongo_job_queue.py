@@ -0,0 +1,212 @@
+import os
+import time
+from datetime import datetime, timezone
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+from email_and_mongo.mongo_trade_finance_store import db
+from pipeline.stage_queue import STAGES, LEASE_SECONDS
+
+
+class MongoStageQueue:
+    """
+    MongoDB implementation of the pipeline StageQueue interface, for worker
+    fleets spread over several hosts.
+
+    Claims use find_one_and_update, which is atomic per document, so two
+    workers can never lease the same job. Stage outputs live in a second
+    collection keyed by (job_id, stage, item_key).
+    """
+
+    def __init__(self, max_attempts: int = None):
+        self.max_attempts = max_attempts or int(os.getenv("PIPELINE_MAX_ATTEMPTS", "3"))
+
+        self.jobs = db[os.getenv("PIPELINE_JOBS_COLLECTION", "pipeline_jobs")]
+        self.outputs = db[os.getenv("PIPELINE_STAGE_OUTPUTS_COLLECTION", "pipeline_stage_outputs")]
+
+        self.jobs.create_index([("status", ASCENDING), ("available_at", ASCENDING), ("created_at", ASCENDING)])
+        self.jobs.create_index([("status", ASCENDING), ("lease_expires", ASCENDING)])
+        self.outputs.create_index(
+            [("job_id", ASCENDING), ("stage", ASCENDING), ("item_key", ASCENDING)],
+            unique=True
+        )
+
+    @staticmethod
+    def _job(doc: dict):
+        if not doc:
+            return None
+        return {
+            "job_id": doc["_id"],
+            "payload": doc["payload"],
+            "stage": doc["stage"],
+            "attempts": doc.get("attempts", 0),
+        }
+
+    # -------------------------------
+    # Jobs
+    # -------------------------------
+    def enqueue(self, job_id: str, payload: dict) -> bool:
+        now = datetime.now(timezone.utc)
+        try:
+            self.jobs.insert_one({
+                "_id": job_id,
+                "payload": payload,
+                "status": "pending",
+                "stage": "fetched",
+                "attempts": 0,
+                "last_error": None,
+                "lease_owner": None,
+                "lease_expires": None,
+                "available_at": 0,
+                "created_at": now,
+                "updated_at": now,
+            })
+            return True
+        except DuplicateKeyError:
+            return False
+
+    def pending_jobs(self, limit: int = None) -> list:
+        cursor = self.jobs.find({"status": "pending"}).sort("created_at", ASCENDING)
+        if limit:
+            cursor = cursor.limit(limit)
+        return [self._job(doc) for doc in cursor]
+
+    def get_job(self, job_id: str):
+        doc = self.jobs.find_one({"_id": job_id})
+        if not doc:
+            return None
+        job = self._job(doc)
+        job.update(status=doc["status"], last_error=doc.get("last_error"))
+        return job
+
+    # -------------------------------
+    # Leases
+    # -------------------------------
+    def claim(self, worker_id: str, lease_seconds: float = None):
+        lease_seconds = lease_seconds or LEASE_SECONDS
+        now = time.time()
+
+        doc = self.jobs.find_one_and_update(
+            {
+                "$or": [
+                    {"status": "pending", "available_at": {"$lte": now}},
+                    {"status": "leased", "lease_expires": {"$lt": now}},
+                ]
+            },
+            {
+                "$set": {
+                    "status": "leased",
+                    "lease_owner": worker_id,
+                    "lease_expires": now + lease_seconds,
+                    "updated_at": datetime.now(timezone.utc),
+                }
+            },
+            sort=[("created_at", ASCENDING)],
+            return_document=ReturnDocument.AFTER,
+        )
+        return self._job(doc)
+
+    def renew_lease(self, job_id: str, worker_id: str, lease_seconds: float = None) -> bool:
+        lease_seconds = lease_seconds or LEASE_SECONDS
+        result = self.jobs.update_one(
+            {"_id": job_id, "status": "leased", "lease_owner": worker_id},
+            {"$set": {
+                "lease_expires": time.time() + lease_seconds,
+                "updated_at": datetime.now(timezone.utc),
+            }},
+        )
+        return result.modified_count == 1
+
+    def requeue_expired(self) -> int:
+        result = self.jobs.update_many(
+            {"status": "leased", "lease_expires": {"$lt": time.time()}},
+            {"$set": {
+                "status": "pending",
+                "lease_owner": None,
+                "lease_expires": None,
+                "updated_at": datetime.now(timezone.utc),
+            }},
+        )
+        return result.modified_count
+
+    def complete(self, job_id: str, worker_id: str = None) -> bool:
+        query = {"_id": job_id}
+        if worker_id:
+            query["lease_owner"] = worker_id
+
+        result = self.jobs.update_one(query, {"$set": {
+            "status": "done",
+            "stage": STAGES[-1],
+            "last_error": None,
+            "lease_owner": None,
+            "lease_expires": None,
+            "updated_at": datetime.now(timezone.utc),
+        }})
+        return result.modified_count == 1
+
+    def release(self, job_id: str, retry_delay: float = 0, worker_id: str = None) -> bool:
+        query = {"_id": job_id, "status": "leased"}
+        if worker_id:
+            query["lease_owner"] = worker_id
+
+        result = self.jobs.update_one(query, {"$set": {
+            "status": "pending",
+            "lease_owner": None,
+            "lease_expires": None,
+            "available_at": time.time() + retry_delay,
+            "updated_at": datetime.now(timezone.utc),
+        }})
+        return result.modified_count == 1
+
+    def fail(self, job_id: str, error: str, retry_delay: float = 0) -> str:
+        doc = self.jobs.find_one_and_update(
+            {"_id": job_id},
+            {"$inc": {"attempts": 1}},
+            return_document=ReturnDocument.AFTER,
+        )
+        attempts = doc["attempts"] if doc else self.max_attempts
+        status = "failed" if attempts >= self.max_attempts else "pending"
+
+        self.jobs.update_one({"_id": job_id}, {"$set": {
+            "status": status,
+            "last_error": error,
+            "lease_owner": None,
+            "lease_expires": None,
+            "available_at": time.time() + retry_delay,
+            "updated_at": datetime.now(timezone.utc),
+        }})
+        return status
+
+    # -------------------------------
+    # Stage checkpoints
+    # -------------------------------
+    def save_stage_output(self, job_id: str, stage: str, output, item_key: str = ""):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown pipeline stage: {stage}")
+
+        self.outputs.replace_one(
+            {"job_id": job_id, "stage": stage, "item_key": item_key},
+            {
+                "job_id": job_id,
+                "stage": stage,
+                "item_key": item_key,
+                "output": output,
+                "created_at": datetime.now(timezone.utc),
+            },
+            upsert=True,
+        )
+
+        # Track the furthest stage reached, for observability
+        earlier = STAGES[:STAGES.index(stage)]
+        self.jobs.update_one(
+            {"_id": job_id, "stage": {"$in": earlier}},
+            {"$set": {"stage": stage, "updated_at": datetime.now(timezone.utc)}},
+        )
+
+    def load_stage_output(self, job_id: str, stage: str, item_key: str = ""):
+        """
+        Returns (found, output)
+        """
+        doc = self.outputs.find_one({"job_id": job_id, "stage": stage, "item_key": item_key})
+        if not doc:
+            return False, None
+        return True, doc["output"]
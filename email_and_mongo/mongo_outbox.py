@@ -0,0 +1,283 @@
+import os
+import time
+import sqlite3
+import threading
+from datetime import datetime, timezone
+import bson
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pymongo.write_concern import WriteConcern
+from pipeline.resilience import get_circuit_breaker, CircuitOpenError
+
+
+# Flush when this many documents are pending, or every interval
+MONGO_BATCH_SIZE = int(os.getenv("MONGO_BATCH_SIZE", "100"))
+MONGO_FLUSH_INTERVAL_SECONDS = float(os.getenv("MONGO_FLUSH_INTERVAL_SECONDS", "1"))
+
+# Write concern of the batched inserts
+MONGO_WRITE_CONCERN_W = os.getenv("MONGO_WRITE_CONCERN_W", "majority")
+MONGO_WRITE_CONCERN_JOURNAL = os.getenv("MONGO_WRITE_CONCERN_JOURNAL", "1") == "1"
+MONGO_WRITE_CONCERN_TIMEOUT_MS = int(os.getenv("MONGO_WRITE_CONCERN_TIMEOUT_MS", "10000"))
+
+# Retry backoff for transient failures; documents rejected by the server
+# itself (validation, ...) are parked after MONGO_OUTBOX_MAX_ATTEMPTS
+MONGO_RETRY_BASE_SECONDS = float(os.getenv("MONGO_RETRY_BASE_SECONDS", "1"))
+MONGO_RETRY_MAX_SECONDS = float(os.getenv("MONGO_RETRY_MAX_SECONDS", "60"))
+MONGO_OUTBOX_MAX_ATTEMPTS = int(os.getenv("MONGO_OUTBOX_MAX_ATTEMPTS", "5"))
+
+DUPLICATE_KEY = 11000
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+def _write_concern() -> WriteConcern:
+    w = int(MONGO_WRITE_CONCERN_W) if MONGO_WRITE_CONCERN_W.isdigit() else MONGO_WRITE_CONCERN_W
+    return WriteConcern(w=w, j=MONGO_WRITE_CONCERN_JOURNAL, wtimeout=MONGO_WRITE_CONCERN_TIMEOUT_MS)
+
+
+class MongoOutbox:
+    """
+    Local, durable outbox (SQLite) in front of a Mongo collection.
+
+    enqueue() stores the BSON-encoded document and returns at once; a
+    background thread sends pending documents with insert_many(ordered=False)
+    once MONGO_BATCH_SIZE are waiting or MONGO_FLUSH_INTERVAL_SECONDS passed.
+    Documents carry their own _id, so a batch retried after a partial
+    success only hits duplicate key errors for what is already stored.
+
+    Transient failures (network, timeouts, open circuit) keep the batch and
+    retry with exponential backoff; documents Mongo itself rejects are
+    retried MONGO_OUTBOX_MAX_ATTEMPTS times, then parked as "dead".
+    """
+
+    def __init__(self, collection, is_transient, db_path: str = None):
+        self.collection = collection.with_options(write_concern=_write_concern())
+        self.is_transient = is_transient
+        self.db_path = db_path or os.getenv("MONGO_OUTBOX_DB", "mongo_outbox.db")
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS mongo_outbox (
+                doc_id           TEXT PRIMARY KEY,
+                payload          BLOB NOT NULL,
+                status           TEXT NOT NULL,
+                attempts         INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at  REAL NOT NULL,
+                last_error       TEXT,
+                created_at       TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._flush_lock = threading.Lock()
+        self._backoff = 0.0
+        self._resume_at = 0.0
+        self._stats = {"enqueued": 0, "written": 0, "batches": 0, "retries": 0, "dead": 0}
+
+    # -------------------------------
+    # Producer side
+    # -------------------------------
+    def enqueue(self, document: dict) -> str:
+        doc_id = str(document["_id"])
+
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO mongo_outbox (doc_id, payload, status, next_attempt_at, created_at) "
+                "VALUES (?, ?, 'pending', ?, ?)",
+                (doc_id, bson.encode(document), time.time(), _now()),
+            )
+            self._conn.commit()
+            self._stats["enqueued"] += 1
+            pending = self._pending_count()
+
+        if pending >= MONGO_BATCH_SIZE:
+            self._wake.set()
+        return doc_id
+
+    def _pending_count(self) -> int:
+        return self._conn.execute(
+            "SELECT COUNT(*) FROM mongo_outbox WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    # -------------------------------
+    # Flushing
+    # -------------------------------
+    def _due_batch(self) -> list:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT doc_id, payload, attempts FROM mongo_outbox "
+                "WHERE status = 'pending' AND next_attempt_at <= ? "
+                "ORDER BY created_at LIMIT ?",
+                (time.time(), MONGO_BATCH_SIZE),
+            ).fetchall()
+
+    def _mark_written(self, doc_ids: list):
+        if not doc_ids:
+            return
+        with self._lock:
+            self._conn.executemany("DELETE FROM mongo_outbox WHERE doc_id = ?", [(d,) for d in doc_ids])
+            self._conn.commit()
+            self._stats["written"] += len(doc_ids)
+
+    def _mark_failed(self, failures: dict, attempts: dict):
+        with self._lock:
+            for doc_id, error in failures.items():
+                tries = attempts[doc_id] + 1
+                if tries >= MONGO_OUTBOX_MAX_ATTEMPTS:
+                    status, self._stats["dead"] = "dead", self._stats["dead"] + 1
+                    print(f"❌ Mongo outbox: document {doc_id} parked after {tries} attempts: {error}")
+                else:
+                    status = "pending"
+                delay = min(MONGO_RETRY_BASE_SECONDS * 2 ** tries, MONGO_RETRY_MAX_SECONDS)
+                self._conn.execute(
+                    "UPDATE mongo_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? "
+                    "WHERE doc_id = ?",
+                    (status, tries, time.time() + delay, str(error)[:500], doc_id),
+                )
+            self._conn.commit()
+
+    def flush_once(self) -> int:
+        """
+        Send one batch of due documents; returns how many were written
+        (0 when nothing was due or Mongo is unavailable)
+        """
+        with self._flush_lock:
+            if time.monotonic() < self._resume_at:
+                return 0
+            return self._flush_batch()
+
+    def _flush_batch(self) -> int:
+        batch = self._due_batch()
+        if not batch:
+            return 0
+
+        doc_ids = [row[0] for row in batch]
+        attempts = {row[0]: row[2] for row in batch}
+
+        try:
+            with get_circuit_breaker("mongo").guard(is_failure=self.is_transient):
+                self.collection.insert_many([bson.decode(row[1]) for row in batch], ordered=False)
+        except BulkWriteError as e:
+            failed = {}
+            for error in e.details.get("writeErrors", []):
+                if error.get("code") != DUPLICATE_KEY:
+                    failed[doc_ids[error["index"]]] = error.get("errmsg")
+
+            if e.details.get("writeConcernErrors"):
+                # Inserted but not acknowledged as durable yet: resend the
+                # batch later, the stored ones then hit duplicate keys
+                self._retry_later(RuntimeError(e.details["writeConcernErrors"][0].get("errmsg")))
+                return 0
+
+            self._mark_written([doc_id for doc_id in doc_ids if doc_id not in failed])
+            self._mark_failed(failed, attempts)
+            self._stats["batches"] += 1
+            return len(doc_ids) - len(failed)
+        except CircuitOpenError as e:
+            self._retry_later(e, e.retry_after)
+            return 0
+        except Exception as e:
+            if not self.is_transient(e):
+                # e.g. DocumentTooLarge: no per-document detail, find the
+                # culprit instead of parking the whole batch with it
+                return self._flush_one_by_one(batch, attempts)
+            self._retry_later(e)
+            return 0
+
+        self._backoff = 0.0
+        self._mark_written(doc_ids)
+        self._stats["batches"] += 1
+        return len(doc_ids)
+
+    def _flush_one_by_one(self, batch: list, attempts: dict) -> int:
+        """
+        Send a rejected batch document by document so only the documents
+        Mongo refuses are marked failed. Stops (rest stays pending) on a
+        transient failure.
+        """
+        written = []
+        failed = {}
+
+        for doc_id, payload, _ in batch:
+            try:
+                with get_circuit_breaker("mongo").guard(is_failure=self.is_transient):
+                    self.collection.insert_one(bson.decode(payload))
+            except DuplicateKeyError:
+                # Stored by the batch insert before it failed
+                written.append(doc_id)
+            except CircuitOpenError as e:
+                self._retry_later(e, e.retry_after)
+                break
+            except Exception as e:
+                if self.is_transient(e):
+                    self._retry_later(e)
+                    break
+                failed[doc_id] = e
+            else:
+                written.append(doc_id)
+
+        self._mark_written(written)
+        self._mark_failed(failed, attempts)
+        self._stats["batches"] += 1
+        return len(written)
+
+    def _retry_later(self, error: Exception, delay: float = None):
+        self._backoff = min(max(self._backoff * 2, MONGO_RETRY_BASE_SECONDS), MONGO_RETRY_MAX_SECONDS)
+        delay = self._backoff if delay is None else delay
+        self._resume_at = time.monotonic() + delay
+        self._stats["retries"] += 1
+        print(f"⚠️ Mongo outbox: batch deferred {delay:.1f}s ({type(error).__name__}: {error})")
+
+    def drain(self, timeout: float = 30.0) -> int:
+        """
+        Flush until nothing is due or `timeout` passes; returns the number
+        of documents still pending
+        """
+        give_up = time.monotonic() + timeout
+        while time.monotonic() < give_up and self.flush_once():
+            pass
+
+        with self._lock:
+            return self._pending_count()
+
+    # -------------------------------
+    # Background writer
+    # -------------------------------
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(MONGO_FLUSH_INTERVAL_SECONDS)
+            self._wake.clear()
+            try:
+                while self.flush_once() and not self._stop.is_set():
+                    pass
+            except Exception as e:
+                print(f"❌ Mongo outbox flush failed: {e}")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="mongo-outbox", daemon=True)
+            self._thread.start()
+
+    def close(self, timeout: float = 30.0):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self.drain(timeout)
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["pending"] = self._pending_count()
+        return stats
@@ -1,9 +1,18 @@
 import os
+import re
+import copy
 import json
+import base64
+import threading
 from datetime import datetime, timezone
 from bson import ObjectId
-from pymongo import MongoClient
+import pymongo
+from pymongo import MongoClient, ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import ConnectionFailure, PyMongoError
 from dotenv import load_dotenv
+from pipeline.resilience import get_circuit_breaker, stage_timeout
+from email_and_mongo.mongo_outbox import MongoOutbox
+from pipeline.cassettes import wrap_mongo_collection
 import json
 
 
@@ -15,16 +24,37 @@ load_dotenv()
 MONGO_URI = os.getenv("MONGO_URI")
 DB_NAME = os.getenv("DB_NAME")
 FILE_DETAILS = os.getenv("FILE_DETAILS")  # collection name
+# Raw LLM output of failed extractions, kept out of the main collection
+FILE_DETAILS_DEBUG = os.getenv("FILE_DETAILS_DEBUG", f"{FILE_DETAILS}_debug")
 
 if not all([MONGO_URI, DB_NAME, FILE_DETAILS]):
     raise ValueError("Mongo environment variables not set properly")
 
+# Fail fast when the cluster is unreachable instead of pymongo's 30s default
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "5000"))
+MONGO_WRITE_TIMEOUT_SECONDS = float(os.getenv("MONGO_WRITE_TIMEOUT_SECONDS", "15"))
+
+MONGO_QUERY_TIMEOUT_SECONDS = float(os.getenv("MONGO_QUERY_TIMEOUT_SECONDS", "10"))
+MONGO_MAX_PAGE_SIZE = int(os.getenv("MONGO_MAX_PAGE_SIZE", "500"))
+
+# Create the lookup indexes and backfill older results on first query
+# (idempotent); off when a DBA manages them: python I_trade_finance.py mongo-indexes
+MONGO_ENSURE_INDEXES = os.getenv("MONGO_ENSURE_INDEXES", "1") == "1"
+
+# Queue results in the local outbox and insert them in batches in the
+# background instead of one synchronous insert_one per transaction
+MONGO_ASYNC_WRITES = os.getenv("MONGO_ASYNC_WRITES", "1") == "1"
+
 # -------------------------------------------------------
 # MONGO CLIENT (REUSED)
 # -------------------------------------------------------
-mongo_client = MongoClient(MONGO_URI)
+mongo_client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS)
 db = mongo_client[DB_NAME]
-collection = db[FILE_DETAILS]
+collection = wrap_mongo_collection(db[FILE_DETAILS], "results")
+debug_collection = wrap_mongo_collection(db[FILE_DETAILS_DEBUG], "debug")
+
+# extractedValues stored once, reviewer edits as extractedValuesDelta
+RESULT_SCHEMA_VERSION = 2
 
 
 # -------------------------------------------------------
@@ -54,6 +84,346 @@ def normalize_structured_data(summarized_data):
     # ✅ RETURN AS-IS (NO NORMALIZATION)
     return summarized_data
 
+def is_mongo_dependency_failure(e: Exception) -> bool:
+    """
+    Network errors and timeouts; validation / duplicate key errors are not
+    """
+    return isinstance(e, ConnectionFailure) or (isinstance(e, PyMongoError) and e.timeout)
+
+
+_mongo_outbox = None
+_debug_outbox = None
+_mongo_outbox_lock = threading.Lock()
+
+
+def get_mongo_outbox() -> MongoOutbox:
+    global _mongo_outbox
+    with _mongo_outbox_lock:
+        if _mongo_outbox is None:
+            _mongo_outbox = MongoOutbox(collection, is_transient=is_mongo_dependency_failure)
+            # Also picks up documents left pending by an earlier run
+            _mongo_outbox.start()
+    return _mongo_outbox
+
+
+def get_debug_outbox() -> MongoOutbox:
+    global _debug_outbox
+    with _mongo_outbox_lock:
+        if _debug_outbox is None:
+            _debug_outbox = MongoOutbox(
+                debug_collection,
+                is_transient=is_mongo_dependency_failure,
+                db_path=os.getenv("MONGO_DEBUG_OUTBOX_DB", "mongo_debug_outbox.db")
+            )
+            _debug_outbox.start()
+    return _debug_outbox
+
+
+def _write(document: dict, debug: bool = False):
+    if MONGO_ASYNC_WRITES:
+        (get_debug_outbox() if debug else get_mongo_outbox()).enqueue(document)
+        return
+
+    with get_circuit_breaker("mongo").guard(is_failure=is_mongo_dependency_failure):
+        with pymongo.timeout(stage_timeout(MONGO_WRITE_TIMEOUT_SECONDS, "Mongo write")):
+            (debug_collection if debug else collection).insert_one(document)
+
+
+# -------------------------------------------------------
+# REVIEWER EDITS AS FIELD-LEVEL DELTA
+# A delta is a list of {"path": [...], "value": v} or
+# {"path": [...], "removed": True}; lists are replaced whole
+# -------------------------------------------------------
+_MISSING = object()
+
+
+def compute_extracted_delta(original, updated, path=None) -> list:
+    path = path or []
+
+    if isinstance(original, dict) and isinstance(updated, dict):
+        delta = []
+        for key, value in updated.items():
+            delta.extend(compute_extracted_delta(original.get(key, _MISSING), value, path + [key]))
+        for key in original:
+            if key not in updated:
+                delta.append({"path": path + [key], "removed": True})
+        return delta
+
+    if original is _MISSING or original != updated:
+        return [{"path": path, "value": updated}]
+    return []
+
+
+def apply_extracted_delta(original: dict, delta: list) -> dict:
+    """
+    Reviewed values: a copy of `original` with the delta applied
+    """
+    result = copy.deepcopy(original)
+
+    for change in delta or []:
+        *parents, field = change["path"]
+        target = result
+        for key in parents:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+
+        if change.get("removed"):
+            target.pop(field, None)
+        else:
+            target[field] = copy.deepcopy(change["value"])
+
+    return result
+
+
+def reviewed_values(document: dict) -> dict:
+    """
+    Current (reviewer-edited) values of a stored result, for either
+    storage format
+    """
+    if "updatedExtractedValues" in document:
+        return document["updatedExtractedValues"]
+    return apply_extracted_delta(document["extractedValues"], document.get("extractedValuesDelta"))
+
+
+def store_reviewer_edits(document_id: str, updated_values: dict) -> list:
+    """
+    Save reviewed values as a delta against the stored extractedValues.
+    Returns the delta.
+    """
+    if not isinstance(updated_values, dict):
+        raise ValueError(f"updated_values must be a dict, got {type(updated_values).__name__}")
+
+    with get_circuit_breaker("mongo").guard(is_failure=is_mongo_dependency_failure):
+        with pymongo.timeout(stage_timeout(MONGO_WRITE_TIMEOUT_SECONDS, "Mongo write")):
+            stored = collection.find_one({"_id": ObjectId(document_id)}, {"extractedValues": 1})
+            if stored is None:
+                raise ValueError(f"Trade finance result {document_id} not found")
+
+            delta = compute_extracted_delta(stored["extractedValues"], updated_values)
+            collection.update_one(
+                {"_id": ObjectId(document_id)},
+                {
+                    "$set": {"extractedValuesDelta": delta, "updatedAt": datetime.now(timezone.utc)},
+                    "$unset": {"updatedExtractedValues": ""},
+                }
+            )
+    return delta
+
+
+# -------------------------------------------------------
+# LOOKUP KEYS
+# Reference numbers copied out of extractedValues, normalized so
+# "176-1234 5675" and "17612345675" find the same result
+# -------------------------------------------------------
+LOOKUP_FIELDS = {
+    "lcNumber": "lcNumber",
+    "invoiceNumber": "invoiceNumber",
+    "awbNumber": "awbNumber",
+}
+
+_PLACEHOLDERS = {"", "NA", "NONE", "NULL", "NOTAVAILABLE", "NOTFOUND"}
+
+
+def normalize_reference(value):
+    if value is None or isinstance(value, (dict, list)):
+        return None
+    normalized = re.sub(r"[^0-9A-Z]", "", str(value).upper())
+    return None if normalized in _PLACEHOLDERS else normalized
+
+
+def lookup_keys(extracted_values: dict) -> dict:
+    keys = {}
+    for key, field in LOOKUP_FIELDS.items():
+        value = normalize_reference(extracted_values.get(field))
+        if value:
+            keys[key] = value
+    return keys
+
+
+# -------------------------------------------------------
+# INDEXES
+# Every lookup ends in (createdAt, _id) descending: newest first and
+# keyset pagination served by the index alone
+# -------------------------------------------------------
+RESULT_INDEXES = [
+    ("lookup_lc_number", [("lookupKeys.lcNumber", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)], "lookupKeys.lcNumber"),
+    ("lookup_awb_number", [("lookupKeys.awbNumber", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)], "lookupKeys.awbNumber"),
+    ("lookup_invoice_number", [("lookupKeys.invoiceNumber", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)], "lookupKeys.invoiceNumber"),
+    ("file_name", [("fileName", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)], None),
+    ("processing_status", [("processingStatus", ASCENDING), ("createdAt", DESCENDING), ("_id", DESCENDING)], None),
+    ("created_at", [("createdAt", DESCENDING), ("_id", DESCENDING)], None),
+]
+
+_indexes_ensured = False
+_indexes_lock = threading.Lock()
+
+
+def ensure_indexes(backfill: bool = False) -> list:
+    """
+    Create the lookup indexes if missing. Reference-number indexes are
+    partial: results without that number take no index space.
+
+    backfill=True also runs backfill_lookup_keys before queries are let
+    through: results stored with a string createdAt or without lookupKeys
+    would otherwise be missing from (or break the cursor of) every lookup.
+    """
+    global _indexes_ensured
+    with _indexes_lock:
+        names = []
+        for name, keys, partial_field in RESULT_INDEXES:
+            options = {"name": name, "background": True}
+            if partial_field:
+                options["partialFilterExpression"] = {partial_field: {"$exists": True}}
+            names.append(collection.create_index(keys, **options))
+
+        debug_collection.create_index(
+            [("resultId", ASCENDING)], name="result_id", background=True
+        )
+        if backfill:
+            print(f"🗂️ Backfilled {backfill_lookup_keys()} older result(s)")
+        _indexes_ensured = True
+    return names
+
+
+def backfill_lookup_keys(batch_size: int = 1000) -> int:
+    """
+    Add lookupKeys to older results and turn ISO-string createdAt into
+    dates, so they show up in the indexed queries. Returns updated count.
+    """
+    updated = 0
+    pending = []
+
+    query = {"$or": [{"lookupKeys": {"$exists": False}}, {"createdAt": {"$type": "string"}}]}
+    for document in collection.find(query, {"extractedValues": 1, "createdAt": 1}):
+        changes = {"lookupKeys": lookup_keys(document.get("extractedValues") or {})}
+        if isinstance(document.get("createdAt"), str):
+            changes["createdAt"] = datetime.fromisoformat(document["createdAt"])
+        pending.append(UpdateOne({"_id": document["_id"]}, {"$set": changes}))
+
+        if len(pending) >= batch_size:
+            updated += collection.bulk_write(pending, ordered=False).modified_count
+            pending = []
+
+    if pending:
+        updated += collection.bulk_write(pending, ordered=False).modified_count
+    return updated
+
+
+# -------------------------------------------------------
+# QUERY API
+# -------------------------------------------------------
+DEFAULT_RESULT_PROJECTION = {
+    "fileName": 1,
+    "originalFile": 1,
+    "status": 1,
+    "processingStatus": 1,
+    "lookupKeys": 1,
+    "extractedValues.overallStatus": 1,
+    "createdAt": 1,
+}
+
+
+def _encode_cursor(document: dict) -> str:
+    token = f"{document['createdAt'].isoformat()}|{document['_id']}"
+    return base64.urlsafe_b64encode(token.encode()).decode()
+
+
+def _decode_cursor(cursor: str):
+    created_at, document_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return datetime.fromisoformat(created_at), ObjectId(document_id)
+
+
+def find_results(
+    lc_number: str = None,
+    awb_number: str = None,
+    invoice_number: str = None,
+    file_name: str = None,
+    processing_status: str = None,
+    created_from: datetime = None,
+    created_to: datetime = None,
+    projection: dict = DEFAULT_RESULT_PROJECTION,
+    limit: int = 50,
+    cursor: str = None
+) -> dict:
+    """
+    Stored results, newest first, filtered by any combination of the
+    arguments. projection=None returns whole documents.
+
+    Returns {"results": [...], "next_cursor": str | None}; pass
+    next_cursor back as `cursor` for the next page. Pages are keyset
+    based ((createdAt, _id) < last seen), so deep pages cost the same
+    as the first one.
+    """
+    if MONGO_ENSURE_INDEXES and not _indexes_ensured:
+        ensure_indexes(backfill=True)
+
+    query = {}
+    for key, value in (("lcNumber", lc_number), ("awbNumber", awb_number), ("invoiceNumber", invoice_number)):
+        if value is not None:
+            normalized = normalize_reference(value)
+            # "N/A", "" etc. are never stored as lookup keys; querying for
+            # None would match (and scan) every result without the key
+            if normalized is None:
+                return {"results": [], "next_cursor": None}
+            query[f"lookupKeys.{key}"] = normalized
+    if file_name is not None:
+        query["fileName"] = file_name
+    if processing_status is not None:
+        query["processingStatus"] = processing_status
+
+    if created_from or created_to:
+        query["createdAt"] = {}
+        if created_from:
+            query["createdAt"]["$gte"] = created_from
+        if created_to:
+            query["createdAt"]["$lt"] = created_to
+
+    if cursor:
+        last_created_at, last_id = _decode_cursor(cursor)
+        query = {"$and": [query, {"$or": [
+            {"createdAt": {"$lt": last_created_at}},
+            {"createdAt": last_created_at, "_id": {"$lt": last_id}},
+        ]}]}
+
+    if projection is not None:
+        # The cursor needs both sort keys
+        projection = {**projection, "createdAt": 1}
+
+    limit = max(1, min(limit, MONGO_MAX_PAGE_SIZE))
+
+    with get_circuit_breaker("mongo").guard(is_failure=is_mongo_dependency_failure):
+        with pymongo.timeout(stage_timeout(MONGO_QUERY_TIMEOUT_SECONDS, "Mongo query")):
+            results = list(
+                collection.find(query, projection)
+                .sort([("createdAt", DESCENDING), ("_id", DESCENDING)])
+                .limit(limit + 1)
+            )
+
+    next_cursor = _encode_cursor(results[limit - 1]) if len(results) > limit else None
+    return {"results": results[:limit], "next_cursor": next_cursor}
+
+
+def find_by_lc_number(lc_number: str, **kwargs) -> dict:
+    return find_results(lc_number=lc_number, **kwargs)
+
+
+def find_by_awb_number(awb_number: str, **kwargs) -> dict:
+    return find_results(awb_number=awb_number, **kwargs)
+
+
+def find_by_invoice_number(invoice_number: str, **kwargs) -> dict:
+    return find_results(invoice_number=invoice_number, **kwargs)
+
+
+def find_by_date_window(created_from: datetime, created_to: datetime, **kwargs) -> dict:
+    return find_results(created_from=created_from, created_to=created_to, **kwargs)
+
+
+def find_by_status(processing_status: str, **kwargs) -> dict:
+    return find_results(processing_status=processing_status, **kwargs)
+
+
 # -------------------------------------------------------
 # MAIN STORE FUNCTION
 # -------------------------------------------------------
@@ -62,7 +432,8 @@ def store_trade_finance_result(
     object_url: str,
     filename: str,
     original_s3_file: str,
-    email_text: str = ""
+    email_text: str = "",
+    debug_payloads: list = None
 ):
     """
     Stores final trade finance extracted results into MongoDB
@@ -73,6 +444,8 @@ def store_trade_finance_result(
     - filename          : merged PDF filename
     - original_s3_file  : original uploaded S3 path
     - email_text        : optional email body text
+    - debug_payloads    : optional raw LLM outputs, stored in the debug
+                          collection with a reference to this result
     """
 
     normalized_data = normalize_structured_data(
@@ -93,18 +466,29 @@ def store_trade_finance_result(
         "originalFile": object_url,
         "originalS3File": original_s3_file,
 
-        # 🧾 Extracted data
+        # 🧾 Extracted data (reviewer edits go to extractedValuesDelta,
+        # see reviewed_values)
         "extractedValues": normalized_data,
-        "updatedExtractedValues": normalized_data,
+        "extractedValuesDelta": [],
+        "lookupKeys": lookup_keys(normalized_data),
+        "schemaVersion": RESULT_SCHEMA_VERSION,
 
         # 💳 Credits (future)
         "credits": None,
 
         # ⏱ Audit
-        "createdAt": datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+        "createdAt": datetime.now(timezone.utc)
     }
 
-    collection.insert_one(document)
+    _write(document)
     print('_id',str(document["_id"]))
+
+    for payload in debug_payloads or []:
+        _write({
+            "_id": ObjectId(),
+            "resultId": document["_id"],
+            "createdAt": document["createdAt"],
+            **payload
+        }, debug=True)
     
     return str(document["_id"])
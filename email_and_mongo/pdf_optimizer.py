@@ -0,0 +1,87 @@
+import io
+from PyPDF2 import PdfReader, PdfWriter
+
+# Optional: pip install pymupdf (object de-duplication, unused-object removal)
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+
+def _optimize_with_pymupdf(payload: bytes) -> bytes:
+    document = pymupdf.open(stream=payload, filetype="pdf")
+    try:
+        options = dict(
+            garbage=4,      # drop unused objects, merge identical ones (fonts, images, ICC)
+            deflate=True,   # compress streams stored uncompressed
+            clean=True,     # rewrite content streams compactly
+        )
+        try:
+            return document.tobytes(use_objstms=1, **options)
+        except TypeError:
+            # PyMuPDF < 1.24 has no object streams
+            return document.tobytes(**options)
+    finally:
+        document.close()
+
+
+def _optimize_with_pypdf2(payload: bytes) -> bytes:
+    reader = PdfReader(io.BytesIO(payload))
+
+    # Whole document, not just its pages: append() carries the outline,
+    # the document info is copied over (PyPDF2 has no clone_from, that
+    # only exists in its successor pypdf)
+    writer = PdfWriter()
+    writer.append(reader, import_outline=True)
+    if reader.metadata:
+        writer.add_metadata(reader.metadata)
+
+    for page in writer.pages:
+        page.compress_content_streams()
+
+    out = io.BytesIO()
+    writer.write(out)
+    return out.getvalue()
+
+
+def is_available() -> bool:
+    """
+    True when PyMuPDF is installed; without it optimize_pdf only
+    compresses page content streams (no object de-duplication)
+    """
+    return pymupdf is not None
+
+
+def optimize_pdf(payload: bytes):
+    """
+    Shrink a merged PDF without touching its rendering.
+
+    With PyMuPDF: identical objects from the merged sources (fonts, images,
+    ICC profiles) are stored once, unused objects dropped and uncompressed
+    streams deflated. Without it only page content streams are compressed.
+
+    Returns (optimized_bytes, stats); the input is returned unchanged when
+    optimizing fails or does not make it smaller.
+    """
+    stats = {
+        "engine": "pymupdf" if pymupdf is not None else "pypdf2",
+        "original_bytes": len(payload),
+        "optimized_bytes": len(payload),
+        "bytes_saved": 0,
+    }
+
+    try:
+        optimized = _optimize_with_pymupdf(payload) if pymupdf is not None else _optimize_with_pypdf2(payload)
+    except Exception as e:
+        print(f"⚠️ PDF optimization skipped: {e}")
+        return payload, stats
+
+    if len(optimized) >= len(payload):
+        return payload, stats
+
+    stats["optimized_bytes"] = len(optimized)
+    stats["bytes_saved"] = len(payload) - len(optimized)
+    return optimized, stats
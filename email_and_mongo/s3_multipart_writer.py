@@ -0,0 +1,176 @@
+import os
+import io
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# S3 minimum for every part but the last is 5 MiB
+S3_PART_SIZE = max(int(os.getenv("S3_PART_SIZE_MB", "8")), 5) * 1024 * 1024
+S3_UPLOAD_CONCURRENCY = int(os.getenv("S3_UPLOAD_CONCURRENCY", "4"))
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Write-only file object that streams into an S3 object.
+
+    Bytes are buffered in memory up to one part; each full part is sent with
+    upload_part while writing continues, at most `concurrency` parts in
+    flight. close() uploads the tail and completes the upload. Objects that
+    never fill a part are sent with one put_object. Any exception inside
+    `with S3MultipartWriter(...)` aborts the multipart upload.
+
+    `local_copy_path` optionally tees the same bytes to a local file.
+    """
+
+    def __init__(
+        self,
+        s3,
+        bucket: str,
+        key: str,
+        content_type: str = "application/octet-stream",
+        metadata: dict = None,
+        part_size: int = None,
+        concurrency: int = None,
+        local_copy_path: str = None
+    ):
+        super().__init__()
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.content_type = content_type
+        self.metadata = metadata or {}
+        self.part_size = part_size or S3_PART_SIZE
+        self.concurrency = concurrency or S3_UPLOAD_CONCURRENCY
+
+        self._buffer = io.BytesIO()
+        self._position = 0
+        self._upload_id = None
+        self._parts = []
+        self._in_flight = set()
+        self._executor = None
+        self._local = open(local_copy_path, "wb") if local_copy_path else None
+
+        self.etag = None
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._buffer.write(data)
+        self._position += len(data)
+
+        if self._local:
+            self._local.write(data)
+
+        if self._buffer.tell() >= self.part_size:
+            self._flush_part()
+
+        return len(data)
+
+    # -------------------------------
+    # Multipart
+    # -------------------------------
+    def _upload_part(self, part_number: int, body: bytes) -> dict:
+        response = self.s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def _collect(self, futures):
+        for future in futures:
+            self._parts.append(future.result())
+
+    def _flush_part(self):
+        body = self._buffer.getvalue()
+        self._buffer = io.BytesIO()
+
+        if self._upload_id is None:
+            self._upload_id = self.s3.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                ContentType=self.content_type,
+                Metadata=self.metadata,
+            )["UploadId"]
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="s3-part"
+            )
+
+        # Bound memory: wait for a slot before queuing another part
+        while len(self._in_flight) >= self.concurrency:
+            done, self._in_flight = wait(self._in_flight, return_when=FIRST_COMPLETED)
+            self._collect(done)
+
+        part_number = len(self._parts) + len(self._in_flight) + 1
+        self._in_flight.add(self._executor.submit(self._upload_part, part_number, body))
+
+    def close(self):
+        if self.closed:
+            return
+
+        try:
+            if self._upload_id is None:
+                response = self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Body=self._buffer.getvalue(),
+                    ContentType=self.content_type,
+                    Metadata=self.metadata,
+                )
+                self.etag = response.get("ETag")
+            else:
+                if self._buffer.tell():
+                    self._flush_part()
+
+                done, _ = wait(self._in_flight)
+                self._in_flight = set()
+                self._collect(done)
+
+                response = self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": sorted(self._parts, key=lambda part: part["PartNumber"])},
+                )
+                self.etag = response.get("ETag")
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self._shutdown()
+            super().close()
+
+    def abort(self):
+        if self._upload_id is not None:
+            for future in self._in_flight:
+                future.cancel()
+            try:
+                self.s3.abort_multipart_upload(
+                    Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+                )
+            except Exception as e:
+                print(f"⚠️ Could not abort multipart upload of {self.key}: {e}")
+            self._upload_id = None
+
+    def _shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._local:
+            self._local.close()
+            self._local = None
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+            self._shutdown()
+            super().close()
+            return False
+        self.close()
+        return False
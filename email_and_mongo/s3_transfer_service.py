@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError
+from pipeline.resilience import get_circuit_breaker, current_deadline
+from pipeline.cassettes import wrap_s3_client
+from pipeline.telemetry import metrics, add_to_span
+from email_and_mongo.s3_multipart_writer import (
+    S3MultipartWriter, S3_PART_SIZE, S3_UPLOAD_CONCURRENCY
+)
+
+
+S3_CONNECT_TIMEOUT_SECONDS = float(os.getenv("S3_CONNECT_TIMEOUT_SECONDS", "10"))
+S3_READ_TIMEOUT_SECONDS = float(os.getenv("S3_READ_TIMEOUT_SECONDS", "60"))
+S3_MAX_ATTEMPTS = int(os.getenv("S3_MAX_ATTEMPTS", "3"))
+
+# Files above the threshold go multipart: S3_PART_SIZE_MB chunks,
+# S3_UPLOAD_CONCURRENCY in parallel (shared with the streaming writer)
+S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD_MB", "8")) * 1024 * 1024
+
+# HTTP connections kept open per client; covers concurrent transactions
+# times their part uploads
+S3_MAX_POOL_CONNECTIONS = int(os.getenv("S3_MAX_POOL_CONNECTIONS", "32"))
+
+# Local S3-compatible stand-in (MinIO, moto server, ...); empty for AWS
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL") or None
+
+S3_CALL_SECONDS = metrics.histogram("s3_call_duration_seconds", "S3 call latency per operation")
+S3_BYTES = metrics.counter("s3_bytes_total", "Bytes sent to S3 per operation")
+
+
+def is_s3_dependency_failure(e: Exception) -> bool:
+    """
+    Only throttling, 5xx and connection / timeout errors say S3 is
+    unhealthy; 4xx client errors (bad bucket, denied) and anything raised
+    by our own code (e.g. an unreadable PDF while merging) do not
+    """
+    if isinstance(e, (EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError)):
+        return True
+    if isinstance(e, ClientError):
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 500)
+        return status >= 500 or status == 429
+    return False
+
+
+class _GuardedS3Client:
+    """
+    Client handed to S3MultipartWriter: each request (create / upload_part /
+    complete / abort / put_object) runs under the "s3" breaker on its own,
+    so the caller's code between writes never counts against S3
+    """
+
+    def __init__(self, service):
+        self._service = service
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            # An abort must still go out after the deadline has passed
+            what = "" if operation == "abort_multipart_upload" else f"S3 {operation}"
+            with self._service._call(operation, what):
+                return getattr(self._service.client, operation)(**kwargs)
+        return call
+
+
+class S3TransferService:
+    """
+    One S3 client (thread-safe, pooled connections) and transfer config per
+    credentials, shared by every transaction in the process. All calls go
+    through the "s3" circuit breaker and are counted in stats().
+    """
+
+    def __init__(
+        self,
+        aws_access_key: str = "",
+        aws_secret_key: str = "",
+        aws_region: str = "ap-south-1",
+        endpoint_url: str = None
+    ):
+        self.aws_region = aws_region
+        self.endpoint_url = endpoint_url or S3_ENDPOINT_URL
+
+        session = boto3.session.Session(
+            aws_access_key_id=aws_access_key or None,
+            aws_secret_access_key=aws_secret_key or None,
+            region_name=aws_region,
+        )
+        self.client = wrap_s3_client(session.client(
+            "s3",
+            endpoint_url=self.endpoint_url,
+            config=Config(
+                connect_timeout=S3_CONNECT_TIMEOUT_SECONDS,
+                read_timeout=S3_READ_TIMEOUT_SECONDS,
+                retries={"max_attempts": S3_MAX_ATTEMPTS, "mode": "standard"},
+                max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+            ),
+        ))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=S3_PART_SIZE,
+            max_concurrency=S3_UPLOAD_CONCURRENCY,
+            use_threads=True,
+        )
+
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    # -------------------------------
+    # Metrics
+    # -------------------------------
+    def _record(self, operation: str, started: float, size: int = 0, error: bool = False):
+        with self._lock:
+            stats = self._stats.setdefault(
+                operation, {"calls": 0, "errors": 0, "bytes": 0, "seconds": 0.0}
+            )
+            stats["calls"] += 1
+            stats["errors"] += int(error)
+            stats["bytes"] += size
+            stats["seconds"] += time.monotonic() - started
+
+        S3_CALL_SECONDS.observe(time.monotonic() - started, operation=operation, status="error" if error else "ok")
+        if size:
+            S3_BYTES.inc(size, operation=operation)
+            add_to_span(s3_bytes=size)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {operation: dict(values) for operation, values in self._stats.items()}
+
+        for values in stats.values():
+            values["seconds"] = round(values["seconds"], 3)
+            if values["bytes"] and values["seconds"]:
+                values["mb_per_second"] = round(values["bytes"] / values["seconds"] / (1024 * 1024), 2)
+        return stats
+
+    @contextmanager
+    def _call(self, operation: str, what: str):
+        deadline = current_deadline()
+        if deadline is not None and what:
+            deadline.check(what)
+
+        started = time.monotonic()
+        call = {"bytes": 0}
+        try:
+            with get_circuit_breaker("s3").guard(is_failure=is_s3_dependency_failure):
+                yield call
+        except Exception:
+            self._record(operation, started, error=True)
+            raise
+        self._record(operation, started, call["bytes"])
+
+    # -------------------------------
+    # Operations
+    # -------------------------------
+    def upload_file(self, file_path: str, bucket: str, key: str, extra_args: dict = None):
+        with self._call("upload_file", "S3 upload") as call:
+            self.client.upload_file(
+                file_path, bucket, key,
+                ExtraArgs=extra_args or None,
+                Config=self.transfer_config
+            )
+            call["bytes"] = os.path.getsize(file_path)
+
+    def head_object(self, bucket: str, key: str):
+        """
+        Object metadata, or None when the key does not exist
+        """
+        with self._call("head_object", "S3 head"):
+            try:
+                return self.client.head_object(Bucket=bucket, Key=key)
+            except ClientError as e:
+                # Missing keys answer 404, or 403 without s3:ListBucket
+                if e.response.get("ResponseMetadata", {}).get("HTTPStatusCode") in (403, 404):
+                    return None
+                raise
+
+    @contextmanager
+    def open_writer(
+        self,
+        bucket: str,
+        key: str,
+        content_type: str = "application/octet-stream",
+        metadata: dict = None,
+        local_copy_path: str = None
+    ):
+        """
+        S3MultipartWriter on the pooled client; the upload completes when
+        the block exits and is aborted if it raises. Only the S3 requests
+        go through the breaker, not the code writing into the block.
+        """
+        deadline = current_deadline()
+        if deadline is not None:
+            deadline.check("S3 upload")
+
+        started = time.monotonic()
+        try:
+            with S3MultipartWriter(
+                _GuardedS3Client(self), bucket, key,
+                content_type=content_type,
+                metadata=metadata,
+                part_size=self.transfer_config.multipart_chunksize,
+                concurrency=self.transfer_config.max_concurrency,
+                local_copy_path=local_copy_path
+            ) as writer:
+                yield writer
+        except Exception:
+            self._record("stream_upload", started, error=True)
+            raise
+        # Bytes are counted once here, not per part request
+        self._record("stream_upload", started, writer.tell())
+
+    def object_url(self, bucket: str, key: str) -> str:
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{bucket}/{key}"
+        return f"https://{bucket}.s3.{self.aws_region}.amazonaws.com/{key}"
+
+
+_transfer_services = {}
+_transfer_services_lock = threading.Lock()
+
+
+def get_s3_transfer_service(
+    aws_access_key: str = "",
+    aws_secret_key: str = "",
+    aws_region: str = "ap-south-1"
+) -> S3TransferService:
+    key = (aws_access_key, aws_secret_key, aws_region)
+    with _transfer_services_lock:
+        if key not in _transfer_services:
+            _transfer_services[key] = S3TransferService(aws_access_key, aws_secret_key, aws_region)
+        return _transfer_services[key]
+
+
+def s3_transfer_stats() -> dict:
+    with _transfer_services_lock:
+        services = list(_transfer_services.values())
+
+    stats = {}
+    for service in services:
+        for operation, values in service.stats().items():
+            merged = stats.setdefault(operation, {"calls": 0, "errors": 0, "bytes": 0, "seconds": 0.0})
+            for field in ("calls", "errors", "bytes", "seconds"):
+                merged[field] += values[field]
+
+    for values in stats.values():
+        values["seconds"] = round(values["seconds"], 3)
+    return stats
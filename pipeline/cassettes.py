@@ -0,0 +1,574 @@
+import os
+import io
+import json
+import time
+import types
+import atexit
+import hashlib
+import importlib
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from bson import json_util
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# off | record | replay
+CASSETTE_MODE = os.getenv("CASSETTE_MODE", "off").lower()
+CASSETTE_PATH = os.getenv("CASSETTE_PATH", "cassettes/pipeline.json")
+
+# Replay sleeps for the recorded duration of every call
+CASSETTE_REPLAY_LATENCY = os.getenv("CASSETTE_REPLAY_LATENCY", "1") == "1"
+
+CASSETTE_FORMAT_VERSION = 1
+
+# Mongo operations whose requests carry generated ids (ObjectIds,
+# createdAt): replayed in recorded order when the key does not match
+ORDER_MATCHED_MONGO_OPERATIONS = {"insert_one", "insert_many"}
+
+
+class CassetteMiss(LookupError):
+    """
+    Replay found no recorded interaction for a call
+    """
+
+
+# -------------------------------------------------------
+# ENCODING
+# JSON with bson.json_util for bytes / datetimes / ObjectIds; tuples
+# are kept apart from lists (imaplib answers mix both)
+# -------------------------------------------------------
+def _mark_tuples(value):
+    if isinstance(value, tuple):
+        return {"$tuple": [_mark_tuples(item) for item in value]}
+    if isinstance(value, list):
+        return [_mark_tuples(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _mark_tuples(item) for key, item in value.items()}
+    return value
+
+
+def _object_hook(value: dict):
+    if "$tuple" in value and len(value) == 1:
+        return tuple(value["$tuple"])
+    return json_util.object_hook(value)
+
+
+def encode_value(value):
+    return json.loads(json.dumps(_mark_tuples(value), default=json_util.default))
+
+
+def decode_value(value):
+    return json.loads(json.dumps(value), object_hook=_object_hook)
+
+
+def _namespace_to_dict(value):
+    if isinstance(value, types.SimpleNamespace):
+        return {key: _namespace_to_dict(item) for key, item in vars(value).items()}
+    if isinstance(value, list):
+        return [_namespace_to_dict(item) for item in value]
+    return value
+
+
+def _dict_to_namespace(value):
+    if isinstance(value, dict):
+        return types.SimpleNamespace(**{key: _dict_to_namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_dict_to_namespace(item) for item in value]
+    return value
+
+
+def _key_default(value):
+    try:
+        return json_util.default(value)
+    except TypeError:
+        return repr(value)      # e.g. pymongo UpdateOne
+
+
+def request_key(*parts) -> str:
+    canonical = json.dumps(_mark_tuples(list(parts)), sort_keys=True, default=_key_default)
+    return hashlib.sha256(canonical.encode()).hexdigest()[:32]
+
+
+def _encode_error(e: Exception) -> dict:
+    error = {"type": f"{type(e).__module__}.{type(e).__qualname__}", "message": str(e)}
+    if hasattr(e, "response") and isinstance(getattr(e, "response"), dict):
+        error["response"] = encode_value(e.response)              # botocore ClientError
+        error["operation"] = getattr(e, "operation_name", None)
+    if isinstance(getattr(e, "details", None), dict):
+        error["details"] = encode_value(e.details)                # pymongo BulkWriteError
+    return error
+
+
+def _decode_error(error: dict) -> Exception:
+    module_name, _, class_name = error["type"].rpartition(".")
+    try:
+        cls = getattr(importlib.import_module(module_name), class_name)
+    except (ImportError, AttributeError):
+        return RuntimeError(f"{error['type']}: {error['message']}")
+
+    if "response" in error:
+        return cls(decode_value(error["response"]), error.get("operation"))
+    if "details" in error:
+        return cls(decode_value(error["details"]))
+
+    # SDK errors want request / response objects in __init__; callers
+    # only look at the type and message
+    e = cls.__new__(cls)
+    Exception.__init__(e, error["message"])
+    return e
+
+
+# -------------------------------------------------------
+# CASSETTE
+# -------------------------------------------------------
+class Cassette:
+    """
+    Versioned JSON file of external calls: per interaction the channel
+    (azure_di, chat, imap, s3, mongo), operation, request key, duration
+    and the encoded response or error.
+
+    Replay serves an interaction with the same (channel, operation, key);
+    anything else raises CassetteMiss. Only Mongo inserts, whose keys
+    embed generated ids, fall back to the next unused interaction of the
+    same operation (counted in `substitutions`). Each interaction is
+    served once, in recorded order.
+    """
+
+    def __init__(self, path: str, mode: str):
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._interactions = []
+        self._by_key = {}
+        self._by_operation = {}
+        self._saved_count = None
+        self.substitutions = 0
+
+        if mode == "replay":
+            self._load()
+
+    def _load(self):
+        with open(self.path) as f:
+            data = json.load(f)
+
+        if data.get("version") != CASSETTE_FORMAT_VERSION:
+            raise ValueError(
+                f"Cassette {self.path} has format version {data.get('version')}, "
+                f"expected {CASSETTE_FORMAT_VERSION}; record it again"
+            )
+
+        for interaction in data["interactions"]:
+            interaction["used"] = False
+            operation = (interaction["channel"], interaction["operation"])
+            self._by_key.setdefault(operation + (interaction["key"],), deque()).append(interaction)
+            self._by_operation.setdefault(operation, deque()).append(interaction)
+
+        print(f"📼 Replaying {len(data['interactions'])} interaction(s) from {self.path}")
+
+    def save(self):
+        if self.mode != "record":
+            return
+
+        with self._lock:
+            if self._saved_count == len(self._interactions):
+                return
+            self._saved_count = len(self._interactions)
+            data = {
+                "version": CASSETTE_FORMAT_VERSION,
+                "recorded_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "interactions": list(self._interactions),
+            }
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, self.path)
+        print(f"📼 Recorded {len(data['interactions'])} interaction(s) to {self.path}")
+
+    # -------------------------------
+    # Record
+    # -------------------------------
+    def _append(self, channel, operation, key, seconds, outcome: dict):
+        with self._lock:
+            self._interactions.append({
+                "channel": channel,
+                "operation": operation,
+                "key": key,
+                "seconds": round(seconds, 4),
+                **outcome,
+            })
+
+    def call(self, channel: str, operation: str, key: str, fn, encode=encode_value, decode=decode_value):
+        """
+        Run fn() (record / off) or serve its recorded outcome (replay)
+        """
+        if self.mode == "replay":
+            return self.replay(channel, operation, key, decode)
+
+        started = time.monotonic()
+        try:
+            result = fn()
+        except Exception as e:
+            if self.mode == "record":
+                self._append(channel, operation, key, time.monotonic() - started, {"error": _encode_error(e)})
+            raise
+
+        if self.mode == "record":
+            self._append(channel, operation, key, time.monotonic() - started, {"response": encode(result)})
+        return result
+
+    # -------------------------------
+    # Replay
+    # -------------------------------
+    def take(self, channel: str, operation: str, key: str) -> dict:
+        order_matched = channel == "mongo" and operation.rsplit(".", 1)[-1] in ORDER_MATCHED_MONGO_OPERATIONS
+
+        with self._lock:
+            interaction = self._next_unused(self._by_key.get((channel, operation, key)))
+            if interaction is None and order_matched:
+                interaction = self._next_unused(self._by_operation.get((channel, operation)))
+                if interaction is not None:
+                    self.substitutions += 1
+                    print(f"📼 {channel}.{operation}: no exact match, replaying the next recorded call")
+
+        if interaction is None:
+            raise CassetteMiss(f"No recorded {channel}.{operation} left in {self.path} for key {key}")
+        return interaction
+
+    @staticmethod
+    def _next_unused(candidates):
+        while candidates:
+            interaction = candidates.popleft()
+            if not interaction["used"]:
+                interaction["used"] = True
+                return interaction
+        return None
+
+    def replay(self, channel: str, operation: str, key: str, decode=decode_value, sleep: bool = True):
+        interaction = self.take(channel, operation, key)
+
+        if sleep and CASSETTE_REPLAY_LATENCY:
+            time.sleep(interaction["seconds"])
+
+        if "error" in interaction:
+            raise _decode_error(interaction["error"])
+        return decode(interaction["response"])
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+
+def get_cassette():
+    """
+    The process cassette, or None with CASSETTE_MODE=off
+    """
+    global _cassette
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette(CASSETTE_PATH, CASSETTE_MODE)
+            if CASSETTE_MODE == "record":
+                atexit.register(_cassette.save)
+    return _cassette
+
+
+def save_cassette():
+    if _cassette is not None:
+        _cassette.save()
+
+
+# -------------------------------------------------------
+# AZURE DOCUMENT INTELLIGENCE
+# -------------------------------------------------------
+def _encode_analyze_result(result) -> dict:
+    if hasattr(result, "as_dict"):
+        return {"format": "azure", "result": encode_value(result.as_dict())}
+    return {"format": "namespace", "result": encode_value(_namespace_to_dict(result))}
+
+
+def _decode_analyze_result(data: dict):
+    if data["format"] == "azure":
+        from azure.ai.documentintelligence.models import AnalyzeResult
+        return AnalyzeResult(decode_value(data["result"]))
+    return _dict_to_namespace(decode_value(data["result"]))
+
+
+class _RecordedPoller:
+    def __init__(self, cassette, key: str, poller):
+        self._cassette = cassette
+        self._key = key
+        self._poller = poller
+        self._started = time.monotonic()
+
+    def result(self, timeout: float = None):
+        # Timed from begin_analyze_document, like the service call
+        try:
+            result = self._poller.result(timeout=timeout)
+        except Exception as e:
+            self._cassette._append("azure_di", "analyze", self._key, time.monotonic() - self._started, {"error": _encode_error(e)})
+            raise
+
+        # Not finished within the caller's timeout: nothing to record yet
+        if self._poller.done():
+            self._cassette._append("azure_di", "analyze", self._key, time.monotonic() - self._started, {"response": _encode_analyze_result(result)})
+        return result
+
+    def done(self) -> bool:
+        return self._poller.done()
+
+
+class _ReplayedPoller:
+    def __init__(self, interaction: dict):
+        self._interaction = interaction
+        self._ready_at = time.monotonic() + (interaction["seconds"] if CASSETTE_REPLAY_LATENCY else 0)
+
+    def result(self, timeout: float = None):
+        wait = self._ready_at - time.monotonic()
+        if timeout is not None:
+            wait = min(wait, timeout)
+        if wait > 0:
+            time.sleep(wait)
+
+        if "error" in self._interaction:
+            raise _decode_error(self._interaction["error"])
+        return _decode_analyze_result(self._interaction["response"])
+
+    def done(self) -> bool:
+        return time.monotonic() >= self._ready_at
+
+
+class _DocumentIntelligenceProxy:
+    def __init__(self, client, cassette):
+        self._client = client
+        self._cassette = cassette
+
+    def begin_analyze_document(self, model_id: str = None, body=None, **kwargs):
+        payload = body.read() if hasattr(body, "read") else body
+        key = request_key(model_id, hashlib.sha256(payload).hexdigest())
+
+        if self._cassette.mode == "replay":
+            return _ReplayedPoller(self._cassette.take("azure_di", "analyze", key))
+
+        poller = self._client.begin_analyze_document(model_id=model_id, body=io.BytesIO(payload), **kwargs)
+        return _RecordedPoller(self._cassette, key, poller)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def wrap_document_intelligence(client):
+    cassette = get_cassette()
+    return _DocumentIntelligenceProxy(client, cassette) if cassette else client
+
+
+# -------------------------------------------------------
+# AZURE OPENAI CHAT
+# -------------------------------------------------------
+def _encode_completion(response) -> dict:
+    usage = getattr(response, "usage", None)
+    return {
+        "model": getattr(response, "model", None),
+        "contents": [choice.message.content for choice in response.choices],
+        "usage": {
+            field: getattr(usage, field, None)
+            for field in ("prompt_tokens", "completion_tokens", "total_tokens")
+        } if usage is not None else None,
+    }
+
+
+def _decode_completion(data: dict):
+    usage = data.get("usage")
+    return types.SimpleNamespace(
+        model=data.get("model"),
+        choices=[types.SimpleNamespace(message=types.SimpleNamespace(content=content)) for content in data["contents"]],
+        usage=types.SimpleNamespace(**usage) if usage else None,
+    )
+
+
+class _CompletionsProxy:
+    def __init__(self, completions, cassette):
+        self._completions = completions
+        self._cassette = cassette
+
+    def create(self, **kwargs):
+        # Deployment and timeout depend on router state, not on the request
+        key = request_key(kwargs.get("messages"), kwargs.get("temperature"))
+        return self._cassette.call(
+            "chat", "completion", key,
+            lambda: self._completions.create(**kwargs),
+            encode=_encode_completion, decode=_decode_completion
+        )
+
+
+class _ChatClientProxy:
+    def __init__(self, client, cassette):
+        self._client = client
+        self.chat = types.SimpleNamespace(completions=_CompletionsProxy(client.chat.completions, cassette))
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+def wrap_chat_client(client):
+    cassette = get_cassette()
+    return _ChatClientProxy(client, cassette) if cassette else client
+
+
+# -------------------------------------------------------
+# IMAP
+# -------------------------------------------------------
+class _IMAPProxy:
+    """
+    Records / replays every method call of an imaplib connection
+    """
+
+    def __init__(self, connection, cassette):
+        self._connection = connection
+        self._cassette = cassette
+
+    def __getattr__(self, name):
+        def call(*args):
+            return self._cassette.call(
+                "imap", name, request_key(name, args),
+                lambda: getattr(self._connection, name)(*args)
+            )
+        return call
+
+
+def open_imap(connect):
+    """
+    connect() opens the real connection; not called in replay mode
+    """
+    cassette = get_cassette()
+    if not cassette:
+        return connect()
+
+    connection = cassette.call("imap", "connect", "", connect, encode=lambda _: None, decode=lambda _: None)
+    return _IMAPProxy(connection, cassette)
+
+
+# -------------------------------------------------------
+# S3
+# -------------------------------------------------------
+class _S3Proxy:
+    """
+    boto3 S3 client whose calls are recorded / replayed; request bodies
+    are matched by size, not stored
+    """
+
+    def __init__(self, client, cassette):
+        self._client = client
+        self._cassette = cassette
+
+    def _call(self, operation: str, key_parts: tuple, fn):
+        return self._cassette.call("s3", operation, request_key(*key_parts), fn)
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        return self._call(
+            "upload_file", (Bucket, Key, os.path.getsize(Filename)),
+            lambda: self._client.upload_file(Filename, Bucket, Key, ExtraArgs=ExtraArgs, Callback=Callback, Config=Config)
+        )
+
+    def __getattr__(self, operation):
+        def call(**kwargs):
+            body = kwargs.get("Body")
+            key_parts = (kwargs.get("Bucket"), kwargs.get("Key"), kwargs.get("PartNumber"), len(body) if body is not None else None)
+            return self._call(operation, key_parts, lambda: getattr(self._client, operation)(**kwargs))
+        return call
+
+
+def wrap_s3_client(client):
+    cassette = get_cassette()
+    return _S3Proxy(client, cassette) if cassette else client
+
+
+# -------------------------------------------------------
+# MONGO
+# -------------------------------------------------------
+class _CursorProxy:
+    def __init__(self, collection_proxy, args: tuple, kwargs: dict):
+        self._proxy = collection_proxy
+        self._args = args
+        self._kwargs = kwargs
+        self._chain = []
+
+    def sort(self, *args, **kwargs):
+        self._chain.append(("sort", args, kwargs))
+        return self
+
+    def limit(self, *args):
+        self._chain.append(("limit", args, {}))
+        return self
+
+    def skip(self, *args):
+        self._chain.append(("skip", args, {}))
+        return self
+
+    def _fetch(self):
+        def run():
+            cursor = self._proxy._collection.find(*self._args, **self._kwargs)
+            for name, args, kwargs in self._chain:
+                cursor = getattr(cursor, name)(*args, **kwargs)
+            return list(cursor)
+
+        key = request_key(self._args, self._kwargs, self._chain)
+        return self._proxy._cassette.call("mongo", f"{self._proxy._name}.find", key, run)
+
+    def __iter__(self):
+        return iter(self._fetch())
+
+
+def _encode_mongo_result(value):
+    # InsertOneResult / UpdateResult / ...: keep the readable fields
+    if hasattr(value, "acknowledged"):
+        return {"$result": encode_value({
+            field: getattr(value, field)
+            for field in ("inserted_id", "inserted_ids", "matched_count", "modified_count", "upserted_id", "deleted_count")
+            if hasattr(value, field)
+        })}
+    return encode_value(value)
+
+
+def _decode_mongo_result(value):
+    if isinstance(value, dict) and "$result" in value:
+        return types.SimpleNamespace(acknowledged=True, **decode_value(value["$result"]))
+    return decode_value(value)
+
+
+class _MongoCollectionProxy:
+    """
+    Records / replays collection calls; find() cursors are materialized
+    """
+
+    def __init__(self, collection, cassette, name: str):
+        self._collection = collection
+        self._cassette = cassette
+        self._name = name
+
+    def with_options(self, **kwargs):
+        if self._cassette.mode == "replay":
+            return self
+        return _MongoCollectionProxy(self._collection.with_options(**kwargs), self._cassette, self._name)
+
+    def find(self, *args, **kwargs):
+        return _CursorProxy(self, args, kwargs)
+
+    def __getattr__(self, operation):
+        def call(*args, **kwargs):
+            return self._cassette.call(
+                "mongo", f"{self._name}.{operation}", request_key(args, kwargs),
+                lambda: getattr(self._collection, operation)(*args, **kwargs),
+                encode=_encode_mongo_result, decode=_decode_mongo_result
+            )
+        return call
+
+
+def wrap_mongo_collection(collection, name: str):
+    cassette = get_cassette()
+    return _MongoCollectionProxy(collection, cassette, name) if cassette else collection
@@ -0,0 +1,200 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling a dependency whose circuit is open
+    """
+
+    def __init__(self, dependency: str, retry_after: float):
+        super().__init__(f"Circuit for '{dependency}' is open, retry in {retry_after:.1f}s")
+        self.dependency = dependency
+        self.retry_after = retry_after
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+# -------------------------------------------------------
+# CIRCUIT BREAKERS
+# -------------------------------------------------------
+class CircuitBreaker:
+    """
+    closed    → calls pass; `failure_threshold` consecutive failures open it
+    open      → calls fail fast with CircuitOpenError for `reset_timeout`
+    half_open → one probe call is let through; success closes the circuit,
+                failure opens it again
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def retry_after(self) -> float:
+        """
+        Seconds until the circuit lets a probe through (0 if it does now)
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+
+            if state == "closed":
+                return
+
+            if state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                print(f"🔌 Circuit '{self.name}' half-open, probing")
+                return
+
+            remaining = max(0.0, self.reset_timeout - (time.monotonic() - self._opened_at))
+
+        raise CircuitOpenError(self.name, remaining or self.reset_timeout)
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                print(f"✅ Circuit '{self.name}' closed")
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            probe_failed = self._probe_in_flight
+            self._probe_in_flight = False
+
+            if probe_failed or self._failures >= self.failure_threshold:
+                if self._opened_at is None or probe_failed:
+                    print(f"🔌 Circuit '{self.name}' opened after {self._failures} failure(s)")
+                self._opened_at = time.monotonic()
+
+    @contextmanager
+    def guard(self, is_failure=lambda e: True):
+        """
+        with breaker.guard(): call_dependency()
+
+        Exceptions for which is_failure(e) is False (e.g. a 400 for a bad
+        document) count as a healthy dependency.
+        """
+        self.allow()
+        try:
+            yield
+        except Exception as e:
+            if is_failure(e):
+                self.record_failure()
+            else:
+                self.record_success()
+            raise
+        else:
+            self.record_success()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """
+    Process-wide breaker per dependency. Tuned with
+    CIRCUIT_<NAME>_FAILURES and CIRCUIT_<NAME>_RESET_SECONDS.
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            key = name.upper().replace(":", "_").replace("-", "_")
+            _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=int(os.getenv(f"CIRCUIT_{key}_FAILURES", os.getenv("CIRCUIT_FAILURES", "5"))),
+                reset_timeout=float(os.getenv(f"CIRCUIT_{key}_RESET_SECONDS", os.getenv("CIRCUIT_RESET_SECONDS", "30"))),
+            )
+        return _breakers[name]
+
+
+def open_circuits() -> dict:
+    """
+    {name: seconds until probe} for every circuit currently rejecting calls
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.retry_after() for b in breakers if b.state == "open"}
+
+
+# -------------------------------------------------------
+# DEADLINES
+# -------------------------------------------------------
+class Deadline:
+    """
+    Absolute point in time by which a transaction must finish
+    """
+
+    def __init__(self, seconds: float):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def check(self, what: str = ""):
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded{f' before {what}' if what else ''}")
+
+
+_current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline):
+    """
+    Make `deadline` visible to every stage called inside the block.
+    Threads started inside must run in a copied context
+    (contextvars.copy_context().run) to inherit it.
+    """
+    token = _current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current_deadline.reset(token)
+
+
+def current_deadline():
+    return _current_deadline.get()
+
+
+def stage_timeout(default: float, what: str = "") -> float:
+    """
+    Timeout for one dependency call: the stage default, capped by what is
+    left of the current transaction deadline.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return default
+
+    deadline.check(what)
+    return max(0.001, min(default, deadline.remaining()))
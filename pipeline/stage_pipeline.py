@@ -0,0 +1,104 @@
+import os
+import queue
+import threading
+import contextvars
+
+
+# Items buffered between two consecutive stages
+STAGE_QUEUE_SIZE = int(os.getenv("STAGE_QUEUE_SIZE", "2"))
+
+_DONE = object()
+
+
+class FanOut(list):
+    """
+    Return FanOut([a, b, ...]) from a stage to send several items
+    downstream in place of one (e.g. the documents inside a PDF bundle)
+    """
+
+
+def run_stage_pipeline(items: list, stages: list, maxsize: int = None) -> list:
+    """
+    Stream items through stages that run concurrently, one thread per stage,
+    connected by bounded queues:
+
+        items → [stage 1] → queue → [stage 2] → queue → ... → results
+
+    While stage 2 works on item 1, stage 1 already works on item 2, so the
+    total time approaches the slowest stage instead of the sum of all
+    stages.
+
+    stages : [(name, fn)] where fn(value) returns the value for the next
+             stage, None to drop the item (e.g. empty OCR), or a FanOut
+             of several values
+
+    Returns the surviving outputs of the last stage in input order (fanned
+    out items follow their parent's position). The
+    first exception raised by any stage is re-raised once all stage threads
+    have stopped.
+    """
+    maxsize = maxsize or STAGE_QUEUE_SIZE
+    queues = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+    failed = threading.Event()
+    errors = []
+
+    def feed():
+        for index, item in enumerate(items):
+            if failed.is_set():
+                break
+            queues[0].put(((index,), item))
+        queues[0].put(_DONE)
+
+    def work(name, fn, inbox, outbox):
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                outbox.put(_DONE)
+                return
+
+            # After a failure keep draining so upstream threads never block
+            if failed.is_set():
+                continue
+
+            index, value = entry
+            try:
+                result = fn(value)
+            except Exception as e:
+                e.add_note(f"pipeline stage '{name}' failed")
+                errors.append(e)
+                failed.set()
+                continue
+
+            if isinstance(result, FanOut):
+                for part, value in enumerate(result):
+                    outbox.put((index + (part,), value))
+            elif result is not None:
+                outbox.put((index, result))
+
+    # Each stage thread runs in a copy of the caller's context so the
+    # transaction deadline (pipeline.resilience) reaches every stage
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, (name, fn) in enumerate(stages):
+        threads.append(threading.Thread(
+            target=contextvars.copy_context().run,
+            args=(work, name, fn, queues[i], queues[i + 1]),
+            daemon=True
+        ))
+
+    for thread in threads:
+        thread.start()
+
+    results = []
+    while True:
+        entry = queues[-1].get()
+        if entry is _DONE:
+            break
+        results.append(entry)
+
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return [value for _, value in sorted(results, key=lambda entry: entry[0])]
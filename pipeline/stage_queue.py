@@ -0,0 +1,403 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime, timezone
+from pipeline.resilience import current_deadline
+
+
+# Pipeline stages in execution order
+STAGES = [
+    "fetched",
+    "ocr",
+    "classified",
+    "extracted",
+    "summarized",
+    "merged",
+    "uploaded",
+    "stored",
+]
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+
+
+class StageQueue:
+    """
+    Durable local job queue (SQLite) for trade finance transactions.
+
+    A job is one email. Every stage writes its output to `stage_outputs`
+    as soon as it finishes, keyed by (job_id, stage, item_key) where
+    item_key identifies the attachment for per-document stages. After a
+    crash the job is still pending and a rerun reads completed outputs
+    back instead of repeating OCR or LLM calls.
+
+    Workers take jobs with claim(), which atomically leases one job for
+    lease_seconds. Several processes on the same host can share the
+    database file; a lease that is not renewed expires and the job is
+    handed to the next claimer.
+    """
+
+    def __init__(self, db_path: str = None, max_attempts: int = None):
+        self.db_path = db_path or os.getenv("PIPELINE_QUEUE_DB", "pipeline_queue.db")
+        self.max_attempts = max_attempts or int(os.getenv("PIPELINE_MAX_ATTEMPTS", "3"))
+
+        self._lock = threading.Lock()
+        # isolation_level=None → explicit BEGIN IMMEDIATE for atomic claims
+        self._conn = sqlite3.connect(
+            self.db_path, timeout=30, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id      TEXT PRIMARY KEY,
+                payload     TEXT NOT NULL,
+                status      TEXT NOT NULL,
+                stage       TEXT NOT NULL,
+                attempts    INTEGER NOT NULL DEFAULT 0,
+                last_error  TEXT,
+                created_at  TEXT NOT NULL,
+                updated_at  TEXT NOT NULL
+            );
+
+            CREATE TABLE IF NOT EXISTS stage_outputs (
+                job_id      TEXT NOT NULL,
+                stage       TEXT NOT NULL,
+                item_key    TEXT NOT NULL DEFAULT '',
+                output      TEXT NOT NULL,
+                created_at  TEXT NOT NULL,
+                PRIMARY KEY (job_id, stage, item_key)
+            );
+            """
+        )
+
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for column, ddl in (
+            ("lease_owner", "TEXT"),
+            ("lease_expires", "REAL"),
+            ("available_at", "REAL NOT NULL DEFAULT 0"),
+        ):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {ddl}")
+
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_jobs_claim "
+            "ON jobs (status, available_at, created_at)"
+        )
+
+    # -------------------------------
+    # Jobs
+    # -------------------------------
+    def enqueue(self, job_id: str, payload: dict) -> bool:
+        """
+        Adds a job in stage 'fetched'. Returns False if it already exists.
+        """
+        now = _now()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO jobs "
+                "(job_id, payload, status, stage, created_at, updated_at) "
+                "VALUES (?, ?, 'pending', 'fetched', ?, ?)",
+                (job_id, json.dumps(payload), now, now),
+            )
+        return cursor.rowcount == 1
+
+    def pending_jobs(self, limit: int = None) -> list:
+        query = (
+            "SELECT job_id, payload, stage, attempts FROM jobs "
+            "WHERE status = 'pending' ORDER BY created_at"
+        )
+        params = ()
+        if limit:
+            query += " LIMIT ?"
+            params = (limit,)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        return [
+            {
+                "job_id": job_id,
+                "payload": json.loads(payload),
+                "stage": stage,
+                "attempts": attempts,
+            }
+            for job_id, payload, stage, attempts in rows
+        ]
+
+    def get_job(self, job_id: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT job_id, payload, status, stage, attempts, last_error "
+                "FROM jobs WHERE job_id = ?",
+                (job_id,),
+            ).fetchone()
+
+        if not row:
+            return None
+
+        return {
+            "job_id": row[0],
+            "payload": json.loads(row[1]),
+            "status": row[2],
+            "stage": row[3],
+            "attempts": row[4],
+            "last_error": row[5],
+        }
+
+    # -------------------------------
+    # Leases
+    # -------------------------------
+    def claim(self, worker_id: str, lease_seconds: float = None):
+        """
+        Atomically lease the oldest available job to worker_id.
+
+        Pending jobs and jobs whose lease has expired are both claimable.
+        Returns the job dict or None when the queue is empty.
+        """
+        lease_seconds = lease_seconds or LEASE_SECONDS
+        now = time.time()
+
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT job_id, payload, stage, attempts FROM jobs "
+                    "WHERE (status = 'pending' AND available_at <= ?) "
+                    "   OR (status = 'leased' AND lease_expires < ?) "
+                    "ORDER BY created_at LIMIT 1",
+                    (now, now),
+                ).fetchone()
+
+                if row:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'leased', lease_owner = ?, "
+                        "lease_expires = ?, updated_at = ? WHERE job_id = ?",
+                        (worker_id, now + lease_seconds, _now(), row[0]),
+                    )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        if not row:
+            return None
+
+        return {
+            "job_id": row[0],
+            "payload": json.loads(row[1]),
+            "stage": row[2],
+            "attempts": row[3],
+        }
+
+    def renew_lease(self, job_id: str, worker_id: str, lease_seconds: float = None) -> bool:
+        """
+        Extend a lease. Returns False if the lease was lost to another worker.
+        """
+        lease_seconds = lease_seconds or LEASE_SECONDS
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? "
+                "WHERE job_id = ? AND status = 'leased' AND lease_owner = ?",
+                (time.time() + lease_seconds, _now(), job_id, worker_id),
+            )
+        return cursor.rowcount == 1
+
+    def requeue_expired(self) -> int:
+        """
+        Put jobs whose lease ran out back to pending. Returns the count.
+        """
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = 'pending', lease_owner = NULL, "
+                "lease_expires = NULL, updated_at = ? "
+                "WHERE status = 'leased' AND lease_expires < ?",
+                (_now(), time.time()),
+            )
+        return cursor.rowcount
+
+    def complete(self, job_id: str, worker_id: str = None) -> bool:
+        """
+        Mark a job done. With worker_id, only succeeds while holding the lease.
+        """
+        query = (
+            "UPDATE jobs SET status = 'done', stage = ?, last_error = NULL, "
+            "lease_owner = NULL, lease_expires = NULL, updated_at = ? WHERE job_id = ?"
+        )
+        params = [STAGES[-1], _now(), job_id]
+        if worker_id:
+            query += " AND lease_owner = ?"
+            params.append(worker_id)
+
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+        return cursor.rowcount == 1
+
+    def release(self, job_id: str, retry_delay: float = 0, worker_id: str = None) -> bool:
+        """
+        Give a leased job back without counting an attempt (e.g. a
+        dependency is down), claimable again after retry_delay seconds.
+        With worker_id, only succeeds while holding the lease.
+        """
+        query = (
+            "UPDATE jobs SET status = 'pending', lease_owner = NULL, "
+            "lease_expires = NULL, available_at = ?, updated_at = ? "
+            "WHERE job_id = ? AND status = 'leased'"
+        )
+        params = [time.time() + retry_delay, _now(), job_id]
+        if worker_id:
+            query += " AND lease_owner = ?"
+            params.append(worker_id)
+
+        with self._lock:
+            cursor = self._conn.execute(query, params)
+        return cursor.rowcount == 1
+
+    def fail(self, job_id: str, error: str, retry_delay: float = 0) -> str:
+        """
+        Records a failed attempt and releases the lease. The job stays
+        pending (and resumes from its checkpoints on the next claim, no
+        earlier than retry_delay seconds from now) until max_attempts is
+        reached.
+
+        Returns the new status.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT attempts FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            status = "failed" if attempts >= self.max_attempts else "pending"
+
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, attempts = ?, last_error = ?, "
+                "lease_owner = NULL, lease_expires = NULL, available_at = ?, "
+                "updated_at = ? WHERE job_id = ?",
+                (status, attempts, error, time.time() + retry_delay, _now(), job_id),
+            )
+        return status
+
+    # -------------------------------
+    # Stage checkpoints
+    # -------------------------------
+    def save_stage_output(self, job_id: str, stage: str, output, item_key: str = ""):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown pipeline stage: {stage}")
+
+        now = _now()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stage_outputs "
+                "(job_id, stage, item_key, output, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, stage, item_key, json.dumps({"value": output}), now),
+            )
+
+            # Track the furthest stage reached, for observability
+            self._conn.execute(
+                "UPDATE jobs SET stage = ?, updated_at = ? WHERE job_id = ? AND "
+                "instr(?, ',' || stage || ',') < instr(?, ',' || ? || ',')",
+                (stage, now, job_id, _STAGE_ORDER, _STAGE_ORDER, stage),
+            )
+
+    def load_stage_output(self, job_id: str, stage: str, item_key: str = ""):
+        """
+        Returns (found, output)
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT output FROM stage_outputs "
+                "WHERE job_id = ? AND stage = ? AND item_key = ?",
+                (job_id, stage, item_key),
+            ).fetchone()
+
+        if not row:
+            return False, None
+        return True, json.loads(row[0])["value"]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_STAGE_ORDER = "," + ",".join(STAGES) + ","
+
+LEASE_SECONDS = float(os.getenv("PIPELINE_LEASE_SECONDS", "300"))
+
+
+class LeaseHeartbeat:
+    """
+    Keeps a claimed job's lease alive from a background thread while the
+    job is being processed. `lost` turns True if another worker took over.
+    """
+
+    def __init__(self, queue, job_id: str, worker_id: str, lease_seconds: float = None):
+        self.queue = queue
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds or LEASE_SECONDS
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            if not self.queue.renew_lease(self.job_id, self.worker_id, self.lease_seconds):
+                print(f"⚠️ Lease lost for {self.job_id} ({self.worker_id})")
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        return False
+
+
+def run_checkpointed_stage(queue: StageQueue, job_id: str, stage: str, compute, item_key: str = ""):
+    """
+    Return the checkpointed output of a stage, or compute and checkpoint it.
+    Empty outputs (e.g. OCR that failed and returned "") and failures
+    ({"error": ...}, e.g. an LLM answer that did not parse) are not
+    checkpointed, so a retry computes them again.
+    """
+    found, output = queue.load_stage_output(job_id, stage, item_key)
+    if found:
+        suffix = f" for {item_key}" if item_key else ""
+        print(f"⏩ Resuming {job_id}: '{stage}' already done{suffix}")
+        return output
+
+    deadline = current_deadline()
+    if deadline:
+        deadline.check(stage)
+
+    output = compute()
+    failed = isinstance(output, dict) and "error" in output
+    if output and not failed:
+        queue.save_stage_output(job_id, stage, output, item_key)
+    return output
+
+
+_stage_queue = None
+_stage_queue_lock = threading.Lock()
+
+
+def get_stage_queue():
+    """
+    Process-wide queue. PIPELINE_QUEUE_BACKEND=mongo shares jobs across
+    hosts through MongoDB; the default SQLite file serves one host.
+    """
+    global _stage_queue
+    with _stage_queue_lock:
+        if _stage_queue is None:
+            if os.getenv("PIPELINE_QUEUE_BACKEND", "sqlite").lower() == "mongo":
+                from email_and_mongo.mongo_job_queue import MongoStageQueue
+                _stage_queue = MongoStageQueue()
+            else:
+                _stage_queue = StageQueue()
+    return _stage_queue
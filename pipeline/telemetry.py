@@ -0,0 +1,375 @@
+import os
+import json
+import time
+import uuid
+import random
+import threading
+import contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# Spans feed the stage histograms below; off skips both
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "1") == "1"
+# Finished spans as JSON lines (empty = not written)
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "")
+# Per-transaction stage breakdown printed when a trace ends
+TRACE_SUMMARY = os.getenv("TRACE_SUMMARY", "1") == "1"
+
+# Prometheus text endpoint (GET /metrics); 0 disables it
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+# Debug payloads (raw OCR text, raw LLM output): fraction logged, at most
+# N per label per minute, truncated
+DEBUG_PAYLOAD_SAMPLE_RATE = float(os.getenv("DEBUG_PAYLOAD_SAMPLE_RATE", "0.01"))
+DEBUG_PAYLOAD_MAX_PER_MINUTE = int(os.getenv("DEBUG_PAYLOAD_MAX_PER_MINUTE", "5"))
+DEBUG_PAYLOAD_MAX_CHARS = int(os.getenv("DEBUG_PAYLOAD_MAX_CHARS", "2000"))
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+# -------------------------------------------------------
+# METRICS
+# -------------------------------------------------------
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((str(k), str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(key)} {value}" for key, value in values]
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._values.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            values = sorted((key, dict(series, counts=list(series["counts"]))) for key, series in self._values.items())
+
+        lines = []
+        for key, series in values:
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f"{self.name}_bucket{_format_labels(key, (('le', str(bound)),))} {count}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {round(series['sum'], 6)}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Process-wide counters / gauges / histograms rendered in the Prometheus
+    text format. Collectors are called on every scrape to refresh gauges
+    from stats the pipeline already keeps (outbox backlog, circuits, ...).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._collectors = []
+
+    def _get(self, cls, name: str, help_text: str, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name: str, help_text: str = "") -> Counter:
+        return self._get(Counter, name, help_text)
+
+    def gauge(self, name: str, help_text: str = "") -> Gauge:
+        return self._get(Gauge, name, help_text)
+
+    def histogram(self, name: str, help_text: str = "", buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def register_collector(self, collect):
+        with self._lock:
+            self._collectors.append(collect)
+
+    def render(self) -> str:
+        with self._lock:
+            collectors = list(self._collectors)
+
+        for collect in collectors:
+            try:
+                collect(self)
+            except Exception as e:
+                print(f"⚠️ Metrics collector failed: {e}")
+
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+
+        lines = []
+        for metric in metrics:
+            kind = {Histogram: "histogram", Gauge: "gauge"}.get(type(metric), "counter")
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+STAGE_SECONDS = metrics.histogram("pipeline_stage_duration_seconds", "Duration of one pipeline stage span")
+STAGE_TOTAL = metrics.counter("pipeline_stage_total", "Finished stage spans by status")
+
+
+# -------------------------------------------------------
+# TRACING
+# -------------------------------------------------------
+class Span:
+    """
+    One timed stage. Nested spans share the trace id of the outermost one
+    (one trace per transaction); counts added with add() are summed, so
+    tokens from several LLM calls inside a stage end up on that stage.
+    """
+
+    def __init__(self, name: str, parent=None, attributes: dict = None):
+        self.name = name
+        self.parent = parent
+        self.root = parent.root if parent else self
+        self.trace_id = self.root.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.duration = None
+        self._lock = threading.Lock()
+        # Root only: seconds per child stage name
+        self._stage_seconds = {}
+
+    def set(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, **counts):
+        with self._lock:
+            for key, value in counts.items():
+                self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent.span_id if self.parent else None,
+            "name": self.name,
+            "start": round(self.started_at, 6),
+            "duration": round(self.duration, 6) if self.duration is not None else None,
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+_trace_log_lock = threading.Lock()
+
+
+def current_span():
+    return _current_span.get()
+
+
+def _finish(span: Span):
+    span.duration = time.monotonic() - span._started
+
+    STAGE_SECONDS.observe(span.duration, stage=span.name)
+    STAGE_TOTAL.inc(stage=span.name, status=span.status)
+
+    if span.parent:
+        with span.root._lock:
+            span.root._stage_seconds[span.name] = span.root._stage_seconds.get(span.name, 0.0) + span.duration
+    elif TRACE_SUMMARY and span.root._stage_seconds:
+        breakdown = ", ".join(
+            f"{name} {seconds:.2f}s"
+            for name, seconds in sorted(span.root._stage_seconds.items(), key=lambda item: -item[1])
+        )
+        print(f"🧭 Trace {span.trace_id[:12]} {span.name} {span.duration:.2f}s ({span.status}): {breakdown}")
+
+    if TRACE_LOG_PATH:
+        line = json.dumps(span.to_dict(), default=str)
+        with _trace_log_lock:
+            with open(TRACE_LOG_PATH, "a") as f:
+                f.write(line + "\n")
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    with span("ocr", file=name) as s: ...; s.set(pages=3)
+
+    Threads started inside must run in a copied context
+    (contextvars.copy_context().run) to nest their spans under this one.
+    Child stages of one transaction overlap (the stage pipeline), so the
+    summary shows busy time per stage, not a partition of the total.
+    """
+    if not TRACING_ENABLED:
+        yield Span(name, attributes=attributes)
+        return
+
+    current = Span(name, parent=_current_span.get(), attributes=attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        _current_span.reset(token)
+        _finish(current)
+
+
+def add_to_span(**counts):
+    """
+    Sum counts (tokens, bytes, ...) into the current span, if any
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.add(**counts)
+
+
+# -------------------------------------------------------
+# METRICS ENDPOINT
+# -------------------------------------------------------
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown the pipeline output
+        pass
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port: int = None, host: str = None):
+    """
+    Serve GET /metrics from a daemon thread (once per process). Returns
+    the server, or None when disabled or the port is taken.
+    """
+    global _metrics_server
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+
+    with _metrics_server_lock:
+        if _metrics_server is None:
+            try:
+                _metrics_server = ThreadingHTTPServer((host or METRICS_HOST, port), _MetricsHandler)
+            except OSError as e:
+                print(f"⚠️ Metrics endpoint not started on port {port}: {e}")
+                return None
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+            print(f"📈 Metrics on http://{_metrics_server.server_address[0]}:{_metrics_server.server_address[1]}/metrics")
+    return _metrics_server
+
+
+# -------------------------------------------------------
+# SAMPLED DEBUG PAYLOADS
+# -------------------------------------------------------
+_debug_lock = threading.Lock()
+_debug_windows = {}
+_debug_random = random.Random()
+
+
+def log_debug_payload(label: str, payload, force: bool = False):
+    """
+    Print a large debug payload (raw OCR text, raw LLM output) for a
+    sample of calls: DEBUG_PAYLOAD_SAMPLE_RATE of them, at most
+    DEBUG_PAYLOAD_MAX_PER_MINUTE per label, truncated to
+    DEBUG_PAYLOAD_MAX_CHARS. force=True skips the sampling (e.g. a parse
+    failure) but not the rate limit. Printing every payload in full used
+    to flood the logs at batch volume.
+    """
+    now = time.monotonic()
+
+    with _debug_lock:
+        if not force and _debug_random.random() >= DEBUG_PAYLOAD_SAMPLE_RATE:
+            return False
+
+        window = _debug_windows.setdefault(label, {"started": now, "logged": 0, "dropped": 0})
+        if now - window["started"] >= 60:
+            if window["dropped"]:
+                print(f"🔇 {label}: {window['dropped']} debug payload(s) dropped in the last minute")
+            window.update(started=now, logged=0, dropped=0)
+
+        if window["logged"] >= DEBUG_PAYLOAD_MAX_PER_MINUTE:
+            window["dropped"] += 1
+            return False
+        window["logged"] += 1
+
+    text = payload if isinstance(payload, str) else str(payload)
+    if len(text) > DEBUG_PAYLOAD_MAX_CHARS:
+        text = f"{text[:DEBUG_PAYLOAD_MAX_CHARS]}… [{len(text) - DEBUG_PAYLOAD_MAX_CHARS} more chars]"
+
+    current = _current_span.get()
+    trace = f" [trace {current.trace_id[:12]}]" if current else ""
+    print(f"\n🔎 {label}{trace}:\n{text}")
+    return True